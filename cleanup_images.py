@@ -3,22 +3,31 @@
 import argparse
 import sys
 from hpcmodules import *
-from umount_image import umount_image
+from umount_image import umount_image, evict_idle_images
 
 
 def cleanup_images(cleanup=False, kill=False, verbosity=1):
 
-    # get used loop devices
-    loopdevs = list_loopdevs()
+    # unmount the idle images whose grace period is over
+    with local_lock_images() as lock:
+        with metrics_phase('evict'):
+            evict_idle_images()
 
-    # get all mounted images
-    images = get_mounted_images()
+    # get used loop devices, and those of the layers of stacked images
+    with metrics_phase('scan'):
+        loopdevs = list_loopdevs()
+        layer_loopdevs = get_layer_loopdevs()
+
+        # get all mounted images, and the idle ones
+        images = get_mounted_images()
+        idle = [i[0] for i in get_idle_images()]
 
     for (img, mnt, loopdev) in iter(images):
 
-        # check if used by a job
-        usage = get_image_usage(img)
-        if usage == 0:
+        # check if used by a job. Stacks that use the image as a layer do not use this mount. Idle images are kept
+        # mounted on purpose, unused images that are not idle are left over.
+        usage = get_image_usage(img, layers=False)
+        if usage == 0 and img not in idle:
             try:
                 # is this a software image?
                 module_name = get_module_name(img)
@@ -27,14 +36,31 @@ def cleanup_images(cleanup=False, kill=False, verbosity=1):
                 module_name = None
 
             if module_name is None:
-                umount_image(img, mnt)
+                umount_image(img, mnt, keep_idle=False)
             else:
-                umount_image(module_name)
-
-        # remove loop device from list of used devices
-        idx = [i for i, loop in enumerate(loopdevs) if loop[0] == loopdev]
-        idx = idx[0]
-        loopdevs = loopdevs[:idx] + loopdevs[idx + 1:]
+                umount_image(module_name, keep_idle=False)
+
+        # remove loop device from list of used devices (overlays of stacked images have none)
+        if loopdev is not None:
+            idx = [i for i, loop in enumerate(loopdevs) if loop[0] == loopdev]
+            idx = idx[0]
+            loopdevs = loopdevs[:idx] + loopdevs[idx + 1:]
+
+    # layers that no mounted stacked image uses any more
+    used = set(d for (m, dirs) in get_stack_mounts() for d in dirs)
+    unused = [m for m in get_layer_mounts().values() if m.mntpoint not in used]
+    if len(unused):
+        if cleanup:
+            with local_lock_images() as lock:
+                umount_layers()
+        else:
+            for m in unused:
+                print(' --- WARNING: ' + m.source + ' is mounted as a layer at ' + m.mntpoint + ', but no stacked image uses it')
+
+    # idle pool loop devices are not blocked, they are detached by trim_loop_pool. Layers of stacked images are not
+    # blocked either.
+    pool = [d for (d, i) in get_pool_loopdevs()] + layer_loopdevs
+    loopdevs = [l for l in loopdevs if l[0] not in pool]
 
     # remaining loop devices are blocked
     if len(loopdevs):
@@ -70,10 +96,12 @@ if __name__ == '__main__':
     parser.add_argument("--verbosity", help="Print some extra information", default=1)
     args = parser.parse_args()
 
+    start_metrics('cleanup_images')
     try:
         cleanup_images(args.cleanup, args.kill, int(args.verbosity))
 
     except ModuleException:
         print(str(sys.exc_info()[1]))
+        metrics_failed(str(sys.exc_info()[1]))
         exit(1)
     # other exceptions run through
@@ -0,0 +1,115 @@
+#!/usr/bin/env python2
+
+# Compact the global image lock files.
+#
+# Older versions stored the host names of RO mounts as lines in <image>.lock. This script moves them into per-host
+# holder records in <image>.lock.d (see get_holder_dir), so that later unmounts only remove their own record.
+# Only the " rw "+hostname claim of an RW mount is kept in the lock file. Leftover temporary records are removed,
+# and holder records of hosts given with --remove_host are dropped (e.g., reinstalled nodes).
+
+import os
+import sys
+import argparse
+from hpcmodules import *
+
+
+def compact_image_lock(imagename, remove_hosts=[], dry_run=False):
+
+    migrated = []
+    removed = []
+    with fs_lock_file(imagename + ".lock", False) as fd:
+
+        fd.seek(0)
+        lines = fd.readlines()
+        holders = list_holder_dir(get_holder_dir(imagename))
+        mtime = int(os.fstat(fd.fileno()).st_mtime)
+
+        keep = []
+        for line in lines:
+            # a leftover " rw " line without a host name is dropped
+            (h, mode) = parse_lock_file_line(line)
+            if not h:
+                continue
+            if h in remove_hosts:
+                removed.append(h)
+                continue
+
+            # the RW claim stays in the lock file
+            if mode == 'rw' and len(keep) == 0:
+                keep.append(" rw " + h + "\n")
+
+            # the time of the mount is not known, use the last change of the lock file
+            if h not in holders:
+                migrated.append(h)
+                holders.append(h)
+                if not dry_run:
+                    add_image_holder(imagename, h, mode, mtime)
+
+        for h in remove_hosts:
+            if h in list_holder_dir(get_holder_dir(imagename)):
+                removed.append(h)
+                if not dry_run:
+                    remove_image_holder(imagename, h)
+
+        if dry_run:
+            return migrated, removed
+
+        # temporary records left by interrupted mounts
+        dname = get_holder_dir(imagename)
+        if os.path.isdir(dname):
+            for f in os.listdir(dname):
+                if f.startswith('.') and f.endswith('.tmp'):
+                    os.remove(os.path.join(dname, f))
+
+        if keep != lines:
+            fd.truncate(0)
+            fd.seek(0)
+            fd.writelines(keep)
+
+    return migrated, removed
+
+
+# all image lock files under image_path
+def find_image_locks():
+    images = []
+    for dirpath, dirnames, filenames in os.walk(image_path):
+        for f in filenames:
+            if f.endswith(".lock"):
+                images.append(os.path.join(dirpath, f[:-len(".lock")]))
+    return sorted(images)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Move host names stored in image lock files into per-host holder records.")
+    parser.add_argument("image_name", help="software module, or path to image file [default: all images in " + image_path + "]", nargs='*')
+    parser.add_argument("--remove_host", help="remove all records of a host (can be given more than once)", action='append', default=[])
+    parser.add_argument("--dry-run", help="only report what would be changed", action='store_true')
+    args = parser.parse_args()
+
+    try:
+        if len(args.image_name):
+            images = []
+            for name in args.image_name:
+                if os.path.isfile(name):
+                    images.append(os.path.realpath(name))
+                else:
+                    images.append(get_image_name(name))
+        else:
+            images = find_image_locks()
+
+        for imagename in images:
+            try:
+                migrated, removed = compact_image_lock(imagename, args.remove_host, args.dry_run)
+            except ModuleException:
+                print(" --- " + imagename + str(sys.exc_info()[1]))
+                continue
+            if len(migrated):
+                print(" --- " + imagename + ": migrated " + " ".join(migrated))
+            if len(removed):
+                print(" --- " + imagename + ": removed " + " ".join(removed))
+
+    except ModuleException:
+        print(str(sys.exc_info()[1]))
+        exit(1)
+    # other exceptions run through
@@ -1,39 +1,47 @@
 #!/usr/bin/env python2
 
-# This script creates an ext4 fs image that contains the software module files.
+# This script creates a file system image that contains the software module files.
 #
 # Input: module name, e.g., matlab-R2014b
 #
 # Output: image file located in cluster/software/IMAGES, e.g., /cluster/software/IMAGES/matlab/R2014b.ext4
 #
-# 1. calculate the space needed for the files (size of directory contents * oversize factor)
-# 2. create empty image file in <workdir>
-# 3. create ext4 fs in the file
-# 4. mount the file in a temporary directory over loopback
-# 5. rsync the source directory to the loop-mounted image
-# 6. unmount the image
-# 7. move the image to /cluster/software/IMAGES/<module_name>/<module_version>.ext4
+# The image format is selected with --format (see image_formats.py):
+#  ext4:
+#   1. calculate the exact size of the ext4 file system for the files (blocks, inodes, directories, metadata)
+#   2. create empty image file in <workdir>
+#   3. create ext4 fs in the file, populated with the source directory by mke2fs -d (--ext4_build populate, no root
+#      privileges needed), or
+#   3. create ext4 fs in the file, mount it in a temporary directory over loopback, rsync the source directory to the
+#      loop-mounted image and unmount the image (--ext4_build rsync)
+#   4. optionally shrink the file system to its minimum size (--shrink)
+#  ext4, incremental (--incremental, needs root):
+#   1. copy the existing image to <workdir>, and grow it if the files need more space or inodes
+#   2. mount the copy and rsync only the changed files into it
+#  squashfs, erofs:
+#   1. build a compressed read-only image of the source directory in <workdir>
+#  layered (--base <module>, see image_layers.py):
+#   1. compare the manifest of the source directory with the manifest of the base image
+#   2. stage the files that differ, and whiteouts for the removed ones, in <workdir>
+#   3. build the layer image of the staged files in any format, and write the stack file next to it
+# Then the image is moved to /cluster/software/IMAGES/<module_name>/<module_version>.<format>, replacing an existing
+# image atomically: jobs that have the old image mounted keep using it. The manifest of the source directory (see
+# manifest.py), computed while the image is built, is written next to it.
 
 import os
 import sys
-import subprocess
 import shutil
 import argparse
-import math
 import tempfile
-from filefs import filefs
+import threading
+import image_formats
+from image_formats import formats, default_format, get_image_format
 
 from hpcmodules import *
-from get_dir_size import get_dir_size
-
-# MB
-MB = 1024*1024
-
-# space for the image filesystem:
-# Image size = oversize * space in bytes required for the files
-oversize = 1.3
-# give some slack to small modules - often fail to install with small oversize
-oversize_small = 3
+from image_profile import get_hot_name
+from manifest import Manifest, get_manifest_name, read_manifest, write_manifest, compute_manifest, compare_manifests
+from image_layers import make_layer, write_stack, get_stacked_images
+from filefs import MB
 
 
 if __name__ == '__main__':
@@ -43,100 +51,133 @@ if __name__ == '__main__':
     parser.add_argument("module_name", help="Name of the module to deploy (installed software must reside in " + mount_path + "/<module_name>/<module_version>)")
     parser.add_argument("module_version", help="Name of the module to deploy (installed software must reside in " + mount_path + "/<module_name>/<module_version>)")
     parser.add_argument("-f", "--overwrite", help="Overwrite existing image file [default: False].", default=False, action="store_true")
-    parser.add_argument("--oversize", help="Image size = oversize * space in bytes required for the files [default: " + str(oversize) + "]", default=oversize)
-    parser.add_argument("--workdir", help="Temporary location where to create the image. A finished imaged will be moved to " + image_path + "/<module_name>/<module_version>.ext4 [default: /cluster/tmp]", default='/cluster/tmp')
+    parser.add_argument("--extra_size", help="free space of ext4 images, on top of the exact size [MB, default: %(default)s]", type=int, default=image_formats.ext4_extra_size)
+    parser.add_argument("--incremental", help="update the existing ext4 image with the changed files only (needs root) [default: False]", default=False, action="store_true")
+    parser.add_argument("--shrink", help="shrink ext4 images to their minimum size with resize2fs -M [default: False]", default=image_formats.ext4_shrink > 0, action="store_true")
+    parser.add_argument("--workdir", help="Temporary location where to create the image. A finished imaged will be moved to " + image_path + "/<module_name>/<module_version>.<format> [default: /cluster/tmp]", default='/cluster/tmp')
+    parser.add_argument("--format", help="image format: " + ", ".join(sorted(formats)) + " [default: %(default)s]", default=default_format)
+    parser.add_argument("--base", help="build the image as a layer on the image of this module, e.g., gcc/9.3.0 (needs root if files of the base are removed)", default=None)
+    parser.add_argument("--replace_base", help="replace the image even if other images are stacked on it, they cannot be mounted until they are rebuilt [default: False]", default=False, action="store_true")
+    parser.add_argument("--ext4_build", help="build mode of ext4 images: populate (mke2fs -d), or rsync (loop mount, needs root) [default: %(default)s]", default=image_formats.ext4_build)
     args = parser.parse_args()
-    oversize = float(args.oversize)
+    image_formats.ext4_build = args.ext4_build
+    image_formats.ext4_extra_size = args.extra_size
+    image_formats.ext4_shrink = int(args.shrink)
     args.module_name = args.module_name + '/' + args.module_version
+    start_metrics('create_software_image')
 
     try:
 
+        fmt = get_image_format(args.format)
+
         # check if directory with software exists
         origpath = get_mount_path(args.module_name)
         if not os.path.isdir(origpath):
             raise ModuleException(args.module_name + " is not available in " + mount_path)
         print(" --- mount point for this module: " + origpath)
 
-        # check if image file exists
-        image_name = get_image_name(args.module_name)
-        if os.path.isfile(image_name) and not args.overwrite:
-            raise ModuleException(image_name + " exists, bailing out. Use --overwrite.")
-
-        # find the size (in MB)
-        print(" --- estimating module space requirements")
-        size = get_dir_size(origpath)
-        if size < 20*MB:
-            size = int(math.ceil(float(oversize_small * size) / MB))
-        else:
-            size = int(math.ceil(float(oversize * size) / MB))
-        print(" --- creating disk image of size: " + str(size) + "MB")
-        if size == 0:
+        # check if an image file exists, in any format
+        image_name = get_image_name(args.module_name, fmt.ext)
+        existing = [get_image_name(args.module_name, e) for e in image_exts if os.path.isfile(get_image_name(args.module_name, e))]
+        if args.incremental:
+            if not hasattr(fmt, 'update'):
+                raise ModuleException(fmt.name + " images cannot be updated incrementally")
+            if not os.path.isfile(image_name):
+                raise ModuleException(image_name + " does not exist, cannot update it incrementally")
+            if len(get_image_stack(image_name, check=False)):
+                raise ModuleException(image_name + " is a layer, cannot update it incrementally")
+        elif len(existing) and not args.overwrite:
+            raise ModuleException(" ".join(existing) + " exists, bailing out. Use --overwrite.")
+
+        # the base image, and the images below it
+        lowers = []
+        if args.base is not None:
+            if args.incremental:
+                raise ModuleException("--base and --incremental cannot be combined")
+            base_image = get_image_name(args.base)
+            if not os.path.isfile(base_image):
+                raise ModuleException(args.base + " has no image in " + image_path)
+            if not os.path.isfile(get_manifest_name(base_image)):
+                raise ModuleException(base_image + " has no manifest, rebuild it to use it as a base")
+            lowers = get_image_stack(base_image) + [base_image]
+            stats = [os.stat(l) for l in lowers]
+            if len([l for l in lowers if l in existing]):
+                raise ModuleException(args.module_name + " cannot be a layer on its own image")
+            print(" --- base image: " + base_image + " (" + str(len(lowers)) + " lower images)")
+
+        # the image size is computed by the format
+        if not len(os.listdir(origpath)):
             raise ModuleException("module empty, bailing out.")
 
+        # nothing to do if the metadata of the source directory matches the manifest of the image
+        if args.incremental and os.path.isfile(get_manifest_name(image_name)):
+            if not len(compare_manifests(read_manifest(get_manifest_name(image_name)), compute_manifest(origpath, quick=True), True)):
+                print(" --- " + image_name + " is up to date")
+                exit(0)
+
+        # the layers on an image hold their differences to it: they do not mount on a replaced image
+        stacked = []
+        for f in existing:
+            stacked += get_stacked_images(f)
+        if len(stacked):
+            if not args.replace_base:
+                raise ModuleException(" ".join(stacked) + " are stacked on " + " ".join(existing) + " and cannot be mounted "
+                                      "once it is replaced. Use --replace_base, and rebuild them afterwards.")
+            print(" --- WARNING: " + " ".join(stacked) + " are stacked on " + " ".join(existing) + " and cannot be mounted until they are rebuilt")
+
+        # manifest of the source directory, computed while the image is built. A layer is staged from it.
+        manifest = []
+        def manifest_worker():
+            try:
+                manifest.append(compute_manifest(origpath))
+            except:
+                manifest.append(sys.exc_info()[1])
+        manifest_thread = threading.Thread(target=manifest_worker)
+        manifest_thread.daemon = True
+        manifest_thread.start()
+
+        srcdir = origpath
+        if len(lowers):
+            manifest_thread.join()
+            if not isinstance(manifest[0], Manifest):
+                raise ModuleException("cannot build a layer without a manifest: " + str(manifest[0]))
+            base = read_manifest(get_manifest_name(lowers[-1]))
+            srcdir = tempfile.mkdtemp('', 'layer', args.workdir)
+            print(" --- staging the layer on " + lowers[-1] + " in " + srcdir)
+            try:
+                with metrics_phase('layer'):
+                    (nentries, nwhiteouts, nbytes) = make_layer(origpath, srcdir, base, manifest[0])
+            except (OSError, IOError):
+                shutil.rmtree(srcdir)
+                raise ModuleException("cannot stage the layer: " + str(sys.exc_info()[1]))
+            except ModuleException:
+                shutil.rmtree(srcdir)
+                raise
+            total = sum([e[2] for e in manifest[0].entries.values() if e[0] == 'f'])
+            print(" --- layer: " + str(nentries) + " of " + str(len(manifest[0].entries)) + " entries, " + str(nwhiteouts) +
+                  " whiteouts, " + str(nbytes / MB) + " of " + str(total / MB) + " MB of files (" + str((total - nbytes) / MB) + " MB shared with the base)")
+
         # create file system image in a temporary location
         final_image_name = image_name
         (fd, image_name) = tempfile.mkstemp('', 'tmp', args.workdir)
         os.close(fd)
-        print(" --- building image at " + image_name)
         try:
-            filefs(size, image_name)
-        except:
-            raise ModuleException("while creating image: " + str(sys.exc_info()[1]))
-
-        # mount the image in a temporary place
-        try:
-            tempdir = tempfile.mkdtemp()
-            cmd = ['/bin/mount', '-o', 'loop,rw', image_name, tempdir]
-            p1 = subprocess.Popen(cmd)
-            p1.wait()
-            if p1.returncode:
-                raise ModuleException("mount failed with " + str(p.returncode))
-
-        except ModuleException:
-            print(str(sys.exc_info()[1]))
-            print(" --- removing BAD IMAGE " + image_name)
-            os.remove(image_name)
-            raise ModuleException("while mounting image: " + str(sys.exc_info()[1]))
-
-        # assume we failed to produce a valid image, bad images are removed at the end
-        image_ok = False
-
-        # rsync - copy tree
-        try:
-            print(" --- copy module files into the image using rsync")
-            cmd = ["rsync", "-av", origpath + "/", tempdir]
-            p1 = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-            for line in iter(p1.stdout.readline, b''):
-                sys.stdout.write(line.decode("utf-8"))
-
-            p1.wait()
-            if not p1.returncode:
-                print(" --- rsync completed with SUCCESS")
-                image_ok = True
+            if args.incremental:
+                print(" --- updating " + fmt.name + " image " + final_image_name + " at " + image_name)
+                with metrics_phase('update'):
+                    fmt.update(origpath, image_name, final_image_name)
             else:
-                raise ModuleException("rsync returned with " + str(p.returncode))
-
+                print(" --- building " + fmt.name + " image at " + image_name)
+                with metrics_phase('build'):
+                    fmt.build(srcdir, image_name)
         except:
-            print(" --- trying to clean up...")
-
-        #  unmount the image, remove temporary directory
-        try:
-            cmd = ['/bin/umount', tempdir]
-            p1 = subprocess.Popen(cmd)
-            p1.wait()
-            if p1.returncode:
-                raise ModuleException("umount failed with " + str(p.returncode))
-
-            os.rmdir(tempdir)
-        except ModuleException:
             print(str(sys.exc_info()[1]))
-            print(" --- WARNING: image not unmounted and/or removed. Manual cleanup needed.")
-
-        if not image_ok:
             print(" --- removing BAD IMAGE " + image_name)
             os.remove(image_name)
             raise ModuleException("deployment failed.")
+        finally:
+            if srcdir != origpath:
+                shutil.rmtree(srcdir)
 
         # move the temporary image into its final location
         # might need to create the destination directory
@@ -144,11 +185,48 @@ if __name__ == '__main__':
         if not os.path.isdir(path):
             print(" --- create directory " + path)
             os.makedirs(path)
+        # the stack file of a layer is written before the image: a job that mounts the old image in between sees
+        # the files of the base below it, not the new layer without its base
+        if len(lowers):
+            write_stack(final_image_name, lowers, stats)
+            print(" --- stack written to " + get_stack_name(final_image_name))
+        # next to the final image first, then renamed: the image is replaced atomically
         print(" --- move temporary image " + image_name + " to " + final_image_name)
-        shutil.move(image_name, final_image_name)
+        with metrics_phase('install'):
+            shutil.move(image_name, final_image_name + ".new")
+            os.rename(final_image_name + ".new", final_image_name)
+        if not len(lowers) and os.path.isfile(get_stack_name(final_image_name)):
+            print(" --- removing " + get_stack_name(final_image_name) + ", the image is not a layer any more")
+            os.remove(get_stack_name(final_image_name))
+        if os.path.isfile(get_hot_name(final_image_name)):
+            print(" --- removing " + get_hot_name(final_image_name) + ", profile the new image with mount_image --profile")
+            os.remove(get_hot_name(final_image_name))
+
+        # images of the module in other formats would be found first by get_image_name
+        for f in existing:
+            if f != final_image_name:
+                print(" --- removing " + f + ", replaced by " + final_image_name + ". Check that it is not mounted anywhere.")
+                os.remove(f)
+                for g in [get_manifest_name(f), get_stack_name(f), get_hot_name(f)]:
+                    if os.path.isfile(g):
+                        os.remove(g)
+
+        with metrics_phase('manifest'):
+            manifest_thread.join()
+        if isinstance(manifest[0], Manifest):
+            write_manifest(get_manifest_name(final_image_name), manifest[0])
+            print(" --- manifest written to " + get_manifest_name(final_image_name) + ", root " + manifest[0].root)
+        else:
+            # the image is fine, but an old manifest does not describe it any more
+            print(" --- WARNING: no manifest: " + str(manifest[0]))
+            if os.path.isfile(get_manifest_name(final_image_name)):
+                os.remove(get_manifest_name(final_image_name))
+
         print(" --- Successfully created module image at " + final_image_name)
+        get_metrics().set('image', final_image_name)
 
     except ModuleException:
         print(str(sys.exc_info()[1]))
+        metrics_failed(str(sys.exc_info()[1]))
         exit(1)
     # other exceptions run through
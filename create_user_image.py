@@ -2,37 +2,28 @@
 
 # This script creates an ext4 fs image and optionally copies source data into it
 #
-# 1. calculate the space needed for the files (size of directory contents * oversize factor), or take user parameter
+# 1. calculate the exact size of the ext4 file system for the files, plus free space (oversize factor), or take user
+#    parameter
 # 2. create empty image file at user specified location
-# 3. create ext4 fs in the file
-# 4. if source given, mount the file in a temporary directory under /var/run/user_images/$(username) over loopback
-# 5. rsync the source directory to the loop-mounted image
-# 6. unmount the image
+# 3. create ext4 fs in the file. If source given, mke2fs populates the fs with the source directory (no mount needed)
+#
+# With --base <module>, the image is a layer on the image of a software module (see image_layers.py): it holds only
+# the files of the source directory that differ from the module, and is mounted read-only as an overlay on it.
 
 import os
 import sys
-import subprocess
+import shutil
 import argparse
-import math
 import tempfile
 
-from hpcmodules import get_mount_path, ModuleException, fs_lock_file
-from filefs import filefs
-from get_dir_size import get_dir_size
-
-# MB
-MB = 1024*1024
+from hpcmodules import get_mount_path, get_image_name, get_image_stack, get_stack_name, get_holder_dir, ModuleException, fs_lock_file
+from filefs import filefs, get_image_size
+from manifest import get_manifest_name, read_manifest, compute_manifest
+from image_layers import make_layer, write_stack
 
-# space for the image filesystem:
-# Image size = oversize * space in bytes required for the files
+# free space in user images:
+# Free space = (oversize - 1) * space in bytes required for the files, on top of the exact size of the file system
 oversize = 1.3
-# give some slack to small modules - often fail to install with small oversize
-oversize_small = 3
-
-# image mount / umount utilities are executed using sudo
-utils_path = os.path.split(os.path.realpath(__file__))[0]
-mount_prog = os.path.join(utils_path, 'mount_image')
-umount_prog = os.path.join(utils_path, 'umount_image')
 
 def remove_bad_image(image_name):
     if os.path.isfile(image_name):
@@ -48,6 +39,18 @@ def remove_bad_image(image_name):
         except:
             print('could not remove image lock file: ' + sys.exc_info()[1])
 
+    if os.path.isdir(get_holder_dir(image_name)):
+        try:
+            shutil.rmtree(get_holder_dir(image_name))
+        except:
+            print('could not remove image lock directory: ' + str(sys.exc_info()[1]))
+
+    if os.path.isfile(get_stack_name(image_name)):
+        try:
+            os.remove(get_stack_name(image_name))
+        except:
+            print('could not remove image stack file: ' + str(sys.exc_info()[1]))
+
 if __name__ == '__main__':
 
     # parse arguments
@@ -56,7 +59,8 @@ if __name__ == '__main__':
     parser.add_argument("src", help="Directory, contents of which to copy into the image.", nargs='?', default=None)
     parser.add_argument("-f", "--overwrite", help="Overwrite existing image file [default: False].", default=False, action="store_true")
     parser.add_argument("-s", "--size", help="Size of the disk image (in MB), if src is not given.", default=None)
-    parser.add_argument("--oversize", help="Image size = oversize * space in bytes required for the files in src [default: " + str(oversize) + "]", default=oversize)
+    parser.add_argument("--base", help="create the image as a layer on the image of this software module, e.g., python/3.8.2. Needs src.", default=None)
+    parser.add_argument("--oversize", help="Free space = (oversize - 1) * space in bytes required for the files in src [default: " + str(oversize) + "]", default=oversize)
     args = parser.parse_args()
     oversize = float(args.oversize)
 
@@ -68,103 +72,58 @@ if __name__ == '__main__':
         if os.path.isfile(image_name) and not args.overwrite:
             raise ModuleException(image_name + " exists, bailing out. Use --overwrite.")
 
-        # find the image size (in MB)
+        # find the image size (in MB) and the number of inodes
+        inodes = None
         if args.src is not None:
 
             args.src = os.path.abspath(args.src)
             print(" --- estimating module space requirements for source data at " + args.src)
-
-            size = get_dir_size(args.src)
-            if size < 20*MB:
-                size = int(math.ceil(float(oversize_small * size) / MB))
-            else:
-                size = int(math.ceil(float(oversize * size) / MB))
-            if size == 0:
+            if not len(os.listdir(args.src)):
                 raise ModuleException("src directory contains no data. Cannot create empty disk image, bailing out.")
+
+            # a layer holds the files that differ from the base module
+            if args.base is not None:
+                base_image = get_image_name(args.base)
+                if not os.path.isfile(get_manifest_name(base_image)):
+                    raise ModuleException(args.base + " has no image with a manifest, it cannot be used as a base")
+                lowers = get_image_stack(base_image) + [base_image]
+                stats = [os.stat(l) for l in lowers]
+                stagedir = tempfile.mkdtemp('', '.layer', os.path.dirname(image_name))
+                print(" --- staging the layer on " + base_image + " in " + stagedir)
+                try:
+                    (nentries, nwhiteouts, nbytes) = make_layer(args.src, stagedir, read_manifest(get_manifest_name(base_image)), compute_manifest(args.src))
+                except:
+                    shutil.rmtree(stagedir)
+                    raise ModuleException("cannot stage the layer: " + str(sys.exc_info()[1]))
+                print(" --- layer: " + str(nentries) + " entries, " + str(nwhiteouts) + " whiteouts, " + str(nbytes) + " bytes of files")
+                args.src = stagedir
+
+            size, inodes = get_image_size(args.src, oversize=oversize)
+            print(" --- creating disk image of size: " + str(size) + "MB, " + str(inodes) + " inodes")
+        elif args.base is not None:
+            raise ModuleException("--base needs source data")
         elif args.size is not None:
-            size = args.size
+            size = int(args.size)
         else:
             raise ModuleException("Unknown image size. You must specify either --size, or source data to copy into the image.")
-        size = int(size)
 
-        # create file system image and the corresponding lock file
+        # create file system image, populated with the source data if requested, and the corresponding lock file
         try:
-            filefs(size, image_name)
+            filefs(size, image_name, args.src, inodes)
             with fs_lock_file(image_name + '.lock', True) as fd:
                 # lock the image file to trigger creation of the lock file. Otherwise, the lock file will be created in
                 # (u)mount_image with root ownership
                 pass
+            if args.base is not None:
+                write_stack(image_name, lowers, stats)
+            elif os.path.isfile(get_stack_name(image_name)):
+                os.remove(get_stack_name(image_name))
         except:
             remove_bad_image(image_name)
             raise ModuleException("while creating image: " + str(sys.exc_info()[1]))
-
-        # copy source data, if requested
-        if args.src is not None:
-
-            # mount the image in a temporary directory
-            try:
-
-                # mount point will be created in mount_image, if it does not exist
-                mntpoint = get_mount_path()
-                if os.path.isdir(mntpoint):
-                    tempdir = tempfile.mkdtemp(dir=mntpoint)
-                else:
-                    tempdir = os.path.join(mntpoint, 'temp')
-
-                # mount must be done with root privileges
-                cmd = ['sudo', mount_prog, '--rw', image_name, tempdir]
-                p1 = subprocess.Popen(cmd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-                p1.wait()
-                if p1.returncode:
-                    msg = p1.stdout.read().replace('\n', '')
-                    raise ModuleException(msg)
-            except:
-                remove_bad_image(image_name)
-                raise ModuleException("while mounting image: " + str(sys.exc_info()[1]))
-
-            # assume we failed to produce a valid image, bad images are removed at the end
-            image_ok = False
-
-            # rsync - copy tree
-            try:
-                print(" --- copy source files into the image using rsync")
-                cmd = ["rsync", "-av", args.src + "/", tempdir]
-                p1 = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-                for line in iter(p1.stdout.readline, b''):
-                    sys.stdout.write(line.decode())
-
-                p1.wait()
-                if not p1.returncode:
-                    print(" --- rsync completed with SUCCESS")
-                    image_ok = True
-                else:
-                    raise ModuleException("rsync returned with " + str(p1.returncode))
-
-            except:
-                print(" --- failed to rsync, trying to clean up...")
-
-            #  unmount the image, remove temporary directory
-            try:
-
-                # umount must be done with root privileges
-                print(' --- unmounting image at ' + tempdir)
-                cmd = ['sudo', umount_prog, image_name, tempdir]
-                p1 = subprocess.Popen(cmd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-                p1.wait()
-                if p1.returncode:
-                    msg = p1.stdout.read().replace('\n', '')
-                    raise ModuleException(msg)
-
-                print(' --- removing temporary directory ' + tempdir)
-                os.rmdir(tempdir)
-            except ModuleException:
-                print(str(sys.exc_info()[1]))
-                print(" --- WARNING: image not unmounted and/or removed. Manual cleanup needed.")
-
-            if not image_ok:
-                remove_bad_image(image_name)
-                raise ModuleException("deployment failed.")
+        finally:
+            if args.base is not None:
+                shutil.rmtree(args.src)
 
         print('')
         print('The image has been created. You can mount with')
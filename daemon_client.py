@@ -0,0 +1,67 @@
+#!/usr/bin/env python2
+
+# Client side of the image daemon protocol, see image_daemon.py.
+
+import os
+import json
+import socket
+import sys
+import hpcmodules
+from hpcmodules import get_login_username, is_module_name, metrics_phase
+
+# seconds to wait for the daemon to handle a request
+daemon_timeout = 300
+
+
+# Send a request to the image daemon and print the messages it returns.
+# Returns True / False for a successful / failed request, or None if the daemon is not available - the caller then
+# does the work itself. Set SI_NO_DAEMON to always work without the daemon.
+def daemon_request(req):
+    if 'SI_NO_DAEMON' in os.environ or not os.path.exists(hpcmodules.daemon_socket):
+        return None
+
+    req = dict(req)
+    req['user'] = get_login_username()
+    with metrics_phase('daemon'):
+        return send_request(req)
+
+
+# internal - send a request to the daemon socket, see daemon_request
+def send_request(req):
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(daemon_timeout)
+        sock.connect(hpcmodules.daemon_socket)
+        sock.sendall(json.dumps(req) + "\n")
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+        sock.close()
+    except socket.error:
+        return None
+
+    # the reply ends with a status line: "== ok", or "== failed"
+    lines = "".join(chunks).split("\n")
+    if len(lines) < 2 or not lines[-2].startswith("== "):
+        # the daemon went away
+        return None
+
+    if len(lines) > 2:
+        sys.stdout.write("\n".join(lines[:-2]) + "\n")
+    return lines[-2] == "== ok"
+
+
+# The daemon does not know the working directory of the client: make user image names and mount points absolute.
+def absolute_requests(requests):
+    result = []
+    for (name, mntpoint) in requests:
+        if not is_module_name(name):
+            name = os.path.abspath(name)
+        if mntpoint is not None:
+            mntpoint = os.path.abspath(mntpoint)
+        result.append((name, mntpoint))
+    return result
@@ -1,32 +1,130 @@
 #!/usr/bin/env python2.6
 
+import os
+import sys
 import argparse
 import subprocess
 from hpcmodules import ModuleException
+from get_dir_size import block_size, inode_size, scan_tree, get_ext4_size
 
+# MB
+MB = 1024*1024
 
-def filefs(size, name):
+
+# Create an ext4 file system of size MB in a file. If src is given, the file system is populated with the contents of
+# the src directory by mke2fs (-d): no mount, no root privileges and no copy of the files are needed.
+# If inodes is given, the file system has exactly that many inodes and the layout assumed by get_ext4_size: 4 KiB
+# blocks, 256 byte inodes, reserved percent of reserved blocks, no resize inode, and a journal only if journal is set.
+# Otherwise mke2fs chooses the layout for small file systems.
+def filefs(size, name, src=None, inodes=None, reserved=5, journal=True):
     print(" --- creating a " + str(size) + "MB sparse file filled with zeros")
     with open(name, 'wb+') as f:
         f.truncate(size*1024*1024)
 
     print(" --- creating an ext4 file system in file " + name)
-    cmd = ["/sbin/mkfs", "-t", "ext4", "-T", "small", name]
+    cmd = ["/sbin/mkfs", "-t", "ext4"]
+    if inodes is None:
+        cmd += ["-T", "small"]
+    else:
+        features = "^resize_inode"
+        if not journal:
+            features += ",^has_journal"
+        cmd += ["-b", str(block_size), "-I", str(inode_size), "-N", str(inodes), "-m", str(reserved), "-O", features]
+    if src is not None:
+        print(" --- populating the file system with the contents of " + src)
+        st = os.stat(src)
+        cmd += ["-d", src, "-E", "root_owner=%d:%d" % (st.st_uid, st.st_gid)]
+    cmd.append(name)
     p = subprocess.Popen(cmd, stdin=subprocess.PIPE)
     p.communicate(b"y\n")
     p.wait()
     if p.returncode:
         raise ModuleException("mkfs failed")
 
+
+# Size in MB and number of inodes of an image for the contents of the src directory (see get_ext4_size). Free space
+# of extra_size MB plus (oversize - 1) times the size of the files is added, with one inode per 16 KiB, as mke2fs.
+def get_image_size(src, reserved=5, journal=True, extra_size=0, oversize=1.0):
+    usage = scan_tree(src)
+    if usage.errors:
+        raise ModuleException("cannot scan " + src)
+    print(" --- " + src + ": " + str(usage.bytes) + " bytes in " + str(usage.inodes) + " files and directories, " + str(usage.hardlinks) + " hard links")
+
+    free = extra_size * MB + int((oversize - 1) * usage.bytes)
+    usage.data_blocks += (free + block_size - 1) // block_size
+    size, inodes = get_ext4_size(usage, reserved, journal, free // 16384)
+    return (size + MB - 1) // MB, inodes
+
+
+# internal - run a file system tool on an image file
+def run_fs_command(cmd):
+    p = subprocess.Popen(cmd)
+    p.wait()
+    if p.returncode:
+        raise ModuleException(cmd[0] + " returned with " + str(p.returncode))
+
+
+# Superblock fields of the file system in an image file (dumpe2fs -h), e.g., 'Block count', as strings
+def get_fs_info(name):
+    p = subprocess.Popen(["/sbin/dumpe2fs", "-h", name], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    if p.returncode:
+        raise ModuleException("dumpe2fs failed: " + stderr.decode().strip())
+    info = {}
+    for line in stdout.decode().splitlines():
+        if ':' in line:
+            key, value = line.split(':', 1)
+            info[key] = value.strip()
+    return info
+
+
+# Shrink the file system in an image file to its minimum size, and truncate the file
+def shrink_fs(name):
+    print(" --- shrinking the file system in " + name)
+    run_fs_command(["/sbin/e2fsck", "-f", "-p", name])
+    run_fs_command(["/sbin/resize2fs", "-M", name])
+    print(" --- image size: " + str(os.path.getsize(name) // MB) + "MB")
+
+
+# Grow the file system in an image file to at least size MB and inodes inodes. The number of inodes per group is
+# fixed: more inodes need more block groups.
+def grow_fs(name, size, inodes):
+    info = get_fs_info(name)
+    bs = int(info['Block size'])
+    bpg = int(info['Blocks per group'])
+    ipg = int(info['Inodes per group'])
+
+    blocks = size * MB // bs
+    if inodes > int(info['Inode count']):
+        blocks = max(blocks, (inodes + ipg - 1) // ipg * bpg)
+    if blocks <= int(info['Block count']):
+        return
+
+    print(" --- growing the file system in " + name + " to " + str(blocks * bs // MB) + "MB")
+    run_fs_command(["/sbin/e2fsck", "-f", "-p", name])
+    run_fs_command(["/sbin/resize2fs", name, str(blocks)])
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Create a file system in a file.")
     parser.add_argument("size", help="Size of the file system [MB].")
     parser.add_argument("file_name", help="Name of the file in which fs will be created.")
+    parser.add_argument("--src", help="Directory, contents of which to copy into the file system.", default=None)
+    parser.add_argument("--exact", help="Size the file system exactly for the contents of --src, size is the free space to add [MB].", default=False, action="store_true")
+    parser.add_argument("--shrink", help="Shrink the file system to its minimum size after populating it.", default=False, action="store_true")
     args = parser.parse_args()
 
     try:
-        filefs(int(args.size), args.file_name)
+        if args.exact:
+            if args.src is None:
+                raise ModuleException("--exact needs --src")
+            size, inodes = get_image_size(args.src, extra_size=int(args.size))
+            filefs(size, args.file_name, args.src, inodes)
+        else:
+            filefs(int(args.size), args.file_name, args.src)
+        if args.shrink:
+            shrink_fs(args.file_name)
     except ModuleException:
         print(str(sys.exc_info()[1]))
         exit(1)
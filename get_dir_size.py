@@ -1,22 +1,383 @@
 import os
+import stat
+import time
+import threading
+import sqlite3
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# directory listing with file types: os.scandir, or the scandir module on python 2
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# ext4 layout of exactly sized images (see filefs)
+block_size = 4096
+inode_size = 256
+
+# extra space on top of the computed ext4 size, for what the layout model does not cover (e.g., extended attributes)
+size_slack = 0.02
+
+# number of threads that scan directories: on a parallel file system the metadata requests of one thread are mostly
+# waiting for the servers
+scan_workers = 8
+
+# Per-directory scan cache (SQLite database), disabled if empty. A directory is only scanned again if its mtime has
+# changed, i.e., if entries were created, removed or renamed in it. A file that is rewritten in place does not change
+# the mtime of its directory: scan without the cache after such changes.
+scan_cache = ""
+
+
+# Usage of a directory tree, collected in a single pass by scan_tree. Hard linked files are counted once.
+class TreeUsage(object):
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.bytes = 0           # size of the regular files
+        self.data_blocks = 0     # data and extent tree blocks of the regular files
+        self.dir_blocks = 0      # directory blocks
+        self.symlink_blocks = 0  # blocks of symbolic links that do not fit into the inode
+        self.inodes = 0          # files, directories, symbolic links and other files, not counting the top directory
+        self.hardlinks = 0       # additional names of hard linked files
+        self.errors = 0
+        self.dirs = 0            # directories, and how many of them were taken from the scan cache
+        self.cached_dirs = 0
+        self.elapsed = 0.0
+
+
+# The entries of one directory, without the contents of its subdirectories. Regular files with more than one link
+# are kept apart (linked: (inode, blocks, bytes) tuples), they are counted once per tree.
+class DirRecord(object):
+
+    def __init__(self, dev, ino, mtime, bs):
+        self.dev = dev
+        self.ino = ino
+        self.mtime = mtime
+        self.bs = bs
+        self.bytes = 0
+        self.data_blocks = 0
+        self.dir_blocks = 0
+        self.symlink_blocks = 0
+        self.inodes = 0
+        self.linked = []
+        self.subdirs = []
+        self.cached = False
+
+    def matches(self, st, bs):
+        return (self.dev, self.ino, self.mtime, self.bs) == (st.st_dev, st.st_ino, st.st_mtime, bs)
+
+
+# internal - ext4 blocks of a regular file: data, and extent tree blocks if the file needs more than the 4 extents
+# that fit into the inode (one extent covers at most 32768 blocks)
+def file_blocks(size, bs):
+    blocks = (size + bs - 1) // bs
+    extents = (blocks + 32767) // 32768
+    if extents > 4:
+        blocks += (extents + (bs - 12) // 12 - 1) // ((bs - 12) // 12)
+    return blocks
+
+
+# internal - ext4 blocks of a directory with entries of dirent_bytes. Entries do not span blocks, and every block has
+# a checksum tail. Directories of more than one block get an index root block.
+def dir_blocks(dirent_bytes, bs):
+    usable = bs - 12 - 264
+    blocks = max(1, (dirent_bytes + usable - 1) // usable)
+    if blocks > 1:
+        blocks += 1
+    return blocks
+
+
+# internal - (name, path, lstat) of the entries of a directory. With scandir the directory is read once and the
+# entries are stat'ed; os.path.exists is not needed, entries that vanish in between raise OSError.
+def list_dir(dname):
+    if scandir is not None:
+        return [(e.name, e.path, e.stat(follow_symlinks=False)) for e in scandir(dname)]
+    entries = []
+    for name in os.listdir(dname):
+        path = os.path.join(dname, name)
+        entries.append((name, path, os.lstat(path)))
+    return entries
+
+
+# internal - scan the entries of a directory with lstat st. Returns its DirRecord and the (path, lstat) of its
+# subdirectories.
+def scan_dir(dname, st, bs):
+
+    rec = DirRecord(st.st_dev, st.st_ino, st.st_mtime, bs)
+    subdirs = []
+
+    # . and ..
+    dirent_bytes = 24
+    for (name, path, est) in list_dir(dname):
+        dirent_bytes += (8 + len(name) + 3) & ~3
+
+        if stat.S_ISDIR(est.st_mode):
+            rec.inodes += 1
+            rec.subdirs.append(name)
+            subdirs.append((path, est))
+        elif stat.S_ISREG(est.st_mode):
+            if est.st_nlink > 1:
+                rec.linked.append((est.st_ino, file_blocks(est.st_size, bs), est.st_size))
+            else:
+                rec.inodes += 1
+                rec.bytes += est.st_size
+                rec.data_blocks += file_blocks(est.st_size, bs)
+        else:
+            rec.inodes += 1
+            if stat.S_ISLNK(est.st_mode) and est.st_size >= 60:
+                rec.symlink_blocks += 1
+
+    rec.dir_blocks = dir_blocks(dirent_bytes, bs)
+    return rec, subdirs
+
+
+# internal - the scan cache database
+def open_scan_cache(path):
+    conn = sqlite3.connect(path, timeout=10)
+    conn.text_factory = str
+    conn.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, mtime REAL, bs INTEGER, "
+                 "bytes INTEGER, data_blocks INTEGER, dir_blocks INTEGER, symlink_blocks INTEGER, inodes INTEGER, "
+                 "linked TEXT, subdirs TEXT)")
+    return conn
+
+
+# internal - the cached DirRecords of a tree, by path
+def load_scan_cache(path, top):
+    records = {}
+    conn = open_scan_cache(path)
+    try:
+        rows = conn.execute("SELECT * FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?", (top, len(top) + 1, top + "/"))
+        for row in rows:
+            rec = DirRecord(row[1], row[2], row[3], row[4])
+            (rec.bytes, rec.data_blocks, rec.dir_blocks, rec.symlink_blocks, rec.inodes) = row[5:10]
+            rec.linked = [tuple(int(f) for f in l.split(":")) for l in row[10].split(",") if len(l)]
+            # names do not contain /
+            rec.subdirs = [n for n in row[11].split("/") if len(n)]
+            rec.cached = True
+            records[row[0]] = rec
+    finally:
+        conn.close()
+    return records
+
+
+# internal - replace the cached records of a tree. Directories modified less than 2 seconds before the scan are not
+# stored: a change in the same second would not change their mtime.
+def save_scan_cache(path, top, records, start):
+    conn = open_scan_cache(path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?", (top, len(top) + 1, top + "/"))
+            conn.executemany("INSERT INTO dirs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             [(p, r.dev, r.ino, r.mtime, r.bs, r.bytes, r.data_blocks, r.dir_blocks, r.symlink_blocks, r.inodes,
+                               ",".join("%d:%d:%d" % l for l in r.linked), "/".join(r.subdirs))
+                              for (p, r) in records.items() if r.mtime < start - 2])
+    finally:
+        conn.close()
+
+
+# Walk a directory tree once, and return its TreeUsage for ext4 blocks of block size bs. Directories are scanned by
+# workers threads. With a cache (a database file, see scan_cache), unchanged directories are not scanned again.
+def scan_tree(start_path, bs=block_size, workers=None, cache=None):
+
+    if workers is None:
+        workers = scan_workers
+    if cache is None:
+        cache = scan_cache
+    start = time.time()
+    top = os.path.abspath(start_path)
+
+    cached = {}
+    if len(cache):
+        try:
+            cached = load_scan_cache(cache, top)
+        except sqlite3.Error as err:
+            print(" --- ERROR reading scan cache " + cache + ": " + str(err))
+
+    records = {}
+    errors = []
+    lock = threading.Lock()
+    todo = queue.Queue()
+
+    # a cached directory is taken if its mtime is unchanged and all its subdirectories are still there
+    def visit(path, st):
+        rec = cached.get(path)
+        subdirs = None
+        if rec is not None and rec.matches(st, bs):
+            try:
+                subdirs = [(os.path.join(path, n), os.lstat(os.path.join(path, n))) for n in rec.subdirs]
+            except OSError:
+                subdirs = None
+        if subdirs is None:
+            rec, subdirs = scan_dir(path, st, bs)
+        with lock:
+            records[path] = rec
+        for s in subdirs:
+            todo.put(s)
+
+    def worker():
+        while True:
+            item = todo.get()
+            try:
+                if item is None:
+                    return
+                visit(*item)
+            except OSError as err:
+                print(" --- ERROR: scan_tree: cannot scan " + item[0] + ": " + str(err))
+                with lock:
+                    errors.append(item[0])
+            finally:
+                todo.task_done()
+
+    todo.put((top, os.lstat(top)))
+    threads = [threading.Thread(target=worker) for t in range(max(1, workers))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    todo.join()
+    for t in threads:
+        todo.put(None)
+    for t in threads:
+        t.join()
+
+    # totals, hard linked files are counted once
+    usage = TreeUsage(bs)
+    usage.errors = len(errors)
+    seen = set()
+    for rec in records.values():
+        usage.bytes += rec.bytes
+        usage.data_blocks += rec.data_blocks
+        usage.dir_blocks += rec.dir_blocks
+        usage.symlink_blocks += rec.symlink_blocks
+        usage.inodes += rec.inodes
+        for (ino, blocks, size) in rec.linked:
+            if (rec.dev, ino) in seen:
+                usage.hardlinks += 1
+                continue
+            seen.add((rec.dev, ino))
+            usage.inodes += 1
+            usage.data_blocks += blocks
+            usage.bytes += size
+        usage.dirs += 1
+        if rec.cached:
+            usage.cached_dirs += 1
+    usage.elapsed = time.time() - start
+
+    if len(cache):
+        try:
+            save_scan_cache(cache, top, records, start)
+        except sqlite3.Error as err:
+            print(" --- ERROR writing scan cache " + cache + ": " + str(err))
+
+    files = usage.inodes + usage.hardlinks
+    print(" --- scanned %d files in %d directories (%d cached) in %.2f s: %d files/s" %
+          (files, usage.dirs, usage.cached_dirs, usage.elapsed, files / max(usage.elapsed, 1e-6)))
+    return usage
+
+
+# internal - default journal size of mke2fs, in blocks, for a file system of the given number of blocks
+def journal_blocks(blocks):
+    if blocks < 2048:
+        return 0
+    for (limit, jblocks) in [(32768, 1024), (256*1024, 4096), (512*1024, 8192), (4096*1024, 16384),
+                             (8192*1024, 32768), (16384*1024, 65536), (32768*1024, 131072)]:
+        if blocks < limit:
+            return jblocks
+    return 262144
+
+
+# internal - number of block groups below groups that hold a backup of the superblock and the group descriptors
+def backup_groups(groups):
+    n = 1
+    for base in [3, 5, 7]:
+        g = base
+        while g < groups:
+            n += 1
+            g *= base
+    return min(n, groups)
+
+
+# Compute the size of an ext4 file system (4 KiB blocks, 256 byte inodes, no resize inode) that holds the tree
+# described by usage, with extra_inodes free inodes, reserved percent of reserved blocks and optionally a journal.
+# Returns the size in bytes and the number of inodes, to be given to filefs.
+def get_ext4_size(usage, reserved=0, journal=True, extra_inodes=0):
+
+    bs = usage.block_size
+    bpg = 8 * bs
+    ipb = bs // inode_size
+
+    # inodes 1-10 are reserved, 11 is lost+found, the top directory is the root inode (2)
+    inodes = 11 + usage.inodes + extra_inodes
+
+    # lost+found is created with 16 KiB
+    used = usage.data_blocks + usage.dir_blocks + usage.symlink_blocks + max(2, 16384 // bs)
+
+    blocks = used
+    while True:
+        groups = max((blocks + bpg - 1) // bpg, (inodes + bpg - 1) // bpg)
+        ipg = (inodes + groups - 1) // groups
+        ipg = (ipg + ipb - 1) // ipb * ipb
+
+        # per group: block and inode bitmap, inode table. Superblock and group descriptors in the backup groups.
+        gdt = (groups * 64 + bs - 1) // bs
+        meta = groups * (2 + ipg // ipb) + backup_groups(groups) * (1 + gdt)
+        if journal:
+            meta += journal_blocks(blocks)
+
+        need = int((used + meta) / (1 - reserved / 100.0)) + 1
+        if need <= blocks:
+            break
+        blocks = need
+
+    blocks = int(blocks * (1 + size_slack))
+
+    # mke2fs drops a last group that has less than 50 blocks besides its metadata, or fails if it is the only one
+    group_meta = 3 + ipg // ipb + gdt
+    rem = blocks % bpg
+    if rem and rem < group_meta + 50:
+        blocks += group_meta + 50 - rem
+
+    return blocks * bs, groups * ipg
+
 
 # compute disk size needed to store files in a directory tree
 def get_dir_size(start_path):
 
-    total_size = 0
-    repo_size = 0
-    blsize = 1024
-
-    for dirpath, dirnames, filenames in os.walk(start_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            if os.path.exists(fp):
-                sz = os.lstat(fp).st_size
-                repo_size += sz
-                total_size += ((sz//blsize)+1)*blsize
-            else:
-                print(" --- ERROR: get_dir_size: cannot stat " + fp)
+    usage = scan_tree(start_path, 1024)
+    total_size = (usage.data_blocks + usage.dir_blocks + usage.symlink_blocks) * 1024
 
-    print(' --- reported file space: ' + str(repo_size) + ' bytes')
+    print(' --- reported file space: ' + str(usage.bytes) + ' bytes')
     print(' --- disk space: ' + str(total_size) + ' bytes')
     return total_size
+
+
+try:
+    scan_workers = int(os.environ['SI_SCAN_WORKERS'])
+except (KeyError, ValueError):
+    # not defined - use default
+    pass
+scan_cache = os.environ.get('SI_SCAN_CACHE', scan_cache)
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Compute the size of an ext4 image for the contents of a directory.")
+    parser.add_argument("src", help="directory")
+    parser.add_argument("--reserved", help="reserved blocks [percent, default: %(default)s]", type=int, default=0)
+    parser.add_argument("--journal", help="the file system has a journal [default: False]", default=False, action="store_true")
+    parser.add_argument("--workers", help="number of scanning threads [default: %(default)s, SI_SCAN_WORKERS]", type=int, default=scan_workers)
+    parser.add_argument("--cache", help="scan cache database, empty for none [default: %(default)s, SI_SCAN_CACHE]", default=scan_cache)
+    args = parser.parse_args()
+
+    usage = scan_tree(args.src, workers=args.workers, cache=args.cache)
+    size, inodes = get_ext4_size(usage, args.reserved, args.journal)
+    print(" --- files: " + str(usage.bytes) + " bytes, " + str(usage.inodes) + " inodes, " + str(usage.hardlinks) + " hard links")
+    print(" --- blocks: " + str(usage.data_blocks) + " data, " + str(usage.dir_blocks) + " directory, " + str(usage.symlink_blocks) + " symlink")
+    print(" --- ext4 image: " + str(size) + " bytes, " + str(inodes) + " inodes")
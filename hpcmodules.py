@@ -7,17 +7,34 @@ import glob
 import stat
 import getpass
 import pwd
-import signal
+import time
+import random
+import socket
+import threading
 import fcntl
+import zlib
+import tempfile
+import json
+import atexit
+import syslog
+import contextlib
 from os.path import isfile, join
 import subprocess
 from subprocess import PIPE
+import mounttable
+from mounttable import get_mount_table
+import sqlite3
+import usage_index
+from loopdev import get_loop_status, attach_loopdev, detach_loopdev, list_attached_loopdevs, has_direct_io, has_autoclear
 
 # paths: MUST BE without final separator
 
 # software modules settings
 # mount point and image location
 image_ext = ".ext4"
+
+# image file extensions of all image formats (see image_formats.py), in the order in which they are looked up
+image_exts = [".ext4", ".squashfs", ".erofs"]
 image_path = os.path.realpath("/cluster/software/IMAGES")
 mount_path = os.path.realpath("/cluster/software/")
 
@@ -27,6 +44,54 @@ mount_path_usr = os.path.realpath('/var/run/user_images')
 # local information about images mounted on a compute node (local fs, NOT network fs)
 local_lock_path = os.path.realpath("/var/lock/software_images")
 
+# Node-local image cache (see image_cache.py): a directory on a local disk or tmpfs. Empty disables the cache.
+# The copies take at most image_cache_mb MB. With image_cache_fill 1, images are copied into the cache when they are
+# mounted, with 0 only by a prefetch.
+image_cache_path = ""
+image_cache_mb = 10240
+image_cache_fill = 1
+
+# Staging of images on the nodes of a job (see stage_images.py): number of images staged concurrently on a node,
+# maximum read rate on a node [MB/s, 0: no limit], and the command that runs a command on a list of nodes
+stage_workers = 4
+stage_rate_mb = 0
+stage_pdsh = "pdsh"
+
+# Replay the hot block lists of images after mounts (see image_profile.py)
+hot_replay = 1
+
+# lock acquisition per file system type of the lock file, '*' matches all other types
+#  poll  - non-blocking flock retried with exponential backoff and jitter
+#  block - blocking flock with a timeout, only for file systems on which a blocking flock can be interrupted
+lock_strategy = "ext4=block,ext3=block,xfs=block,tmpfs=block,nfs=block,nfs4=block,*=poll"
+
+# backoff of the poll lock strategy: first and maximum delay between lock attempts [s]
+lock_poll_min = 0.001
+lock_poll_max = 0.2
+
+# Attach images to loop devices with direct I/O (1), or buffered (0), see attach_loopdev
+loop_direct_io = 1
+
+# Loop device pool: maximum number of loop devices kept attached to software images after unmount. 0 disables the pool.
+loop_pool_size = 0
+
+# Idle images: software images that no job uses any more stay mounted for idle_grace seconds, so that the next jobs
+# find them mounted and cached. 0 unmounts them when the last job is done. At most idle_max_images images, and
+# idle_max_mb MB of image files (the most they can hold in the page cache, 0: no limit), are kept idle: beyond that,
+# the longest idle images are unmounted first.
+idle_grace = 0
+idle_max_images = 8
+idle_max_mb = 0
+
+# Metrics: every run of a tool, and every request of the image daemon, emits one JSON record with the durations of
+# its phases, lock waits and retries, and the number of subprocesses: to syslog (metrics_syslog 1), and appended to
+# metrics_file (empty: none). See start_metrics, and metrics_report.py for percentiles.
+metrics_syslog = 1
+metrics_file = ""
+
+# Unix socket of the optional image daemon (image_daemon.py). If it does not exist, tools work directly.
+daemon_socket = "/var/run/software_images.sock"
+
 # SLURM job identifier for displaying log messages
 gl_job_id = "NOJOBID"
 
@@ -46,9 +111,21 @@ class ModuleException(Exception):
         return str(self.value)
 
 
+# Per-thread information about the caller, set by the image daemon for every request:
+#   username - login user of the client, authenticated with SO_PEERCRED
+#   output   - list that collects the messages printed while handling the request
+#   profile  - seconds to record the hot blocks of the mounted images, see image_profile.py
+#   metrics  - the metrics record of the tool or request, see start_metrics
+# Threads started by run_parallel inherit it.
+caller = threading.local()
+
+
 # tricky - on some systems getpass.getuser() does not return the login username
-# when using sudo - LOGNAME is set to root. We check SUDO_USER first
+# when using sudo - LOGNAME is set to root. We check the image daemon caller, and SUDO_USER first
 def get_login_username():
+    su = getattr(caller, 'username', None)
+    if su is not None:
+        return su
     su = os.environ.get('SUDO_USER')
     if su is None:
         su = getpass.getuser()
@@ -57,73 +134,202 @@ def get_login_username():
     return su
 
 
-def fs_lock_file(fname, rw, timeout=5):
+# return the lock strategy for a lock file, based on the type of the file system the file is located on
+def get_lock_strategy(fname):
+    strategies = dict(s.strip().split('=', 1) for s in lock_strategy.split(',') if '=' in s)
+    mount = get_mount_table().find_path(os.path.dirname(os.path.realpath(fname)))
+    if mount is not None and mount.fstype in strategies:
+        return strategies[mount.fstype]
+    return strategies.get('*', 'poll')
 
-    mask = os.umask(stat.S_IXUSR | stat.S_IRWXG | stat.S_IRWXO)
 
+# call a non-blocking flock until locked, or until the deadline, with exponential backoff and jitter
+def flock_poll(fdo, operation, deadline, stats):
+    delay = lock_poll_min
+    while True:
+        stats['attempts'] += 1
+        try:
+            fcntl.flock(fdo, operation | fcntl.LOCK_NB)
+            return True
+        except IOError, err:
+            if err.errno != errno.EWOULDBLOCK:
+                raise
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+        delay = min(2 * delay, lock_poll_max)
+
+
+# Call a blocking flock until locked, or until the deadline. The blocking call is made in a helper thread on a duplicate
+# of the file descriptor, so no signals are needed. If the deadline passes first, the helper releases the lock as soon
+# as it gets it. Only for file systems on which a blocking flock can be interrupted: the helper thread must not hang.
+def flock_block(fdo, operation, deadline, stats):
+    stats['attempts'] += 1
+    fd = os.dup(fdo.fileno())
+    cond = threading.Condition()
+    state = {'locked': False, 'abandoned': False, 'error': None}
+
+    def helper():
+        try:
+            fcntl.flock(fd, operation)
+            with cond:
+                if state['abandoned']:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                else:
+                    state['locked'] = True
+                cond.notify()
+        except:
+            with cond:
+                state['error'] = sys.exc_info()[1]
+                cond.notify()
+        finally:
+            os.close(fd)
+
+    t = threading.Thread(target=helper)
+    t.daemon = True
+    t.start()
+
+    with cond:
+        while not state['locked'] and state['error'] is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                state['abandoned'] = True
+                return False
+            cond.wait(remaining)
+        if state['error'] is not None:
+            raise state['error']
+
+    return True
+
+
+# Lock a file on a (possibly network) file system with a timeout.
+# Image lock files: an rw lock requires that no other host holds the image, see get_holder_dir.
+# A shared lock can be held by many clients at a time, it excludes exclusive locks.
+# If stats is a dict, it is updated with the lock strategy used, the number of lock attempts and the wait time [s].
+def fs_lock_file(fname, rw, timeout=5, stats=None, shared=False):
+
+    # Open lock file, create it if doesn't exist. The mode is given to open instead of setting the process-wide umask,
+    # so that locks can be taken from threads.
+    # Locking is based on the assumption that the lock file is never removed once created, and all write operations
+    # to the lock file are done on the same physical file
+    fd = os.open(fname, os.O_RDWR | os.O_CREAT, stat.S_IRUSR | stat.S_IWUSR)
+
+    # We know the file is there now, update file permissions just in case.
+    # The lock file MUST have 0600 permissions. Only the lock owner may be allowed to lock the file.
+    os.chmod(fname, stat.S_IRUSR | stat.S_IWUSR)
+
+    # open lock file
+    fdo = os.fdopen(fd, 'r+')
+
+    # Obtain a lock with timeout. On beegfs this must be implemented using polling - a blocking flock can not be
+    # interrupted. The strategy is selected by the file system type of the lock file, see lock_strategy.
+    if stats is None:
+        stats = {}
+    stats['strategy'] = get_lock_strategy(fname)
+    stats['attempts'] = 0
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    start = time.time()
     try:
+        if stats['strategy'] == 'block':
+            locked = flock_block(fdo, operation, start + timeout, stats)
+        else:
+            locked = flock_poll(fdo, operation, start + timeout, stats)
+    except:
+        fdo.close()
+        raise
+    finally:
+        stats['wait'] = time.time() - start
+        add_lock_metrics(fname, stats)
+
+    if not locked:
+        fdo.close()
+        raise ModuleException(" Timeout when locking file " + fname)
 
-        # Open lock file, create it if doesn't exist.
-        # Locking is based on the assumption that the lock file is never removed once created, and all write operations
-        # to the lock file are done on the same physical file
-        fd = os.open(fname, os.O_RDWR | os.O_CREAT)
+    # We have the lock. If requesting an rw lock, check the file size. The file MUST be empty to grant an rw lock,
+    # and there must be no RO holders in <lock file>.d
+    if rw:
+        fdo.seek(0, os.SEEK_END)
+        if fdo.tell() != 0 or len(list_holder_dir(fname + ".d")):
+            fdo.close()
+            raise ModuleException(fname + " cannot be RW-locked in exclusive mode: other clients hold the lock.")
+
+    return fdo
 
-        # We know the file is there now, update file permissions just in case.
-        # The lock file MUST have 0600 permissions. Only the lock owner may be allowed to lock the file.
-        os.chmod(fname, stat.S_IRUSR | stat.S_IWUSR)
 
-        # open lock file
-        fdo = os.fdopen(fd, 'r+')
+# Holder registry: every host that mounts an image has one record in <image>.lock.d, a file named after the host
+# that contains the mount mode (ro / rw) and the time of the mount. Records are added and removed in O(1), the
+# registry is never rewritten as a whole. RO records are created and removed under a shared lock on <image>.lock,
+# so RO mounts of one image on many hosts do not serialize.
+# A host that mounts an image in RW mode also stores " rw "+hostname in <image>.lock, see fs_lock_file: RO mounters
+# (also those running older versions) only need to read the first line of the lock file to detect an RW mount.
+# Older versions stored the host names of RO mounts as lines in <image>.lock, compact_image_locks moves them into
+# holder records.
+def get_holder_dir(imagename):
+    return imagename + ".lock.d"
 
-        # obtain a lock with timeout. On beegfs this must be implemented using polling - SIGALRM does not interrupt the
-        # flock call. We use SIGALRM only to measure time here.
 
-        global retry
-        retry = True
-        locked = False
-        def timeout_handler(signum, frame):
-            global retry
-            retry = False
+# list of hosts in a holder directory. Temporary files start with a dot.
+def list_holder_dir(dname):
+    try:
+        return [h for h in os.listdir(dname) if not h.startswith('.')]
+    except OSError:
+        err = sys.exc_info()[1]
+        if err.errno == errno.ENOENT:
+            return []
+        raise
 
-        original_handler = signal.signal(signal.SIGALRM, timeout_handler)
-        signal.alarm(timeout)
 
-        # call a non-blocking, exclusive flock until locked, or until timed out
-        while retry:
-            try:
-                fcntl.flock(fdo, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                locked = True
-                retry = False
-
-            except IOError, err:
-                if err.errno != errno.EWOULDBLOCK:
-                    raise
-
-            finally:
-                if not retry:
-                    # restore original signal handler
-                    signal.alarm(0)
-                    signal.signal(signal.SIGALRM, original_handler)
-
-        if not locked:
-            raise ModuleException(" Timeout when locking file " + fname)
-
-        # We have the lock. If requesting an rw lock, check the file size. The file MUST be empty to grant an rw lock.
-        if rw:
-            fdo.seek(0, os.SEEK_END)
-            if fdo.tell() != 0:
-                fdo.close()
-                raise ModuleException(fname + " cannot be RW-locked in exclusive mode: other clients hold the lock.")
+# register a host as a holder of an image mount
+def add_image_holder(imagename, hostname, mode='ro', timestamp=None):
+    dname = get_holder_dir(imagename)
+    try:
+        os.mkdir(dname, stat.S_IRWXU)
+    except OSError:
+        # race - sb created it before us
+        err = sys.exc_info()[1]
+        if err.errno != errno.EEXIST:
+            raise
+
+    if timestamp is None:
+        timestamp = int(time.time())
 
+    # write-and-rename: a record is either complete, or not there
+    tmpname = os.path.join(dname, "." + hostname + ".tmp")
+    fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IRUSR | stat.S_IWUSR)
+    try:
+        os.write(fd, mode + " " + str(timestamp) + "\n")
     finally:
-        # restore umask
-        os.umask(mask)
+        os.close(fd)
+    os.rename(tmpname, os.path.join(dname, hostname))
+
+
+# unregister a host as a holder of an image mount
+def remove_image_holder(imagename, hostname):
+    try:
+        os.remove(os.path.join(get_holder_dir(imagename), hostname))
+    except OSError:
+        err = sys.exc_info()[1]
+        if err.errno != errno.ENOENT:
+            raise
 
-    return fdo
 
+# parse a line of an image lock file: " rw host", or "host" (RO mounts of older versions).
+# Returns (hostname, mode), hostname is None for empty lines.
+def parse_lock_file_line(line):
+    if line.startswith(" rw "):
+        return line[4:].strip(), 'rw'
+    line = line.strip()
+    if line.startswith("rw "):
+        return line[3:].strip(), 'rw'
+    if len(line) == 0:
+        return None, None
+    return line, 'ro'
 
-# lock local image information for update
-def local_lock_images():
+
+# lock local image information for update. A shared lock only excludes the holders of the exclusive lock.
+def local_lock_images(shared=False, timeout=5):
 
     # create directory if it does not exist
     try:
@@ -136,7 +342,7 @@ def local_lock_images():
             print("Cannot lock modules! Unexpected OSError:", sys.exc_info()[0])
             raise
 
-    return fs_lock_file(os.path.join(local_lock_path, "lockfile"), False)
+    return fs_lock_file(os.path.join(local_lock_path, "lockfile"), False, timeout, shared=shared)
 
 
 # internal - mount information per (SLURM) job is stored in this file
@@ -146,6 +352,38 @@ def get_job_filename(job_id):
     return join(local_lock_path, str(job_id) + ".modules")
 
 
+# internal - job key in the usage index: job file name without the .modules suffix
+def get_job_key(filename):
+    return os.path.basename(filename)[:-len(".modules")]
+
+
+# internal - the node-local image usage index
+def get_usage_index_filename():
+    return join(local_lock_path, usage_index.index_name)
+
+
+# Rebuild the image usage index from the job files. Must be called with the local image lock held.
+def rebuild_usage_index():
+    jobs = {}
+    for f in get_all_job_files():
+        jobs[get_job_key(f)] = read_job_file(f)
+    usage_index.rebuild(get_usage_index_filename(), jobs, get_mounted_stacks())
+    return jobs
+
+
+# Apply an update to the image usage index, after the job files have been updated.
+# A missing or broken index is rebuilt from the job files instead. Must be called with the local image lock held.
+def update_usage_index(update, *args):
+    filename = get_usage_index_filename()
+    if os.path.isfile(filename):
+        try:
+            update(filename, *args)
+            return
+        except sqlite3.Error:
+            print(" --- ERROR updating image usage index " + filename + ": " + str(sys.exc_info()[1]) + ", rebuilding.")
+    rebuild_usage_index()
+
+
 def is_job_owner(job_id):
 
     job_file = get_job_filename(job_id)
@@ -179,26 +417,48 @@ def get_all_job_files():
 
 # add image to list of images mounted by a job
 def add_image_usage(job_id, imagename):
+    add_images_usage(job_id, [imagename])
+
+
+# add several images to list of images mounted by a job in a single write
+def add_images_usage(job_id, imagenames):
+    if len(imagenames) == 0:
+        return
+
     filename = get_job_filename(job_id)
+    images = get_image_list(job_id)
+    added = [m for m in unique(imagenames) if m not in images]
+
+    # nothing to do - every image is recorded once per job
+    if len(added) == 0:
+        return
+
     try:
         if not os.path.isdir(local_lock_path):
             print(" --- create directory " + local_lock_path)
             os.makedirs(local_lock_path)
 
-        with open(filename, 'a') as fd:
-
-            # change file ownership to calling user, not root
-            # used to establish owndership of jobs (job files)
-            username = get_login_username()
-            userinfo = pwd.getpwnam(username)
-            os.chown(filename, userinfo.pw_uid, userinfo.pw_gid)
-            fd.write(imagename + "\n")
+        write_job_file(filename, images + added)
     except:
         raise ModuleException("failed to update / create module file " + filename)
 
+    update_usage_index(usage_index.add_usage, get_job_key(filename), added)
+
 
-# return number of jobs that mount an image
-def get_image_usage(imagename):
+# return number of jobs that mount an image. With layers, the jobs that mount a stacked image with the image as a
+# lower image are counted too: the image is in use as long as the stack is mounted.
+def get_image_usage(imagename, layers=True):
+    filename = get_usage_index_filename()
+    if os.path.isfile(filename):
+        try:
+            return usage_index.get_usage(filename, imagename, layers)
+        except sqlite3.Error:
+            print(" --- ERROR reading image usage index " + filename + ": " + str(sys.exc_info()[1]))
+
+    # no usable index: look at the job files, and the mount table
+    users = [imagename]
+    if layers:
+        users += [img for (img, lowers) in get_mounted_stacks().items() if imagename in lowers]
     modulefiles = get_all_job_files()
     usage = 0
     for f in modulefiles:
@@ -207,7 +467,7 @@ def get_image_usage(imagename):
         try:
             with open(f, 'r') as fd:
                 lines = fd.readlines()
-            usage = usage + any(imagename + "\n" in s for s in lines)
+            usage = usage + any(s.rstrip("\n") in users for s in lines)
         except:
             print(" --- ERROR reading module information from " + f + ", assuming image " + imagename + " is used.")
             usage = usage + 1
@@ -219,6 +479,15 @@ def get_image_usage(imagename):
 # If imagename is given, only remove info about that image.
 # Otherwise remove all information about images mounted by a job.
 def clear_image_usage(job_id, imagename=None):
+    if imagename is not None:
+        clear_images_usage(job_id, [imagename])
+    else:
+        clear_images_usage(job_id)
+
+
+# Remove local information about several images mounted by a job in a single write.
+# If imagenames is None, remove all information about images mounted by a job.
+def clear_images_usage(job_id, imagenames=None):
 
     # Forcefully remove all job module files: admin cleanup.
     # Actual images are not unmounted!
@@ -231,27 +500,39 @@ def clear_image_usage(job_id, imagename=None):
                     print(" --- removed job image information " + f)
             except:
                 print(" --- ERROR: failed to remove job image information " + f)
+
+        # temporary job files left by interrupted updates
+        for f in glob.glob(join(local_lock_path, ".*.modules.*.tmp")):
+            try:
+                os.remove(f)
+            except OSError:
+                print(" --- ERROR: failed to remove temporary job file " + f)
+
+        update_usage_index(usage_index.clear_usage)
         return
 
     # remove information about specific job
     filename = get_job_filename(job_id)
 
-    # remove information about a specific module or image
-    if imagename is not None:
+    # remove information about specific modules or images
+    if imagenames is not None:
 
-        # get list of images used by a given job - duplicates removed
-        images = get_image_list(job_id)
-        images = [m for m in images if m != imagename]
+        # get list of images used by a given job
+        used = get_image_list(job_id)
+        images = [m for m in used if m not in imagenames]
+
+        # nothing to do - none of the images is used by the job
+        if len(images) == len(used) and os.path.isfile(filename):
+            return
 
         # save the remaining modules to file and exit
         if len(images):
             try:
-                with open(filename, "w") as fd:
-                    for m in images:
-                        fd.write(m + "\n")
+                write_job_file(filename, images)
             except:
                 raise ModuleException("failed to update / create module file " + filename)
 
+            update_usage_index(usage_index.clear_usage, get_job_key(filename), imagenames)
             return
 
     # remove entire file - empty, or removing all modules
@@ -261,79 +542,178 @@ def clear_image_usage(job_id, imagename=None):
     except:
         print(" --- ERROR: failed to remove job image information " + filename)
 
+    update_usage_index(usage_index.clear_usage, get_job_key(filename))
+
 
 # list of images loaded by a job
 def get_image_list(job_id):
     filename = get_job_filename(job_id)
-    images = []
     if not os.path.isfile(filename):
-        return images
+        return []
+
+    return read_job_file(filename)
+
+
+# Job file format: a version header, one image per line, and a checksum of the image lines.
+# Files without the header were written by older versions, and contain only the image lines.
+job_file_header = "# software_images job file v2\n"
+
+
+# list without duplicates, in the original order
+def unique(items):
+    seen = set()
+    return [i for i in items if not (i in seen or seen.add(i))]
+
+
+# Call func(*args) for every tuple in arglist using at most workers threads.
+# Returns a list of (return value, exception, elapsed seconds), in the order of arglist.
+def run_parallel(func, arglist, workers):
+
+    results = [None] * len(arglist)
+    pending = list(range(len(arglist)))
+    lock = threading.Lock()
+
+    # workers act on behalf of the same caller
+    parent = dict(caller.__dict__)
+
+    def worker():
+        caller.__dict__.update(parent)
+        while True:
+            with lock:
+                if len(pending) == 0:
+                    return
+                i = pending.pop(0)
+            start = time.time()
+            try:
+                results[i] = (func(*arglist[i]), None, time.time() - start)
+            except:
+                results[i] = (None, sys.exc_info()[1], time.time() - start)
+
+    # no threads needed for a single call
+    if workers <= 1 or len(arglist) <= 1:
+        worker()
+        return results
+
+    threads = [threading.Thread(target=worker) for t in range(min(workers, len(arglist)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results
+
+
+def job_file_checksum(body):
+    return "# crc32 %08x\n" % (zlib.crc32(body) & 0xffffffff)
+
+
+# Replace a job file: write a temporary file, sync it to disk and rename it over the job file. A job file is either
+# the old, or the new version, never a partially written one. The owner of an existing job file is preserved,
+# new job files are owned by the calling user, not root: used to establish ownership of jobs.
+def write_job_file(filename, images):
+
+    if os.path.isfile(filename):
+        st = os.lstat(filename)
+        uid, gid = st.st_uid, st.st_gid
+    else:
+        userinfo = pwd.getpwnam(get_login_username())
+        uid, gid = userinfo.pw_uid, userinfo.pw_gid
+
+    body = "".join(m + "\n" for m in unique(images))
+    dname, fname = os.path.split(filename)
+    (fd, tmpname) = tempfile.mkstemp(".tmp", "." + fname + ".", dname)
+    try:
+        os.write(fd, job_file_header + body + job_file_checksum(body))
+        os.fchmod(fd, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.fchown(fd, uid, gid)
+        os.fsync(fd)
+        os.close(fd)
+        fd = None
+        os.rename(tmpname, filename)
+    except:
+        if fd is not None:
+            os.close(fd)
+        os.remove(tmpname)
+        raise
+
+    # make the rename durable
+    dfd = os.open(dname, os.O_RDONLY)
+    try:
+        os.fsync(dfd)
+    finally:
+        os.close(dfd)
+
+
+# List of images in a job file. Damaged or partially written files are reported, and the images that could be read
+# are returned. Duplicates written by older versions are removed.
+def read_job_file(filename):
+    images = []
 
     # read list of used images
     try:
         with open(filename, 'r') as fd:
-            lines = fd.readlines()
+            data = fd.read()
     except:
         print(" --- ERROR reading image information from " + filename)
         return images
 
-    # strip newline
-    images = [l.rstrip() for l in lines]
+    if data.startswith(job_file_header):
+        body = data[len(job_file_header):]
+        idx = body.rfind("# crc32 ")
+        if idx < 0:
+            print(" --- ERROR: job file " + filename + " is incomplete, checksum missing")
+        elif body[idx:] != job_file_checksum(body[:idx]):
+            print(" --- ERROR: job file " + filename + " is damaged, checksum mismatch")
+            body = body[:idx]
+        else:
+            body = body[:idx]
+    else:
+        body = data
 
-    return images
+    # a partially written last line has no newline
+    lines = body.split("\n")
+    if len(lines[-1]):
+        print(" --- ERROR: job file " + filename + " is incomplete, ignoring partial line " + lines[-1])
+    images = [l.rstrip() for l in lines[:-1] if len(l.strip()) and not l.startswith("#")]
 
+    return unique(images)
 
-# check if an image is mounted
-def is_image_mounted(imagename, mntpoint=None):
 
-    # check if file is mounted where it should be by mount | grep imagename | grep mntpoint
-    p1 = subprocess.Popen(["/bin/mount"], stdout=PIPE)
-    p2 = subprocess.Popen(["/bin/grep", imagename], stdin=p1.stdout, stdout=PIPE)
-    if mntpoint is not None:
-        mntpoint = os.path.realpath(mntpoint)
-        pend = subprocess.Popen(["/bin/grep", mntpoint], stdin=p2.stdout, stdout=PIPE)
-    else:
-        pend = p2
-    stdout = pend.communicate()[0]
+# check if a path is located inside a directory
+def is_path_under(path, dname):
+    return path.startswith(dname + os.sep)
 
-    # check if any output at all
-    if not len(stdout):
-        return False
 
-    # match whole path components
-    stdout = re.split("\s+", stdout)
-    if stdout[0] != imagename:
-        return False
-    if mntpoint is not None and stdout[2] != mntpoint:
-        return False
+# check if an image is mounted
+def is_image_mounted(imagename, mntpoint=None):
 
-    return True
+    mounts = get_mount_table().find_source(imagename)
+    if mntpoint is None:
+        return len(mounts) > 0
 
+    # check if the image is mounted where it should be
+    mntpoint = os.path.realpath(mntpoint)
+    return any(m.mntpoint == mntpoint for m in mounts)
 
-# Admin: get a list of mounted images. Everything mounted under mount_path, or mount_path_usr is returned.
-def get_mounted_images(return_details=True):
 
-    p1 = subprocess.Popen(["/bin/mount"], stdout=PIPE)
-    p2 = subprocess.Popen(["/bin/grep", mount_path+'\|'+mount_path_usr], stdin=p1.stdout, stdout=PIPE)
-    stdout = p2.communicate()[0]
-    stdout = stdout.split("\n")
-
-    if len(stdout) == 0:
-        return []
+# Admin: get a list of mounted images. Everything mounted under mount_path, or mount_path_usr is returned. For the
+# overlays of stacked images (see get_image_stack) the loop device is None.
+def get_mounted_images(return_details=True):
 
     modules = []
-    for l in stdout:
-        fields = l.split()
+    for m in get_mount_table().entries:
 
-        # find the loop device
-        if len(fields) == 0:
+        # only loop-mounted images, and overlays of stacked images
+        if m.loopdev is None and not (m.fstype == 'overlay' and os.path.isabs(m.source)):
             continue
+        if not (is_path_under(m.mntpoint, mount_path) or is_path_under(m.mntpoint, mount_path_usr)):
+            continue
+
         if return_details:
-            m = re.search('loop=([^)]*)', fields[len(fields) - 1])
-            loopdev = m.group(1)
-            modules.append((fields[0], fields[2], loopdev))
+            modules.append((m.source, m.mntpoint, m.loopdev))
         else:
-            modules.append(fields[0])
+            modules.append(m.source)
 
     return modules
 
@@ -341,26 +721,32 @@ def get_mounted_images(return_details=True):
 # return path under which a given image is mounted
 def get_image_mount_point(imagename):
 
-    p1 = subprocess.Popen(["/bin/mount"], stdout=PIPE)
-    p2 = subprocess.Popen(["/bin/grep", imagename], stdin=p1.stdout, stdout=PIPE)
-    stdout = p2.communicate()[0]
-    stdout = stdout.split("\n")
+    mounts = get_mount_table().find_source(imagename)
+    if len(mounts) == 0:
+        return None
 
-    if len(stdout) == 0:
-        return []
+    return mounts[0].mntpoint
 
-    for l in stdout:
-        fields = l.split()
-        if len(fields) == 0:
-            continue
 
-        return fields[2]
+# check if a name refers to an existing software module image
+def is_module_name(name):
+    try:
+        return os.path.isfile(get_image_name(name))
+    except ModuleException:
+        return False
 
 
 # return full image name for a given software module
-def get_image_name(modulename):
+# By default the existing image of the module in any format, or the image with the default extension if there is none.
+def get_image_name(modulename, ext=None):
     verify_module_name(modulename)
-    imagename = join(image_path, modulename + image_ext)
+    if ext is None:
+        for e in image_exts:
+            imagename = join(image_path, modulename + e)
+            if os.path.isfile(imagename):
+                return imagename
+        ext = image_ext
+    imagename = join(image_path, modulename + ext)
     return imagename
 
 
@@ -381,10 +767,11 @@ def get_module_name(imagename):
 
     modulename = os.path.realpath(imagename)
 
-    # remove suffix : .ext4
-    if len(modulename) < 5:
+    # remove suffix : .ext4, .squashfs, ...
+    exts = [e for e in image_exts if modulename.endswith(e)]
+    if len(exts) == 0 or len(modulename) <= len(exts[0]):
         raise ModuleException("invalid image: " + imagename)
-    modulename = modulename[:len(modulename)-5]
+    modulename = modulename[:len(modulename)-len(exts[0])]
 
     # get all path elements after image_path
     modulename = modulename[len(image_path):]
@@ -519,6 +906,313 @@ def delete_loopdev(loopdev, kill=False):
         raise ModuleException('ERROR: ' + stdout)
 
 
+# Attach an image to a loop device, with direct I/O if enabled, or as given by direct_io. Returns the loop device,
+# and an open file descriptor of the device that must be closed after the device is mounted (see attach_loopdev).
+def attach_image(imagename, rw=False, autoclear=True, direct_io=None):
+    if direct_io is None:
+        direct_io = loop_direct_io > 0
+    return attach_loopdev(imagename, read_only=not rw, autoclear=autoclear, direct_io=direct_io)
+
+
+# Loop device pool.
+# Software images are attached to loop devices without autoclear, so that a device stays attached after the image is
+# unmounted, and the next mount of the image is a plain mount of the attached device. After an unmount, at most
+# loop_pool_size pool devices are kept: idle devices of images that are not among the most used ones (usage history
+# in the usage index) are detached first, least recently used first. warm_loop_pool attaches the most used images
+# ahead of the jobs. User images and RW mounts do not use the pool.
+
+# internal - is the loop device a pool device, i.e., attached to a software image without autoclear
+def is_pool_loopdev(loopdev, imagename):
+    if not is_path_under(imagename, image_path):
+        return False
+    return not has_autoclear(loopdev)
+
+
+# all pool devices, a list of (loop device, image name) tuples
+def get_pool_loopdevs():
+    return [(d, i) for (d, i) in list_attached_loopdevs() if is_pool_loopdev(d, i)]
+
+
+# usage history of the images: a list of (image name, number of uses, time of last use), most used first
+def get_usage_history():
+    filename = get_usage_index_filename()
+    if not os.path.isfile(filename):
+        return []
+    try:
+        return usage_index.get_history(filename)
+    except sqlite3.Error:
+        return []
+
+
+# Idle images, see idle_grace: a list of (image name, mount point, idle since), longest idle first. Only images that
+# are still mounted at their mount point, and not used by a job, are returned.
+def get_idle_images():
+    filename = get_usage_index_filename()
+    if not os.path.isfile(filename):
+        return []
+    try:
+        idle = usage_index.get_idle(filename)
+    except sqlite3.Error:
+        return []
+    return [(img, mnt, since) for (img, mnt, since) in idle if is_image_mounted(img, mnt) and not get_image_usage(img, layers=False)]
+
+
+# Keep an image mounted at mntpoint as idle. Must be called with the local (per-compute node) image lock held.
+def set_image_idle(imagename, mntpoint):
+    update_usage_index(usage_index.set_idle, imagename, mntpoint)
+
+
+# Forget idle images, e.g., after they have been unmounted
+def clear_images_idle(imagenames):
+    update_usage_index(usage_index.clear_idle, imagenames)
+
+
+# Idle images to unmount now, longest idle first: those idle for idle_grace seconds or more, and the longest idle
+# images beyond idle_max_images and idle_max_mb. idle is a list of (image name, mount point, idle since).
+def get_expired_images(idle, now=None):
+    if now is None:
+        now = time.time()
+    expired = [i for i in idle if now - i[2] >= idle_grace]
+    kept = [i for i in idle if now - i[2] < idle_grace]
+
+    # most recently idle kept first
+    kept.reverse()
+    size = 0
+    for n, i in enumerate(kept):
+        try:
+            size += os.stat(i[0]).st_size
+        except OSError:
+            pass
+        if n >= idle_max_images or (idle_max_mb > 0 and size > idle_max_mb * 1024 * 1024):
+            expired.append(i)
+    return sorted(expired, key=lambda i: i[2])
+
+
+# Return the pool device of an image, attach the image to a new pool device if there is none. filename is the file
+# to attach, the image or its copy in the image cache. direct_io overrides loop_direct_io for a new device, an
+# unused device with another I/O mode is attached again.
+# Must be called with the local (per-compute node) image lock held.
+def get_pool_loopdev(imagename, filename=None, direct_io=None):
+    if filename is None:
+        filename = imagename
+    st = os.stat(filename)
+    for (loopdev, backing) in get_pool_loopdevs():
+        if backing != imagename:
+            continue
+        status = get_loop_status(loopdev)
+        mounted = get_mount_table().find_loopdev(loopdev) is not None
+        if status['device'] == st.st_dev and status['inode'] == st.st_ino:
+            if direct_io is None or mounted or has_direct_io(loopdev) == direct_io:
+                return loopdev
+
+        # the image file has been replaced, or the device holds the image instead of its copy, or vice versa
+        if not mounted:
+            detach_loopdev(loopdev)
+
+    loopdev, fd = attach_image(filename, autoclear=False, direct_io=direct_io)
+    os.close(fd)
+    return loopdev
+
+
+# Detach idle pool devices above the pool size. Must be called with the local (per-compute node) image lock held.
+# Returns the detached devices, a list of (loop device, image name) tuples.
+def trim_loop_pool(size=None):
+    if size is None:
+        size = loop_pool_size
+
+    pool = get_pool_loopdevs()
+    table = get_mount_table()
+    idle = [(d, i) for (d, i) in pool if table.find_loopdev(d) is None]
+
+    # least used images first, then least recently used
+    history = get_usage_history()
+    hot = [i for (i, uses, last_used) in history[:size]]
+    last_used = dict((i, last) for (i, uses, last) in history)
+    idle.sort(key=lambda e: (e[1] in hot, last_used.get(e[1], 0)))
+
+    detached = []
+    for (loopdev, imagename) in idle:
+        if len(pool) - len(detached) <= size:
+            break
+        try:
+            detach_loopdev(loopdev)
+            detached.append((loopdev, imagename))
+        except (IOError, OSError):
+            print(" --- WARNING: cannot detach pool loop device " + loopdev + ": " + str(sys.exc_info()[1]))
+
+    return detached
+
+
+# Attach the most used images that have no pool device, up to the pool size.
+# Must be called with the local (per-compute node) image lock held. Returns the attached devices.
+def warm_loop_pool(size=None):
+    if size is None:
+        size = loop_pool_size
+
+    pool = get_pool_loopdevs()
+    images = [i for (d, i) in pool]
+    attached = []
+    for (imagename, uses, last_used) in get_usage_history()[:size]:
+        if len(pool) + len(attached) >= size:
+            break
+        if imagename in images or not is_path_under(imagename, image_path) or not os.path.isfile(imagename):
+            continue
+        attached.append((get_pool_loopdev(imagename), imagename))
+
+    return attached
+
+
+# Image stacks (see image_layers.py).
+# A layer image holds the files of a module that differ from a base image, and overlay whiteouts for the removed
+# files. <image>.stack lists the lower images of the stack, bottom first, relative to image_path. Software images
+# and user images can be layers, the lower images are software images. A stacked image is mounted as an overlay:
+# every image of the stack is mounted read-only once per node, in a hidden directory under the layer mount path
+# shared by all the stacks that use it, and the overlay, with the image name as its source, at the mount point.
+# The layer mounts are registered in the global lock files of their images like RO mounts, and unmounted when no
+# overlay uses them any more.
+# A layer only holds the differences to its base at the time it was built: every line of the stack file records the
+# size, mtime and inode of the lower image it was built on, after a tab. A stack whose lower image has been rebuilt
+# since is not mounted, the layer must be rebuilt on the new base. Lines without them (older stack files) are not
+# checked.
+
+stack_ext = ".stack"
+
+
+# name of the stack file of an image
+def get_stack_name(imagename):
+    return imagename + stack_ext
+
+
+# identity of a lower image recorded in a stack file, from the os.stat result of the image file
+def get_stack_identity(st):
+    return "%d %r %d" % (st.st_size, st.st_mtime, st.st_ino)
+
+
+# lower images of a stacked image, bottom first. Empty for plain images. With check, a lower image that is not the
+# one the image was built on is an error.
+def get_image_stack(imagename, check=True):
+    try:
+        with open(get_stack_name(imagename), 'r') as f:
+            lines = f.read().split("\n")
+    except IOError:
+        err = sys.exc_info()[1]
+        if err.errno == errno.ENOENT:
+            return []
+        raise ModuleException("cannot read image stack " + get_stack_name(imagename) + ": " + str(err))
+
+    lowers = []
+    for line in lines:
+        line = line.strip()
+        if not len(line) or line.startswith('#'):
+            continue
+        (name, sep, identity) = line.partition("\t")
+        lower = os.path.realpath(join(image_path, name))
+        if not is_path_under(lower, image_path) or not os.path.isfile(lower) or lower == imagename:
+            raise ModuleException("image stack " + get_stack_name(imagename) + ": " + name + " is not an image in " + image_path)
+        if check and len(identity) and identity.split() != get_stack_identity(os.stat(lower)).split():
+            raise ModuleException("image stack " + get_stack_name(imagename) + ": " + lower + " has been rebuilt since " +
+                                  imagename + " was built on it, the image must be rebuilt")
+        lowers.append(lower)
+    return lowers
+
+
+# node-local directory of the hidden layer mounts
+def get_layer_mount_path():
+    return join(local_lock_path, "layers")
+
+
+# Hidden mount point of an image used as a layer: <layer mount path>/<image relative to image_path>/<inode>, user
+# images under .user/<absolute path>. A replaced image file gets a new mount point: the stacks mounted before keep
+# the old layer, new stacks mount the new one.
+def get_layer_mount_point(imagename):
+    if is_path_under(imagename, image_path):
+        rel = os.path.relpath(imagename, image_path)
+    else:
+        rel = join(".user", imagename.lstrip("/"))
+    return join(get_layer_mount_path(), rel, str(os.stat(imagename).st_ino))
+
+
+# hidden layer mounts: a dictionary of mount point: MountEntry
+def get_layer_mounts():
+    path = get_layer_mount_path()
+    return dict((m.mntpoint, m) for m in get_mount_table().entries if is_path_under(m.mntpoint, path))
+
+
+# Mounted overlays of stacked images: a list of (MountEntry, layer mount points, top first)
+def get_stack_mounts():
+    path = get_layer_mount_path()
+    stacks = []
+    for m in get_mount_table().entries:
+        if m.fstype != 'overlay':
+            continue
+        for opt in m.super_options.split(','):
+            if opt.startswith('lowerdir='):
+                dirs = opt[len('lowerdir='):].split(':')
+                if all(is_path_under(d, path) for d in dirs):
+                    stacks.append((m, dirs))
+    return stacks
+
+
+# Layers of the mounted stacked images: a dictionary of image name: list of its lower images, as mounted
+def get_mounted_stacks():
+    layers = get_layer_mounts()
+    stacks = {}
+    for (m, dirs) in get_stack_mounts():
+        images = [layers[d].source for d in dirs if d in layers]
+        stacks[m.source] = [i for i in images if i != m.source]
+    return stacks
+
+
+# loop devices of the hidden layer mounts
+def get_layer_loopdevs():
+    return [m.loopdev for m in get_layer_mounts().values() if m.loopdev is not None]
+
+
+# record the lower images of a stacked image in the usage index, after its overlay has been mounted
+def add_stack_layers(imagename, lowers):
+    update_usage_index(usage_index.add_layers, imagename, lowers)
+
+
+# internal - unmount a mount point, lazily if it is busy. Returns True if it was unmounted right away.
+def umount_path(mntpoint, job_id='NOJOBID'):
+    p = subprocess.Popen(["/bin/umount", mntpoint], stderr=PIPE)
+    stderrdata = p.communicate()[1]
+    if not p.returncode:
+        return True
+    print(job_id + " --- umount on " + mntpoint + " failed: " + stderrdata.split('\n')[0] + ", performing lazy umount")
+    p = subprocess.Popen(["/bin/umount", "-l", mntpoint], stderr=PIPE)
+    p.wait()
+    return False
+
+
+# Unmount the hidden layer mounts that no mounted overlay uses, after an overlay has been unmounted or its mount
+# failed, remove the host from the global lock of their images if they are not mounted any more, and update the
+# layers in the usage index. Must be called with the local (per-compute node) image lock held exclusively: a
+# concurrent stack mount could be about to use a layer.
+# Returns the images of the unmounted layers.
+def umount_layers(job_id='NOJOBID'):
+    used = set(d for (m, dirs) in get_stack_mounts() for d in dirs)
+    unused = [m for m in get_layer_mounts().values() if m.mntpoint not in used]
+    for m in unused:
+        umount_path(m.mntpoint, job_id)
+        try:
+            os.rmdir(m.mntpoint)
+        except OSError:
+            pass
+        print(job_id + " --- layer " + m.source + " has been unmounted from " + m.mntpoint)
+
+    hostname = socket.gethostname()
+    images = set(m.source for m in unused)
+    for image in images:
+        if is_image_mounted(image):
+            continue
+        with fs_lock_file(image + ".lock", False, shared=True):
+            remove_image_holder(image, hostname)
+
+    update_usage_index(usage_index.set_layers, get_mounted_stacks())
+    return sorted(images)
+
+
 def validate_mount_arguments(mntname, mntpoint):
 
     imagename = None
@@ -575,6 +1269,193 @@ def validate_mount_arguments(mntname, mntpoint):
     return imagename, mntpoint, modulename
 
 
+# Build a list of (name, mount point) requests from the command line and/or a list file.
+# A list file contains one image per line: a module name, or a user image followed by its mount point.
+# On the command line, two names of which the first is not a software module are an image and its mount point.
+def get_image_requests(names, listfile=None):
+
+    requests = []
+    if listfile is not None:
+        try:
+            if listfile == '-':
+                lines = sys.stdin.readlines()
+            else:
+                with open(listfile, 'r') as fd:
+                    lines = fd.readlines()
+        except IOError:
+            raise ModuleException("cannot read image list " + listfile + ": " + str(sys.exc_info()[1]))
+
+        for l in lines:
+            fields = l.split('#')[0].split()
+            if len(fields) == 0:
+                continue
+            if len(fields) > 2:
+                raise ModuleException("invalid line in image list " + listfile + ": " + l.rstrip())
+            requests.append((fields[0], fields[1] if len(fields) == 2 else None))
+
+    if len(names) == 2 and not is_module_name(names[0]):
+        return requests + [(names[0], names[1])]
+
+    return requests + [(n, None) for n in names]
+
+
+# Metrics of a run of a tool, or of a request of the image daemon. The record is shared by the threads of the run.
+class MetricsRecord(object):
+
+    def __init__(self, tool, job_id='NOJOBID'):
+        self._lock = threading.Lock()
+        self.emitted = False
+        self.data = {'tool': tool, 'host': socket.gethostname(), 'job_id': job_id, 'user': get_login_username(),
+                     'pid': os.getpid(), 'start': time.time(), 'status': 'ok', 'phases': {}, 'images': {},
+                     'locks': {}, 'subprocesses': 0}
+
+    # add seconds to a phase, of an image if given
+    def add_phase(self, phase, seconds, image=None):
+        with self._lock:
+            phases = self.data['phases'] if image is None else self.data['images'].setdefault(image, {})
+            phases[phase] = phases.get(phase, 0.0) + seconds
+
+    def add_lock(self, kind, stats, image=None):
+        with self._lock:
+            locks = self.data['locks'].setdefault(kind, {'count': 0, 'attempts': 0, 'retries': 0, 'wait': 0.0, 'max_wait': 0.0})
+            locks['count'] += 1
+            locks['attempts'] += stats.get('attempts', 0)
+            locks['retries'] += max(0, stats.get('attempts', 0) - 1)
+            locks['wait'] += stats.get('wait', 0.0)
+            locks['max_wait'] = max(locks['max_wait'], stats.get('wait', 0.0))
+        if image is not None:
+            self.add_phase(kind + '_lock', stats.get('wait', 0.0), image)
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.data[key] = self.data.get(key, 0) + n
+
+    def set(self, key, value):
+        with self._lock:
+            self.data[key] = value
+
+    # emit the record once: to syslog, and to metrics_file
+    def emit(self):
+        with self._lock:
+            if self.emitted:
+                return
+            self.emitted = True
+            self.data['elapsed'] = time.time() - self.data['start']
+            line = json.dumps(self.data, sort_keys=True)
+        if metrics_syslog > 0:
+            try:
+                syslog.openlog('software_images_metrics')
+                syslog.syslog(syslog.LOG_INFO, line)
+            except:
+                pass
+        if len(metrics_file):
+            try:
+                fd = os.open(metrics_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, line + "\n")
+                finally:
+                    os.close(fd)
+            except OSError:
+                print(" --- WARNING: cannot write metrics to " + metrics_file + ": " + str(sys.exc_info()[1]))
+
+
+# subprocess.Popen that counts the subprocesses of the metrics record of the calling thread. start_metrics installs
+# it as subprocess.Popen, so the original class is kept here.
+_Popen = subprocess.Popen
+class CountingPopen(_Popen):
+
+    def __init__(self, *args, **kwargs):
+        _Popen.__init__(self, *args, **kwargs)
+        m = get_metrics()
+        if m is not None:
+            m.count('subprocesses')
+
+
+# internal - start time of a process [s since the epoch], and its command name
+def get_process_start(pid):
+    with open("/proc/%d/stat" % pid, 'r') as f:
+        stat = f.read()
+    fields = stat[stat.rindex(')') + 2:].split()
+    with open("/proc/uptime", 'r') as f:
+        uptime = float(f.read().split()[0])
+    name = stat[stat.index('(') + 1:stat.rindex(')')]
+    return time.time() - uptime + int(fields[19]) / float(os.sysconf('SC_CLK_TCK')), name
+
+
+# Start the metrics record of a tool in the calling thread. The time from the start of the process (interpreter and
+# imports), and from the start of a parent sudo, are its first phases. With at_exit, the record is emitted when the
+# process exits, otherwise the caller emits it. Returns the record.
+def start_metrics(tool, job_id='NOJOBID', at_exit=True):
+    m = MetricsRecord(tool, job_id)
+    caller.metrics = m
+    subprocess.Popen = CountingPopen
+    if at_exit:
+        try:
+            (start, name) = get_process_start(os.getpid())
+            m.add_phase('startup', max(0.0, m.data['start'] - start))
+            (pstart, pname) = get_process_start(os.getppid())
+            if pname == 'sudo':
+                m.add_phase('sudo', max(0.0, start - pstart))
+        except (IOError, OSError, ValueError, IndexError):
+            pass
+        atexit.register(m.emit)
+    return m
+
+
+# the metrics record of the calling thread, or None
+def get_metrics():
+    return getattr(caller, 'metrics', None)
+
+
+# Time a phase of the current metrics record, of an image if given
+@contextlib.contextmanager
+def metrics_phase(phase, image=None):
+    start = time.time()
+    try:
+        yield
+    finally:
+        m = get_metrics()
+        if m is not None:
+            m.add_phase(phase, time.time() - start, image)
+
+
+# Mark the current metrics record as failed
+def metrics_failed(msg):
+    m = get_metrics()
+    if m is not None:
+        m.set('status', 'failed')
+        m.set('error', msg.strip())
+
+
+# internal - add the stats of fs_lock_file to the current metrics record: local (per-compute node) locks, image locks
+# (per image), and other global lock files
+def add_lock_metrics(fname, stats):
+    m = get_metrics()
+    if m is None:
+        return
+    if is_path_under(fname, local_lock_path):
+        m.add_lock('local', stats)
+    elif fname.endswith(".lock") and os.path.isfile(fname[:-len(".lock")]):
+        m.add_lock('global', stats, fname[:-len(".lock")])
+    else:
+        m.add_lock('global', stats)
+
+
+# print a per-image status report of a batch operation, return True if all requests succeeded
+def print_image_report(job_id, report):
+    ok = True
+    m = get_metrics()
+    for (name, status, msg, elapsed) in report:
+        if m is not None:
+            m.count('images_' + re.sub(r' by [0-9]+ jobs$', '', status.lower()).replace(' ', '_'))
+        if status == 'FAILED':
+            ok = False
+            if m is not None:
+                m.set('status', 'failed')
+        print(job_id + " --- " + name + ": " + status + " (%.3fs)" % elapsed + (" " + msg.strip() if len(msg.strip()) else ""))
+    return ok
+
+
 def set_from_environment(varname, envname):
     try:
         globals()[varname] = os.environ[envname]
@@ -588,3 +1469,47 @@ set_from_environment('image_path', 'SI_IMAGE_PATH')
 set_from_environment('mount_path', 'SI_MOUNT_PATH')
 set_from_environment('mount_path_usr', 'SI_USR_MOUNT_PATH')
 set_from_environment('local_lock_path', 'SI_LOCK_PATH')
+set_from_environment('daemon_socket', 'SI_DAEMON_SOCKET')
+
+# metrics
+set_from_environment('metrics_syslog', 'SI_METRICS_SYSLOG')
+metrics_syslog = int(metrics_syslog)
+set_from_environment('metrics_file', 'SI_METRICS_FILE')
+set_from_environment('image_cache_path', 'SI_IMAGE_CACHE')
+if len(image_cache_path):
+    image_cache_path = os.path.realpath(image_cache_path)
+
+    # loop devices of cached copies report the images
+    mounttable.backing_aliases.append((image_cache_path, image_path))
+set_from_environment('image_cache_mb', 'SI_IMAGE_CACHE_MB')
+image_cache_mb = int(image_cache_mb)
+set_from_environment('image_cache_fill', 'SI_IMAGE_CACHE_FILL')
+image_cache_fill = int(image_cache_fill)
+
+# staging
+set_from_environment('stage_workers', 'SI_STAGE_WORKERS')
+stage_workers = int(stage_workers)
+set_from_environment('stage_rate_mb', 'SI_STAGE_RATE_MB')
+stage_rate_mb = int(stage_rate_mb)
+set_from_environment('stage_pdsh', 'SI_STAGE_PDSH')
+
+# hot block lists
+set_from_environment('hot_replay', 'SI_HOT_REPLAY')
+hot_replay = int(hot_replay)
+
+# lock acquisition
+set_from_environment('lock_strategy', 'SI_LOCK_STRATEGY')
+
+# loop devices
+set_from_environment('loop_direct_io', 'SI_LOOP_DIRECT_IO')
+loop_direct_io = int(loop_direct_io)
+set_from_environment('loop_pool_size', 'SI_LOOP_POOL_SIZE')
+loop_pool_size = int(loop_pool_size)
+
+# idle images
+set_from_environment('idle_grace', 'SI_IDLE_GRACE')
+idle_grace = int(idle_grace)
+set_from_environment('idle_max_images', 'SI_IDLE_MAX_IMAGES')
+idle_max_images = int(idle_max_images)
+set_from_environment('idle_max_mb', 'SI_IDLE_MAX_MB')
+idle_max_mb = int(idle_max_mb)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python2
+
+# Node-local image cache.
+#
+# With image_cache_path (SI_IMAGE_CACHE) set to a directory on a local disk or tmpfs, RO mounts of software images
+# use a copy of the image in the cache, <cache>/<image relative to image_path>: after the first mount on a node, the
+# blocks of a module are read from the local disk, not from the shared file system. The mount table and the loop
+# device pool report the copies as the images (see backing_aliases in mounttable).
+#
+# A copy is a reflink if the cache is on the file system of the images. Otherwise the image is read once, its sha256
+# is compared with the sha256 of the copy read back, and blocks of zeros are not written (sparse copy). <copy>.info
+# records the size, mtime and inode of the image, and the sha256. A copy is used as long as the size, mtime and inode
+# of the image match: a rebuilt image (replaced by an atomic rename) is copied again.
+#
+# The copies take at most image_cache_mb MB (SI_IMAGE_CACHE_MB) of the cache, the least recently used copies that are
+# not attached to a loop device are removed first. The images of a mount request are copied before the node-local
+# image lock is taken (see fill_cache), so that a copy does not hold up the other (un)mounts of the node; the mount
+# uses the copy if it is still current. With image_cache_fill (SI_IMAGE_CACHE_FILL) 0, mounts only use the copies
+# made ahead of time by a prefetch:
+#
+#   image_cache gcc/9.3.0 python/3.8.2      # prefetch, e.g., from the SLURM prolog with the modules of the job
+#   image_cache --list
+#   image_cache --trim
+
+import os
+import sys
+import time
+import fcntl
+import hashlib
+import argparse
+import hpcmodules
+from hpcmodules import *
+from manifest import hash_file
+
+# seconds to wait for a concurrent copy of the same image
+image_cache_timeout = 600
+
+info_ext = ".info"
+
+FICLONE = 0x40049409
+
+
+# path of the copy of an image in the cache, or None if the image is not cached: the cache is disabled, or the image
+# is not a software image
+def get_cache_name(imagename):
+    if not len(hpcmodules.image_cache_path) or not is_path_under(imagename, image_path):
+        return None
+    return join(hpcmodules.image_cache_path, os.path.relpath(imagename, image_path))
+
+
+# internal - the record of a copy in its .info file: size, mtime and inode of the image, and the sha256 of the copy
+def get_info(st, sha):
+    return "%d %r %d %s\n" % (st.st_size, st.st_mtime, st.st_ino, sha)
+
+
+# internal - is the copy in the cache current
+def is_current(cachename, st):
+    try:
+        with open(cachename + info_ext, 'r') as f:
+            info = f.read()
+        return info.split()[:3] == get_info(st, '-').split()[:3] and os.path.isfile(cachename)
+    except (IOError, OSError):
+        return False
+
+
+# internal - copy an image: a reflink if possible, otherwise a sparse copy verified by sha256.
+# Returns the sha256 of the copy, '-' for a reflink.
+def copy_image(imagename, filename):
+    zeros = "\0" * (1024*1024)
+    with open(imagename, 'rb') as src:
+        with open(filename, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return '-'
+            except IOError:
+                pass
+
+            h = hashlib.sha256()
+            while True:
+                buf = src.read(len(zeros))
+                if not len(buf):
+                    break
+                h.update(buf)
+                if buf == zeros[:len(buf)]:
+                    dst.seek(len(buf), os.SEEK_CUR)
+                else:
+                    dst.write(buf)
+            dst.truncate()
+            dst.flush()
+            os.fsync(dst.fileno())
+
+    sha = h.hexdigest()
+    if hash_file(filename) != sha:
+        raise ModuleException("the copy " + filename + " of " + imagename + " differs from the image")
+    return sha
+
+
+# Copies in the cache: a list of (image name, copy, bytes used, time of last use), least recently used first
+def get_cache_entries():
+    entries = []
+    if not len(hpcmodules.image_cache_path):
+        return entries
+    for (dirpath, dirnames, filenames) in os.walk(hpcmodules.image_cache_path):
+        for f in filenames:
+            if not f.endswith(info_ext):
+                continue
+            cachename = join(dirpath, f[:-len(info_ext)])
+            try:
+                used = os.stat(cachename).st_blocks * 512
+            except OSError:
+                used = 0
+            entries.append((join(image_path, os.path.relpath(cachename, hpcmodules.image_cache_path)), cachename, used,
+                            os.stat(join(dirpath, f)).st_mtime))
+    entries.sort(key=lambda e: e[3])
+    return entries
+
+
+# internal - copies attached to loop devices: a set of (device, inode)
+def get_attached_copies():
+    attached = set()
+    for (loopdev, backing) in list_attached_loopdevs():
+        try:
+            status = get_loop_status(loopdev)
+        except (IOError, OSError):
+            continue
+        attached.add((status['device'], status['inode']))
+    return attached
+
+
+# internal - remove a copy from the cache. A copy attached to a loop device stays on the disk until it is detached.
+def remove_copy(cachename):
+    for f in [cachename + info_ext, cachename]:
+        try:
+            os.remove(f)
+        except OSError:
+            pass
+
+
+# Remove the least recently used copies that are not attached to a loop device, until the copies and needed bytes fit
+# into image_cache_mb. Returns the removed copies, a list of (image name, bytes).
+def trim_cache(needed=0, size=None):
+    if size is None:
+        size = hpcmodules.image_cache_mb
+    entries = get_cache_entries()
+    used = sum([e[2] for e in entries])
+    attached = get_attached_copies()
+    removed = []
+    for (imagename, cachename, nbytes, last_used) in entries:
+        if used + needed <= size * 1024 * 1024:
+            break
+        try:
+            st = os.stat(cachename)
+            if (st.st_dev, st.st_ino) in attached:
+                continue
+        except OSError:
+            pass
+        remove_copy(cachename)
+        used -= nbytes
+        removed.append((imagename, nbytes))
+    return removed
+
+
+# Return the copy of an image in the cache. If there is no current copy and fill is set, the image is copied into
+# the cache. Returns None if the image is not cached: the cache is disabled, the image is not a software image, the
+# copy does not fit into the cache, or copying failed.
+def get_cached_image(imagename, fill=None, job_id='NOJOBID'):
+    cachename = get_cache_name(imagename)
+    if cachename is None:
+        return None
+    if fill is None:
+        fill = hpcmodules.image_cache_fill > 0
+
+    st = os.stat(imagename)
+    if is_current(cachename, st):
+        os.utime(cachename + info_ext, None)
+        return cachename
+    if not fill:
+        return None
+
+    try:
+        if not os.path.isdir(os.path.dirname(cachename)):
+            try:
+                os.makedirs(os.path.dirname(cachename))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(cachename)):
+                    raise
+
+        # one copy of an image at a time
+        with fs_lock_file(cachename + ".lock", False, timeout=image_cache_timeout):
+            if is_current(cachename, st):
+                os.utime(cachename + info_ext, None)
+                return cachename
+
+            needed = st.st_blocks * 512
+            trim_cache(needed)
+            if sum([e[2] for e in get_cache_entries()]) + needed > hpcmodules.image_cache_mb * 1024 * 1024:
+                print(job_id + " --- WARNING: " + imagename + " does not fit into the image cache")
+                return None
+
+            start = time.time()
+            tmpname = join(os.path.dirname(cachename), "." + os.path.basename(cachename) + ".tmp")
+            try:
+                with metrics_phase('cache_copy', imagename):
+                    sha = copy_image(imagename, tmpname)
+            except:
+                remove_copy(tmpname)
+                raise
+
+            # the old copy goes first: a copy without its .info is not used
+            remove_copy(cachename)
+            os.rename(tmpname, cachename)
+            with open(cachename + info_ext + ".tmp", 'w') as f:
+                f.write(get_info(st, sha))
+            os.rename(cachename + info_ext + ".tmp", cachename + info_ext)
+            elapsed = time.time() - start
+            print(job_id + " --- copied " + imagename + " to the image cache, %d MB in %.1f s" % (st.st_size / (1024*1024), elapsed))
+            return cachename
+
+    except (IOError, OSError, ModuleException):
+        print(job_id + " --- WARNING: cannot copy " + imagename + " to the image cache: " + str(sys.exc_info()[1]))
+        return None
+
+
+# Copy the images of RO mount requests, and their lower images, into the cache if image_cache_fill is set. Called
+# before the local image lock is taken: images that are mounted already are not copied.
+def fill_cache(imagenames, job_id='NOJOBID'):
+    if not len(hpcmodules.image_cache_path) or not hpcmodules.image_cache_fill > 0:
+        return
+    for imagename in imagenames:
+        if is_image_mounted(imagename):
+            continue
+        for i in get_image_stack(imagename) + [imagename]:
+            if os.path.isfile(i):
+                get_cached_image(i, True, job_id)
+
+
+# Copy images into the cache ahead of the jobs, with workers threads. Returns the number of images that are cached.
+def prefetch_images(imagenames, workers=2):
+    results = run_parallel(get_cached_image, [(imagename, True) for imagename in imagenames], workers)
+    return len([r for (r, err, elapsed) in results if r is not None])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Prefetch software images into the node-local image cache, list or trim the cache.")
+    parser.add_argument("image_name", help="name of the software module(s) to copy into the cache", nargs='*')
+    parser.add_argument("--list", help="list the copies in the cache", action='store_true')
+    parser.add_argument("--trim", help="remove the least recently used copies that do not fit into --size", action='store_true')
+    parser.add_argument("--size", help="size of the cache [MB, default: %(default)s, SI_IMAGE_CACHE_MB]", type=int, default=hpcmodules.image_cache_mb)
+    parser.add_argument("--workers", help="number of images copied concurrently [default: %(default)s]", type=int, default=2)
+    args = parser.parse_args()
+    hpcmodules.image_cache_mb = args.size
+
+    try:
+        if not len(hpcmodules.image_cache_path):
+            raise ModuleException("the image cache is disabled, set SI_IMAGE_CACHE")
+
+        if len(args.image_name):
+            imagenames = []
+            for name in args.image_name:
+                imagename = get_image_name(name)
+                if not os.path.isfile(imagename):
+                    raise ModuleException("image file " + imagename + " does not exist")
+                imagenames += get_image_stack(imagename) + [imagename]
+            start = time.time()
+            n = prefetch_images(unique(imagenames), args.workers)
+            print(" --- %d of %d images cached in %.1f s" % (n, len(unique(imagenames)), time.time() - start))
+
+        if args.trim:
+            for (imagename, nbytes) in trim_cache(0, args.size):
+                print(" --- removed " + imagename + " (" + str(nbytes / (1024*1024)) + " MB)")
+
+        if args.list:
+            attached = get_attached_copies()
+            total = 0
+            for (imagename, cachename, nbytes, last_used) in reversed(get_cache_entries()):
+                st = os.stat(cachename)
+                state = "attached" if (st.st_dev, st.st_ino) in attached else "idle"
+                print(imagename + " " + str(nbytes / (1024*1024)) + " MB, last used " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(last_used)) + " (" + state + ")")
+                total += nbytes
+            print(" --- " + str(total / (1024*1024)) + " of " + str(args.size) + " MB used")
+
+    except ModuleException:
+        print(str(sys.exc_info()[1]))
+        exit(1)
+    # other exceptions run through
@@ -0,0 +1,188 @@
+#!/usr/bin/env python2
+
+# Node image daemon.
+#
+# A long-lived root process that mounts and unmounts images on behalf of module_load and the (u)mount tools, so that
+# a module load does not pay for sudo, a new interpreter, the imports and rediscovery of the node state. The daemon
+# keeps the mount table in memory (it is only re-read when the kernel reports a change), coalesces concurrent mounts
+# of the same image (see mount_service.py), and serves one request per connection on a Unix socket (daemon_socket,
+# SI_DAEMON_SOCKET):
+#
+#   request: a JSON line {"op": "mount" | "umount" | "list", "images": [[name, mount point or null], ...],
+#            "job_id": ..., "rw": ..., "batch": ..., "workers": ..., "unreported": ..., "now": ..., "user": ...}
+#   reply:   the messages printed while handling the request, and a status line "== ok", or "== failed"
+#
+# Clients are authenticated with SO_PEERCRED, requests are handled on behalf of the connecting user. Only root
+# (i.e., a tool started through sudo) may act on behalf of the user given in the request.
+#
+# The node-local image lock is taken for every request as before, so the daemon and tools working directly can be
+# used at the same time. For the same reason, only the mount table is held in memory: the job files, the usage index
+# and the loop device pool are changed by the tools working directly (and the epilog) as well, so the daemon reads
+# them on every request like the tools do. The usage of an image is a single query of the usage index.
+#
+# With idle_grace (SI_IDLE_GRACE), a timer unmounts the idle images whose grace period is over.
+
+import os
+import sys
+import pwd
+import json
+import stat
+import socket
+import struct
+import time
+import argparse
+import threading
+import traceback
+import SocketServer
+import hpcmodules
+from hpcmodules import *
+from mount_service import MountService
+from umount_image import umount_image, umount_images, evict_idle_images
+from list_images import list_images
+
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+# seconds between two checks of the idle images, at most
+idle_interval = 60
+
+# concurrent mount requests for the same image are coalesced
+service = MountService()
+
+
+# sys.stdout replacement: messages printed while handling a request are returned to the client
+class ThreadOutput(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        output = getattr(caller, 'output', None)
+        if output is not None:
+            output.append(data)
+        else:
+            self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def handle_request(req):
+
+    op = req.get('op')
+    job_id = str(req.get('job_id', 'NOJOBID'))
+    requests = [(str(n), None if m is None else str(m)) for (n, m) in req.get('images', [])]
+
+    if op == 'list':
+        return list_images(job_id, bool(req.get('unreported')))
+
+    if len(requests) == 0:
+        raise ModuleException("no images given")
+
+    if op == 'mount':
+        if req.get('profile'):
+            if get_login_username() != 'root':
+                raise ModuleException("--profile can only be used by root")
+            caller.profile = int(req['profile'])
+        if not req.get('batch'):
+            service.mount_image(requests[0][0], requests[0][1], bool(req.get('rw')), job_id)
+            return True
+        return print_image_report(job_id, service.mount_images(requests, job_id, req.get('workers')))
+
+    if op == 'umount':
+        keep_idle = not req.get('now')
+        if not req.get('batch'):
+            umount_image(requests[0][0], requests[0][1], job_id, keep_idle)
+            return True
+        return print_image_report(job_id, umount_images(requests, job_id, keep_idle))
+
+    raise ModuleException("unknown request " + str(op))
+
+
+# unmount the idle images whose grace period is over
+def idle_timer():
+    while True:
+        time.sleep(min(idle_interval, max(1, hpcmodules.idle_grace)))
+        try:
+            with local_lock_images() as lock:
+                evict_idle_images('idle')
+        except:
+            print(" --- ERROR evicting idle images: " + str(sys.exc_info()[1]))
+        sys.stdout.flush()
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        output = []
+        caller.output = output
+        job_id = 'NOJOBID'
+        ok = False
+        m = None
+        try:
+            creds = self.request.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i'))
+            (pid, uid, gid) = struct.unpack('3i', creds)
+
+            req = json.loads(self.rfile.readline())
+            job_id = str(req.get('job_id', 'NOJOBID'))
+            if uid == 0 and req.get('user'):
+                caller.username = str(req['user'])
+            else:
+                caller.username = pwd.getpwuid(uid).pw_name
+            m = start_metrics('image_daemon ' + str(req.get('op')), job_id, at_exit=False)
+
+            ok = handle_request(req)
+
+        except ModuleException:
+            print(job_id + str(sys.exc_info()[1]))
+        except:
+            print(job_id + " --- ERROR in image daemon: " + str(sys.exc_info()[1]))
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            if m is not None:
+                if not ok and m.data['status'] == 'ok':
+                    m.set('status', 'failed')
+                m.emit()
+            caller.__dict__.clear()
+
+        try:
+            self.wfile.write("".join(output) + "== " + ("ok" if ok else "failed") + "\n")
+        except socket.error:
+            # client went away
+            pass
+
+
+class ImageServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Serve image mount requests on a Unix socket.")
+    parser.add_argument("--socket", help="socket path [default: " + hpcmodules.daemon_socket + "]", default=hpcmodules.daemon_socket)
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        print(" --- ERROR: the image daemon must run as root")
+        exit(1)
+
+    # remove the socket of a previous instance
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+
+    server = ImageServer(args.socket, RequestHandler)
+
+    # every user may connect, callers are identified with SO_PEERCRED
+    os.chmod(args.socket, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
+
+    sys.stdout = ThreadOutput(sys.stdout)
+    print(" --- image daemon listening on " + args.socket)
+    sys.stdout.flush()
+
+    if hpcmodules.idle_grace > 0:
+        timer = threading.Thread(target=idle_timer)
+        timer.daemon = True
+        timer.start()
+    try:
+        server.serve_forever()
+    finally:
+        os.remove(args.socket)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python2
+
+# Image formats of software images, used by create_software_image.
+#
+#   ext4     - ext4 file system sized exactly for the source directory (see get_ext4_size), populated by mke2fs -d
+#              (ext4_build populate), or through a loop mount and rsync (ext4_build rsync, needs root). Software
+#              images are mounted read-only: they have no journal and no reserved blocks. With ext4_shrink the
+#              finished image is shrunk to its minimum size by resize2fs -M.
+#              An existing image can be updated incrementally (update): a copy of the image is grown if needed, and
+#              only the changed files are copied into it by rsync (needs root).
+#   squashfs - compressed read-only image, built directly from the source directory with mksquashfs
+#   erofs    - compressed read-only image, built directly from the source directory with mkfs.erofs
+#
+# A format has a name, the extension of its image files (see image_exts in hpcmodules), and a build method that
+# writes an image of a source directory to a file. All formats are mounted the same way: the kernel detects the file
+# system on the loop device.
+
+import os
+import sys
+import subprocess
+import tempfile
+from hpcmodules import ModuleException
+from filefs import filefs, get_image_size, shrink_fs, grow_fs
+
+# build mode of ext4 images: populate, or rsync
+ext4_build = "populate"
+
+# free space of ext4 images, in MB on top of the exact size, and shrinking of the finished images
+ext4_extra_size = 0
+ext4_shrink = 0
+
+# options of the compressed formats
+squashfs_options = "-comp zstd -b 1M"
+erofs_options = "-zlz4hc"
+
+
+# internal - run a build command, raise ModuleException if it fails
+def run_build_command(cmd):
+    print(" --- " + " ".join(cmd))
+    try:
+        p = subprocess.Popen(cmd)
+    except OSError:
+        raise ModuleException("cannot run " + cmd[0] + ": " + str(sys.exc_info()[1]))
+    p.wait()
+    if p.returncode:
+        raise ModuleException(cmd[0] + " returned with " + str(p.returncode))
+
+
+class Ext4Format(object):
+
+    name = 'ext4'
+    ext = '.ext4'
+
+    def build(self, srcdir, imagename):
+
+        if ext4_build not in ["populate", "rsync"]:
+            raise ModuleException("unknown ext4 build mode " + ext4_build + ", use populate or rsync")
+
+        size, inodes = get_image_size(srcdir, reserved=0, journal=False, extra_size=ext4_extra_size)
+        print(" --- creating disk image of size: " + str(size) + "MB, " + str(inodes) + " inodes")
+
+        if ext4_build == "populate":
+            filefs(size, imagename, srcdir, inodes, reserved=0, journal=False)
+        else:
+            filefs(size, imagename, None, inodes, reserved=0, journal=False)
+            self.rsync(srcdir, imagename)
+
+        if ext4_shrink > 0:
+            shrink_fs(imagename)
+
+    # Build imagename from a copy of the existing image oldname: the file system is grown if the source directory
+    # needs more blocks or inodes, and rsync copies only the files that changed (size or modification time), deleting
+    # the removed ones first. Hard links are preserved.
+    def update(self, srcdir, imagename, oldname):
+
+        print(" --- copying " + oldname + " to " + imagename)
+        run_build_command(["cp", "--sparse=always", oldname, imagename])
+
+        size, inodes = get_image_size(srcdir, reserved=0, journal=False, extra_size=ext4_extra_size)
+        grow_fs(imagename, size, inodes)
+        self.rsync(srcdir, imagename, ["-H", "--delete-before", "--inplace"])
+
+        if ext4_shrink > 0:
+            shrink_fs(imagename)
+
+    # internal - copy the source directory into the image through a loop mount
+    def rsync(self, srcdir, imagename, options=[]):
+
+        # mount the image in a temporary place
+        tempdir = tempfile.mkdtemp()
+        cmd = ['/bin/mount', '-o', 'loop,rw', imagename, tempdir]
+        p1 = subprocess.Popen(cmd)
+        p1.wait()
+        if p1.returncode:
+            os.rmdir(tempdir)
+            raise ModuleException("mount failed with " + str(p1.returncode))
+
+        # rsync - copy tree
+        image_ok = False
+        try:
+            print(" --- copy module files into the image using rsync")
+            cmd = ["rsync", "-av"] + options + [srcdir + "/", tempdir]
+            p1 = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+            for line in iter(p1.stdout.readline, b''):
+                sys.stdout.write(line.decode("utf-8"))
+
+            p1.wait()
+            if not p1.returncode:
+                print(" --- rsync completed with SUCCESS")
+                image_ok = True
+            else:
+                print(" --- rsync returned with " + str(p1.returncode))
+        except:
+            print(" --- trying to clean up...")
+
+        #  unmount the image, remove temporary directory
+        cmd = ['/bin/umount', tempdir]
+        p1 = subprocess.Popen(cmd)
+        p1.wait()
+        if p1.returncode:
+            print(" --- WARNING: image not unmounted and/or removed. Manual cleanup needed.")
+            raise ModuleException("umount failed with " + str(p1.returncode))
+        os.rmdir(tempdir)
+
+        if not image_ok:
+            raise ModuleException("copying the module files failed")
+
+
+class SquashfsFormat(object):
+
+    name = 'squashfs'
+    ext = '.squashfs'
+
+    def build(self, srcdir, imagename):
+        run_build_command(["mksquashfs", srcdir, imagename, "-noappend", "-no-progress"] + squashfs_options.split())
+
+
+class ErofsFormat(object):
+
+    name = 'erofs'
+    ext = '.erofs'
+
+    def build(self, srcdir, imagename):
+        run_build_command(["mkfs.erofs"] + erofs_options.split() + [imagename, srcdir])
+
+
+formats = dict((f.name, f) for f in [Ext4Format(), SquashfsFormat(), ErofsFormat()])
+
+# format of new images
+default_format = 'ext4'
+
+
+def get_image_format(name):
+    if name not in formats:
+        raise ModuleException("unknown image format " + name + ", use one of: " + ", ".join(sorted(formats)))
+    return formats[name]
+
+
+ext4_build = os.environ.get('SI_EXT4_BUILD', ext4_build)
+ext4_extra_size = int(os.environ.get('SI_EXT4_EXTRA_SIZE', ext4_extra_size))
+ext4_shrink = int(os.environ.get('SI_EXT4_SHRINK', ext4_shrink))
+squashfs_options = os.environ.get('SI_SQUASHFS_OPTIONS', squashfs_options)
+erofs_options = os.environ.get('SI_EROFS_OPTIONS', erofs_options)
+default_format = os.environ.get('SI_IMAGE_FORMAT', default_format)
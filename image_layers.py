@@ -0,0 +1,138 @@
+#!/usr/bin/env python2
+
+# Layered software images.
+#
+# create_software_image --base builds a module as a layer on top of the image of another module, e.g., gcc/9.4.0 on
+# gcc/9.3.0. The layer image holds only the entries that differ from the base, found by comparing the manifest of
+# the base image with the manifest of the module directory (see manifest.py), and overlay whiteouts for the entries
+# of the base that the module does not have. The stack file of the new image lists its lower images (see
+# get_image_stack in hpcmodules) with the identity of the image files, and mount_image mounts the stack as an overlay. The files shared with the base are
+# stored once, and a node that mounts several modules of the same base caches them once.
+#
+# Whiteouts are character devices 0/0, creating them needs root.
+
+import os
+import stat
+import shutil
+import hpcmodules
+from hpcmodules import ModuleException, get_stack_name, get_stack_identity, get_image_stack, stack_ext
+
+
+# internal - entries of the module that the layer must hold: new entries, entries of another type or mode, and files
+# and links with other contents. Directories of the base are merged with the layer.
+def get_layer_entries(base, manifest):
+    entries = []
+    for p in sorted(manifest.entries):
+        e = manifest.entries[p]
+        b = base.entries.get(p)
+        if b is None or b[0] != e[0] or b[1] != e[1] or (e[0] != 'd' and (b[2], b[4]) != (e[2], e[4])):
+            entries.append(p)
+    return entries
+
+
+# internal - entries of the base that the module does not have, and that are not hidden by their parent directory
+def get_whiteouts(base, manifest):
+    whiteouts = []
+    for p in sorted(base.entries):
+        if p in manifest.entries:
+            continue
+        parent = os.path.dirname(p)
+        if parent == '' or (parent in manifest.entries and manifest.entries[parent][0] == 'd'):
+            whiteouts.append(p)
+    return whiteouts
+
+
+# internal - copy ownership, mode and times of a source entry to a staged one
+def copy_attributes(src, dst, st):
+    if os.geteuid() == 0:
+        os.lchown(dst, st.st_uid, st.st_gid)
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+        os.utime(dst, (st.st_atime, st.st_mtime))
+
+
+# Stage the layer of the module directory srcdir on a base: a directory tree in stagedir with the entries that differ
+# from the base and the whiteouts, to build the layer image from. Files are hard linked from srcdir if possible,
+# copied otherwise. base and manifest are the manifests of the base image and of srcdir.
+# Returns the number of entries and whiteouts, and the bytes of the files in the layer.
+def make_layer(srcdir, stagedir, base, manifest):
+
+    entries = get_layer_entries(base, manifest)
+    whiteouts = get_whiteouts(base, manifest)
+    if len(whiteouts) and os.geteuid() != 0:
+        raise ModuleException(str(len(whiteouts)) + " entries of the base are removed in " + srcdir + ", creating overlay whiteouts needs root")
+
+    dirs = set([''])
+
+    # parents of an entry that are not in the layer themselves take the attributes of the module directories
+    def make_parents(p):
+        parent = os.path.dirname(p)
+        if parent in dirs:
+            return
+        make_parents(parent)
+        os.mkdir(os.path.join(stagedir, parent))
+        dirs.add(parent)
+
+    nbytes = 0
+    for p in entries:
+        src = os.path.join(srcdir, p)
+        dst = os.path.join(stagedir, p)
+        st = os.lstat(src)
+        make_parents(p)
+        if stat.S_ISDIR(st.st_mode):
+            if p not in dirs:
+                os.mkdir(dst)
+                dirs.add(p)
+        elif stat.S_ISREG(st.st_mode):
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+                copy_attributes(src, dst, st)
+            nbytes += st.st_size
+        elif stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), dst)
+            copy_attributes(src, dst, st)
+        else:
+            os.mknod(dst, st.st_mode, st.st_rdev)
+            copy_attributes(src, dst, st)
+
+    for p in whiteouts:
+        make_parents(p)
+        os.mknod(os.path.join(stagedir, p), stat.S_IFCHR | 0o600, os.makedev(0, 0))
+
+    # directories last, deepest first: creating entries changes their times
+    for p in sorted(dirs, key=lambda d: -d.count('/') - (d != '')):
+        copy_attributes(os.path.join(srcdir, p), os.path.join(stagedir, p), os.lstat(os.path.join(srcdir, p)))
+
+    return len(entries), len(whiteouts), nbytes
+
+
+# Write the stack file of an image: its lower images, bottom first, and the identity of their image files. stats are
+# the os.stat results of the lower images taken before the manifest of the base was read [default: now].
+def write_stack(imagename, lowers, stats=None):
+    if stats is None:
+        stats = [os.stat(lower) for lower in lowers]
+    stackname = get_stack_name(imagename)
+    tmp = os.path.join(os.path.dirname(stackname), "." + os.path.basename(stackname) + ".tmp")
+    with open(tmp, 'w') as f:
+        for (lower, st) in zip(lowers, stats):
+            f.write(os.path.relpath(lower, hpcmodules.image_path) + "\t" + get_stack_identity(st) + "\n")
+    os.rename(tmp, stackname)
+
+
+# Software images stacked on an image, i.e., that have it as a lower image. User images are not found.
+def get_stacked_images(imagename):
+    stacked = []
+    for (dirpath, dirnames, filenames) in os.walk(hpcmodules.image_path):
+        for f in filenames:
+            if not f.endswith(stack_ext):
+                continue
+            image = os.path.join(dirpath, f[:-len(stack_ext)])
+            try:
+                if imagename in get_image_stack(image, check=False):
+                    stacked.append(image)
+            except ModuleException:
+                # a broken stack does not mount anyway
+                pass
+    return sorted(stacked)
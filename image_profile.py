@@ -0,0 +1,214 @@
+#!/usr/bin/env python2
+
+# Hot block lists of software images.
+#
+# A large application started from a freshly mounted image reads a small part of the image, mostly in the same order
+# on every start, one demand-paged request at a time. mount_image --profile <seconds> records the blocks of the image
+# read in the first seconds after the mount: the image is attached to a buffered loop device, its pages are dropped
+# from the page cache before the mount, and a recorder samples which pages of the image file are in the page cache
+# (mincore) until the time is up. The pages in order of first access are stored in <image>.hot, next to the image.
+#
+# Later mounts of the image replay the list: the hot blocks are read ahead in large sorted batches with
+# posix_fadvise(POSIX_FADV_WILLNEED) right after the mount. Images with a hot list are attached to buffered loop
+# devices, so that the pages read ahead are used. A hot list is used as long as the size and mtime of the image
+# match, a rebuilt image must be profiled again. SI_HOT_REPLAY=0 disables the replay.
+#
+#   mount_image --profile 60 matlab/R2020a      # as root, on an otherwise idle node
+#   image_profile --show matlab/R2020a
+#   image_profile --remove matlab/R2020a
+
+import os
+import re
+import sys
+import time
+import mmap
+import ctypes
+import argparse
+import subprocess
+from hpcmodules import *
+from stage_images import fadvise, POSIX_FADV_WILLNEED, POSIX_FADV_DONTNEED
+from filefs import MB
+
+# seconds between two samples of the page cache
+hot_interval = 1
+
+# extents closer than this are read in one request [KB]
+hot_gap_kb = 128
+
+# at most this many bytes are read ahead in one request [MB]
+hot_batch_mb = 16
+
+hot_ext = ".hot"
+
+PROT_READ = 1
+MAP_SHARED = 1
+
+libc = ctypes.CDLL(None, use_errno=True)
+libc.mmap.restype = ctypes.c_void_p
+libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+
+
+def get_hot_name(imagename):
+    return imagename + hot_ext
+
+
+# Pages of a file that are in the page cache: a string with one byte per page, non-zero if the page is cached
+def get_cached_pages(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if size == 0:
+            return ""
+        addr = libc.mmap(None, size, PROT_READ, MAP_SHARED, fd, 0)
+        if addr is None or addr == ctypes.c_void_p(-1).value:
+            raise OSError(ctypes.get_errno(), "mmap of " + filename + " failed")
+        try:
+            npages = (size + mmap.PAGESIZE - 1) / mmap.PAGESIZE
+            vec = ctypes.create_string_buffer(npages)
+            if libc.mincore(addr, size, vec) != 0:
+                raise OSError(ctypes.get_errno(), "mincore of " + filename + " failed")
+            return vec.raw[:npages]
+        finally:
+            libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+
+
+# Drop the pages of a file from the page cache. Pages of mapped or mounted files can stay.
+def drop_cached_pages(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+# Sample the page cache of filename, a copy of imagename or the image itself, for seconds. Returns the extents
+# of pages that became cached, in order of first access: a list of (offset, length) in bytes.
+def record_hot_blocks(filename, seconds, interval=None):
+    if interval is None:
+        interval = hot_interval
+    seen = None
+    extents = []
+    end = time.time() + seconds
+    while True:
+        pages = get_cached_pages(filename)
+        if seen is None:
+            seen = bytearray(len(pages))
+
+        # new pages: cached now, not seen before
+        for run in re.finditer(r'[^\x00]+', pages):
+            for new in re.finditer(r'\x00+', str(seen[run.start():run.end()])):
+                start = run.start() + new.start()
+                extents.append((start * mmap.PAGESIZE, (new.end() - new.start()) * mmap.PAGESIZE))
+            seen[run.start():run.end()] = "\x01" * (run.end() - run.start())
+
+        if time.time() >= end:
+            return extents
+        time.sleep(min(interval, max(0, end - time.time())))
+
+
+# Write the hot list of an image: the size and mtime of the image, then the extents
+def write_hot_list(imagename, extents):
+    st = os.stat(imagename)
+    hotname = get_hot_name(imagename)
+    tmp = join(os.path.dirname(hotname), "." + os.path.basename(hotname) + ".tmp")
+    with open(tmp, 'w') as f:
+        f.write("%d %r\n" % (st.st_size, st.st_mtime))
+        for (offset, length) in extents:
+            f.write("%d %d\n" % (offset, length))
+    os.rename(tmp, hotname)
+
+
+# The hot list of an image, a list of (offset, length) in order of first access. None if the image has no hot list,
+# or the image has changed since it was profiled.
+def read_hot_list(imagename):
+    try:
+        with open(get_hot_name(imagename), 'r') as f:
+            lines = f.readlines()
+    except IOError:
+        return None
+    st = os.stat(imagename)
+    if not len(lines) or lines[0].split() != ("%d %r" % (st.st_size, st.st_mtime)).split():
+        return None
+    return [tuple(int(v) for v in l.split()) for l in lines[1:] if len(l.split()) == 2]
+
+
+# Sort and merge extents: extents less than hot_gap_kb apart are merged, merged extents are at most hot_batch_mb
+def get_batches(extents):
+    batches = []
+    for (offset, length) in sorted(extents):
+        if len(batches):
+            (o, l) = batches[-1]
+            if offset <= o + l + hot_gap_kb * 1024 and offset + length - o <= hot_batch_mb * MB:
+                batches[-1] = (o, max(l, offset + length - o))
+                continue
+        batches.append((offset, length))
+    return batches
+
+
+# Read the hot blocks of an image ahead, from filename, the image or its copy. Returns the number of bytes.
+def replay_hot_list(filename, extents):
+    nbytes = 0
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        for (offset, length) in get_batches(extents):
+            if not fadvise(fd, offset, length, POSIX_FADV_WILLNEED):
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.read(fd, length)
+            nbytes += length
+    finally:
+        os.close(fd)
+    return nbytes
+
+
+# Start the recorder of an image mounted from filename in the background, it writes the hot list after seconds
+def start_profile(imagename, filename, seconds):
+    with open(os.devnull, 'r+') as null:
+        subprocess.Popen([sys.executable, join(os.path.dirname(os.path.abspath(__file__)), "image_profile.py"),
+                          "--record", filename, "--seconds", str(seconds), imagename],
+                         stdin=null, stdout=null, stderr=null, close_fds=True, preexec_fn=os.setsid)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Show or remove the hot block lists of software images, see mount_image --profile.")
+    parser.add_argument("image_name", help="name of the software module, or the image")
+    parser.add_argument("--show", help="show the hot list", action='store_true')
+    parser.add_argument("--remove", help="remove the hot list", action='store_true')
+    parser.add_argument("--record", help="record the hot list from the page cache of FILE, the mounted image or its copy (used by mount_image --profile)", metavar="FILE", default=None)
+    parser.add_argument("--seconds", help="seconds to record [default: %(default)s]", type=int, default=60)
+    args = parser.parse_args()
+
+    try:
+        imagename = args.image_name
+        if not os.path.isfile(imagename):
+            imagename = get_image_name(imagename)
+        if not os.path.isfile(imagename):
+            raise ModuleException("image file " + imagename + " does not exist")
+
+        if args.record is not None:
+            write_hot_list(imagename, record_hot_blocks(args.record, args.seconds))
+
+        if args.remove:
+            try:
+                os.remove(get_hot_name(imagename))
+            except OSError:
+                pass
+
+        if args.show:
+            extents = read_hot_list(imagename)
+            if extents is None:
+                print(" --- " + imagename + " has no current hot list")
+            else:
+                nbytes = sum([l for (o, l) in extents])
+                batches = get_batches(extents)
+                print(" --- " + imagename + ": %d extents, %.1f MB (%.1f%% of the image), replayed in %d requests, %.1f MB" %
+                      (len(extents), nbytes / float(MB), 100.0 * nbytes / max(1, os.stat(imagename).st_size), len(batches), sum([l for (o, l) in batches]) / float(MB)))
+
+    except ModuleException:
+        print(str(sys.exc_info()[1]))
+        exit(1)
+    # other exceptions run through
@@ -2,39 +2,50 @@
 
 import argparse
 import sys
+import time
 from hpcmodules import *
+from daemon_client import daemon_request
 
 
-if __name__ == '__main__':
-
-    parser = argparse.ArgumentParser(description="List all mounted images, or list images loaded by a certain job.")
-    parser.add_argument("--job_id", help="job identifier", default="ALL")
-    parser.add_argument("--unreported", help="only show mounted images that are not reported in " + local_lock_path + "/*modules", action='store_true')
-    args = parser.parse_args()
+# Print information about mounted images. Returns True on success.
+def list_images(job_id="ALL", unreported=False):
 
-    if args.unreported:
-        if args.job_id != 'ALL':
+    if unreported:
+        if job_id != 'ALL':
             print(" --- WARNING: job_id ignored when using --unreported.")
 
         # look at the used loop devices
         loopdevs = list_loopdevs()
 
-        # get all mounted images
+        # get all mounted images, and the idle ones: kept mounted on purpose, see idle_grace
         images = get_mounted_images()
+        idle = [i[0] for i in get_idle_images()]
 
         cnt = 0
         for (img, mnt, loopdev) in iter(images):
 
             # check if used by a job
-            usage = get_image_usage(img)
-            if usage == 0:
+            usage = get_image_usage(img, layers=False)
+            if usage == 0 and img not in idle:
                 print(img + " is mounted but not used.")
                 cnt += 1
 
-            # remove loop device from list of used devices
-            idx = [i for i, loop in enumerate(loopdevs) if loop[0] == loopdev]
-            idx = idx[0]
-            loopdevs = loopdevs[:idx] + loopdevs[idx+1:]
+            # remove loop device from list of used devices (overlays of stacked images have none)
+            if loopdev is not None:
+                idx = [i for i, loop in enumerate(loopdevs) if loop[0] == loopdev]
+                idx = idx[0]
+                loopdevs = loopdevs[:idx] + loopdevs[idx+1:]
+
+        # layers that no stacked image uses
+        used = set(d for (m, dirs) in get_stack_mounts() for d in dirs)
+        for m in get_layer_mounts().values():
+            if m.mntpoint not in used:
+                print(m.source + " is mounted as a layer at " + m.mntpoint + " but not used.")
+                cnt += 1
+
+        # idle pool loop devices and the layers of stacked images are not blocked
+        pool = [d for (d, i) in get_pool_loopdevs()] + get_layer_loopdevs()
+        loopdevs = [l for l in loopdevs if l[0] not in pool]
 
         # remaining loop devices are blocked / used by not our images
         for l in range(0, len(loopdevs)):
@@ -44,10 +55,10 @@ if __name__ == '__main__':
         if cnt == 0:
             print("No unreported images.")
 
-        exit(0)
+        return True
 
     # admin mode: list all images mounted on the compute node
-    if args.job_id == "ALL":
+    if job_id == "ALL":
 
         # a list of used loop devices and images names
         loopdevs = list_loopdevs()
@@ -58,15 +69,42 @@ if __name__ == '__main__':
 
         # list mounted images
         images = get_mounted_images()
+        stacks = get_mounted_stacks()
+        idle = dict((i[0], i[2]) for i in get_idle_images())
         print(" --- mounted software images:")
         for (img, mnt, loopdev) in iter(images):
-            print(img + " mounted at " + mnt)
-        exit(0)
+            if loopdev is None:
+                info = "  overlay of " + str(len(stacks.get(img, [])) + 1) + " layers"
+            else:
+                info = "  direct I/O: " + ("yes" if has_direct_io(loopdev) else "no")
+            if img in idle:
+                info += "  idle for %d s" % (time.time() - idle[img])
+            print(img + " mounted at " + mnt + info)
+
+        # layers of stacked images, shared by the stacks: number of stacks and of jobs that use them
+        layers = get_layer_mounts()
+        if len(layers):
+            print("")
+            print(" --- layers of stacked images:")
+            for mntpoint in sorted(layers):
+                img = layers[mntpoint].source
+                nstacks = len([s for s in stacks if s == img or img in stacks[s]])
+                print(img + " at " + mntpoint + "  used by " + str(nstacks) + " stacks, " + str(get_image_usage(img)) + " jobs")
+
+        # pool loop devices
+        mounted = [loopdev for (img, mnt, loopdev) in images]
+        pool = get_pool_loopdevs()
+        if len(pool):
+            print("")
+            print(" --- pool loop devices:")
+            for (loopdev, img) in pool:
+                print(loopdev + " " + img + (" (mounted)" if loopdev in mounted else " (idle)"))
+        return True
 
     # job-specific operations: list images loaded by that job
     try:
-        print(" --- images used by job " + args.job_id)
-        images = get_image_list(args.job_id)
+        print(" --- images used by job " + job_id)
+        images = get_image_list(job_id)
         for m in images:
             if is_image_mounted(m):
                 suffix = " (mounted)"
@@ -75,5 +113,22 @@ if __name__ == '__main__':
             print(m+suffix)
     except ModuleException:
         print(str(sys.exc_info()[1]))
+        return False
+
+    return True
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="List all mounted images, or list images loaded by a certain job.")
+    parser.add_argument("--job_id", help="job identifier", default="ALL")
+    parser.add_argument("--unreported", help="only show mounted images that are not reported in " + local_lock_path + "/*modules", action='store_true')
+    args = parser.parse_args()
+
+    # ask the image daemon, if it is running
+    ok = daemon_request({'op': 'list', 'job_id': args.job_id, 'unreported': args.unreported})
+    if ok is None:
+        ok = list_images(args.job_id, args.unreported)
+
+    if not ok:
         exit(1)
-    # other exceptions run through
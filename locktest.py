@@ -9,12 +9,14 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Test parallel fs locks.")
     parser.add_argument("fname", help="file name to lock")
     parser.add_argument("--rw", help="rw lock", action='store_true')
+    parser.add_argument("--timeout", help="lock timeout [s]", type=int, default=5)
     args = parser.parse_args()
 
     print("locking...")
-    with fs_lock_file(args.fname, args.rw) as fd:
+    stats = {}
+    with fs_lock_file(args.fname, args.rw, args.timeout, stats) as fd:
     #with local_lock_images() as lock:
-        print("done!")
+        print("done! strategy " + stats['strategy'] + ", " + str(stats['attempts']) + " attempts, waited %.3fs" % stats['wait'])
         while True:
             time.sleep(1)
             print(".")
@@ -0,0 +1,40 @@
+#!/usr/bin/env python2
+
+# Loop device pool of the compute node, see trim_loop_pool in hpcmodules.
+#
+# Without options the pool devices are listed. --warm attaches the most used software images ahead of the jobs
+# (e.g., from the node health check, or after a reboot), --trim detaches idle devices above the pool size.
+
+import sys
+import argparse
+import hpcmodules
+from hpcmodules import *
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="List, warm up, or trim the pool of loop devices attached to software images.")
+    parser.add_argument("--warm", help="attach the most used images that have no pool device", action='store_true')
+    parser.add_argument("--trim", help="detach idle pool devices above the pool size", action='store_true')
+    parser.add_argument("--size", help="pool size [default: %(default)s, SI_LOOP_POOL_SIZE]", type=int, default=hpcmodules.loop_pool_size)
+    args = parser.parse_args()
+
+    try:
+        with local_lock_images() as lock:
+            if args.trim:
+                for (loopdev, imagename) in trim_loop_pool(args.size):
+                    print(" --- detached " + loopdev + " " + imagename)
+            if args.warm:
+                for (loopdev, imagename) in warm_loop_pool(args.size):
+                    print(" --- attached " + loopdev + " " + imagename)
+
+            uses = dict((i, n) for (i, n, last_used) in get_usage_history())
+            table = get_mount_table()
+            for (loopdev, imagename) in get_pool_loopdevs():
+                state = "idle" if table.find_loopdev(loopdev) is None else "mounted"
+                print(loopdev + " " + imagename + " (" + state + ", used by " + str(uses.get(imagename, 0)) + " jobs)")
+
+    except ModuleException:
+        print(str(sys.exc_info()[1]))
+        exit(1)
+    # other exceptions run through
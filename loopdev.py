@@ -0,0 +1,153 @@
+#!/usr/bin/env python2
+
+# Loop device primitives.
+#
+# Image files are attached to loop devices with the loop ioctls: a free device is allocated through /dev/loop-control
+# (LOOP_CTL_GET_FREE), the image is attached with LOOP_SET_FD and configured with LOOP_SET_STATUS64. This replaces
+# losetup and mount -o loop, and lets the caller choose the flags of the device (e.g., no autoclear for devices
+# that stay attached after unmount, see the loop device pool in hpcmodules).
+
+import os
+import re
+import errno
+import fcntl
+import struct
+import mounttable
+from mounttable import get_loop_backing_file
+
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_GET_STATUS64 = 0x4C05
+LOOP_SET_DIRECT_IO = 0x4C08
+LOOP_CTL_GET_FREE = 0x4C82
+
+LO_FLAGS_READ_ONLY = 1
+LO_FLAGS_AUTOCLEAR = 4
+LO_FLAGS_DIRECT_IO = 16
+
+LO_NAME_SIZE = 64
+
+# struct loop_info64
+loop_info64 = struct.Struct("=QQQQQIIII64s64s32sQQ")
+
+loop_control = "/dev/loop-control"
+
+
+# Status of an attached loop device: a dictionary with the device and inode of the backing file, and the flags.
+# Raises IOError (ENXIO) if the device is not attached.
+def get_loop_status(loopdev):
+    fd = os.open(loopdev, os.O_RDONLY)
+    try:
+        buf = fcntl.ioctl(fd, LOOP_GET_STATUS64, "\0" * loop_info64.size)
+    finally:
+        os.close(fd)
+    fields = loop_info64.unpack(buf)
+    return {'device': fields[0], 'inode': fields[1], 'flags': fields[8], 'file_name': fields[9].rstrip("\0")}
+
+
+# Attach an image file to a free loop device. Returns the device name and an open file descriptor of the device.
+# With autoclear the device is detached when it is no longer used, i.e., after unmount: the caller must keep the
+# file descriptor open until the device is mounted, and close it afterwards.
+# With direct_io the device reads the image file with O_DIRECT, so that the blocks of the image are not cached a
+# second time below the file system of the image. If the file system of the image file does not support it, the
+# device falls back to buffered I/O.
+def attach_loopdev(imagename, read_only=True, autoclear=True, direct_io=False):
+
+    mode = os.O_RDONLY if read_only else os.O_RDWR
+    ffd = os.open(imagename, mode)
+    try:
+        ctl = os.open(loop_control, os.O_RDWR)
+        try:
+            # another process can take the free device before us
+            for attempt in range(16):
+                loopdev = "/dev/loop%d" % fcntl.ioctl(ctl, LOOP_CTL_GET_FREE)
+                lfd = os.open(loopdev, mode)
+                try:
+                    fcntl.ioctl(lfd, LOOP_SET_FD, ffd)
+                except IOError as err:
+                    os.close(lfd)
+                    if err.errno == errno.EBUSY:
+                        continue
+                    raise
+
+                flags = 0
+                if read_only:
+                    flags |= LO_FLAGS_READ_ONLY
+                if autoclear:
+                    flags |= LO_FLAGS_AUTOCLEAR
+                info = loop_info64.pack(0, 0, 0, 0, 0, 0, 0, 0, flags, imagename[:LO_NAME_SIZE - 1], "", "", 0, 0)
+                try:
+                    fcntl.ioctl(lfd, LOOP_SET_STATUS64, info)
+                except:
+                    fcntl.ioctl(lfd, LOOP_CLR_FD, 0)
+                    os.close(lfd)
+                    raise
+
+                if direct_io:
+                    try:
+                        fcntl.ioctl(lfd, LOOP_SET_DIRECT_IO, 1)
+                    except IOError:
+                        # not supported, buffered I/O
+                        pass
+                return loopdev, lfd
+
+            raise IOError(errno.EBUSY, "no free loop device")
+        finally:
+            os.close(ctl)
+    finally:
+        os.close(ffd)
+
+
+# internal - a flag of an attached loop device from /sys/block/loopN/loop/<name>, which can be read without access to
+# the device. None if the kernel does not report the flag.
+def get_loop_flag(loopdev, name):
+    try:
+        with open(os.path.join(mounttable.sys_block_path, os.path.basename(loopdev), "loop", name), 'r') as fd:
+            return fd.read().strip() == "1"
+    except (IOError, OSError):
+        return None
+
+
+# internal - a flag of an attached loop device, from sysfs, or from the device status on older kernels.
+# default if neither can be read.
+def has_loop_flag(loopdev, name, flag, default=False):
+    value = get_loop_flag(loopdev, name)
+    if value is not None:
+        return value
+    try:
+        return (get_loop_status(loopdev)['flags'] & flag) != 0
+    except (IOError, OSError):
+        return default
+
+
+# does the loop device use direct I/O
+def has_direct_io(loopdev):
+    return has_loop_flag(loopdev, "dio", LO_FLAGS_DIRECT_IO)
+
+
+# is the loop device detached when its last user is gone. A device of unknown state is not taken for a pool device.
+def has_autoclear(loopdev):
+    return has_loop_flag(loopdev, "autoclear", LO_FLAGS_AUTOCLEAR, True)
+
+
+# Detach a loop device. A device that is still in use is detached by the kernel after the last user is gone.
+def detach_loopdev(loopdev):
+    fd = os.open(loopdev, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, LOOP_CLR_FD, 0)
+    finally:
+        os.close(fd)
+
+
+# all attached loop devices: a list of (loop device, backing file) tuples
+def list_attached_loopdevs():
+    loopdevs = []
+    for name in sorted(os.listdir(mounttable.sys_block_path), key=lambda n: (len(n), n)):
+        if not re.match(r'^loop[0-9]+$', name):
+            continue
+        backing = get_loop_backing_file("/dev/" + name)
+        if backing is not None:
+            loopdevs.append(("/dev/" + name, backing))
+    return loopdevs
+
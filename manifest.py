@@ -0,0 +1,220 @@
+#!/usr/bin/env python2
+
+# Image manifests.
+#
+# create_software_image writes a manifest of the source directory next to every image: <image>.manifest, e.g.,
+# /cluster/software/IMAGES/gcc/9.3.0.ext4.manifest. It is a gzip'ed text file with one line per file, directory and
+# symbolic link:
+#
+#   <type> <mode> <size> <mtime> <hash> <path>
+#
+# type is f (file), d (directory), l (symbolic link) or o (other), mode is octal, mtime in seconds, and path relative
+# to the top directory, with backslash and newline escaped. The hash of a file is the sha256 of its contents, of a
+# symbolic link the sha256 of its target. The hash of a directory is the sha256 of the names, types, modes and hashes
+# of its entries: the hash of the top directory (the root line of the header) is a Merkle root of the whole tree.
+#
+# lost+found in the top directory is not part of a manifest: mkfs creates it in ext4 images.
+#
+# A quick manifest has no hashes (-), only the metadata: it is compared by type, mode, size and mtime, as rsync does.
+
+import os
+import sys
+import stat
+import gzip
+import hashlib
+from hpcmodules import ModuleException, run_parallel
+from get_dir_size import list_dir, scan_workers
+
+manifest_ext = ".manifest"
+
+# manifest format version
+manifest_version = "1"
+
+
+class Manifest(object):
+
+    def __init__(self, source=None):
+        self.source = source
+        self.root = '-'
+        self.entries = {}  # path: (type, mode, size, mtime, hash)
+
+
+# name of the manifest of an image file
+def get_manifest_name(imagename):
+    return imagename + manifest_ext
+
+
+# internal - escape backslash and newline in a path
+def escape_path(path):
+    return path.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def unescape_path(path):
+    out = []
+    i = 0
+    while i < len(path):
+        if path[i] == "\\" and i + 1 < len(path):
+            out.append("\n" if path[i + 1] == "n" else path[i + 1])
+            i += 2
+        else:
+            out.append(path[i])
+            i += 1
+    return "".join(out)
+
+
+# internal - sha256 of the contents of a file
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(1024*1024)
+            if not len(buf):
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+# Compute the manifest of a directory tree. The files are hashed by workers threads (hashlib releases the GIL on
+# large buffers, and the reads wait for the file system). With quick, nothing is hashed.
+def compute_manifest(top, workers=None, quick=False):
+
+    if workers is None:
+        workers = scan_workers
+    top = os.path.abspath(top)
+    manifest = Manifest(top)
+    entries = manifest.entries
+
+    # metadata, and the entries of every directory
+    children = {'': []}
+    files = []
+    stack = ['']
+    while len(stack):
+        rel = stack.pop()
+        try:
+            listing = list_dir(os.path.join(top, rel))
+        except OSError as err:
+            raise ModuleException("cannot list " + os.path.join(top, rel) + ": " + str(err))
+        for (name, path, st) in listing:
+            # created by mkfs in ext4 images
+            if rel == '' and name == 'lost+found':
+                continue
+            p = os.path.join(rel, name)
+            children[rel].append(p)
+            mode = stat.S_IMODE(st.st_mode)
+            if stat.S_ISDIR(st.st_mode):
+                entries[p] = ['d', mode, 0, int(st.st_mtime), '-']
+                children[p] = []
+                stack.append(p)
+            elif stat.S_ISREG(st.st_mode):
+                entries[p] = ['f', mode, st.st_size, int(st.st_mtime), '-']
+                files.append((p, (st.st_dev, st.st_ino)))
+            elif stat.S_ISLNK(st.st_mode):
+                target = os.readlink(path)
+                entries[p] = ['l', mode, len(target), int(st.st_mtime), '-' if quick else hashlib.sha256(target).hexdigest()]
+            else:
+                entries[p] = ['o', mode, 0, int(st.st_mtime), '-']
+
+    if not quick:
+        # hard linked files are hashed once
+        hashes = {}
+        inodes = {}
+        for (p, key) in files:
+            inodes.setdefault(key, p)
+        todo = list(inodes.items())
+        results = run_parallel(hash_file, [(os.path.join(top, p),) for (key, p) in todo], workers)
+        errors = []
+        for (key, p), (h, err, elapsed) in zip(todo, results):
+            if err is None:
+                hashes[key] = h
+            elif isinstance(err, (IOError, OSError)):
+                errors.append(p + ": " + str(err))
+            else:
+                raise err
+        if len(errors):
+            raise ModuleException("cannot hash " + ", ".join(errors))
+
+        for (p, key) in files:
+            entries[p][4] = hashes[key]
+
+        # directory hashes, deepest directories first
+        for rel in sorted(children, key=lambda d: -d.count('/') - (d != '')):
+            h = hashlib.sha256()
+            for p in sorted(children[rel]):
+                e = entries[p]
+                h.update("%s\0%s\0%o\0%s\n" % (os.path.basename(p), e[0], e[1], e[4]))
+            if rel == '':
+                manifest.root = h.hexdigest()
+            else:
+                entries[rel][4] = h.hexdigest()
+
+    for p in entries:
+        entries[p] = tuple(entries[p])
+    return manifest
+
+
+# Write a manifest file, atomically
+def write_manifest(filename, manifest):
+    tmp = os.path.join(os.path.dirname(filename), "." + os.path.basename(filename) + ".tmp")
+    f = gzip.open(tmp, 'wb')
+    try:
+        f.write("# software_images manifest " + manifest_version + "\n")
+        f.write("# source " + escape_path(manifest.source) + "\n")
+        f.write("# root " + manifest.root + "\n")
+        for p in sorted(manifest.entries):
+            e = manifest.entries[p]
+            f.write("%s %o %d %d %s %s\n" % (e[0], e[1], e[2], e[3], e[4], escape_path(p)))
+    finally:
+        f.close()
+    os.rename(tmp, filename)
+
+
+def read_manifest(filename):
+    manifest = Manifest()
+    try:
+        f = gzip.open(filename, 'rb')
+        try:
+            lines = f.read().split("\n")
+        finally:
+            f.close()
+    except (IOError, OSError):
+        raise ModuleException("cannot read manifest " + filename + ": " + str(sys.exc_info()[1]))
+
+    if not lines[0].startswith("# software_images manifest "):
+        raise ModuleException(filename + " is not an image manifest")
+    for line in lines[1:]:
+        if not len(line):
+            continue
+        if line.startswith("# source "):
+            manifest.source = unescape_path(line[len("# source "):])
+        elif line.startswith("# root "):
+            manifest.root = line[len("# root "):]
+        else:
+            fields = line.split(" ", 5)
+            if len(fields) != 6:
+                raise ModuleException("damaged manifest " + filename + ": " + line)
+            manifest.entries[unescape_path(fields[5])] = (fields[0], int(fields[1], 8), int(fields[2]), int(fields[3]), fields[4])
+    return manifest
+
+
+# Differences between two manifests: a sorted list of (path, what), what is 'added' (in new only), 'removed' (in old
+# only), or the list of fields that differ. With quick, files are compared by type, mode, size and mtime, otherwise by
+# type, mode, size and hash.
+def compare_manifests(old, new, quick=False):
+    fields = [0, 1, 2, 3] if quick else [0, 1, 2, 4]
+    names = ['type', 'mode', 'size', 'mtime', 'contents']
+    diffs = []
+    for p in sorted(set(old.entries) | set(new.entries)):
+        if p not in new.entries:
+            diffs.append((p, 'removed'))
+        elif p not in old.entries:
+            diffs.append((p, 'added'))
+        else:
+            o, n = old.entries[p], new.entries[p]
+            # directory sizes and mtimes, and the hashes of directories, follow their entries
+            if o[0] == 'd' and n[0] == 'd':
+                changed = [names[i] for i in [1] if o[i] != n[i]]
+            else:
+                changed = [names[i] for i in fields if o[i] != n[i]]
+            if len(changed):
+                diffs.append((p, ", ".join(changed)))
+    return diffs
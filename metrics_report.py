@@ -0,0 +1,131 @@
+#!/usr/bin/env python2
+
+# Percentiles of the metrics records emitted by the tools (see start_metrics in hpcmodules), per node or per image.
+#
+# Reads JSON records, one per line: metrics files (SI_METRICS_FILE) or syslog files, in which the record follows the
+# syslog header. Per node, the durations of the runs, of their phases, the lock waits and the number of subprocesses
+# are reported per tool. Per image, the durations of the phases of the image (global lock wait, mount, umount, ...)
+# and their sum are reported.
+#
+#   metrics_report /var/log/software_images_metrics.json
+#   grep software_images_metrics /var/log/messages | metrics_report --by image -
+
+import sys
+import json
+import math
+import time
+import argparse
+import hpcmodules
+from hpcmodules import ModuleException
+
+
+# Read the metrics records of files, - is stdin. Lines that hold no record are skipped.
+def read_records(filenames):
+    records = []
+    for filename in filenames:
+        try:
+            f = sys.stdin if filename == '-' else open(filename, 'r')
+        except IOError:
+            raise ModuleException("cannot read metrics " + filename + ": " + str(sys.exc_info()[1]))
+        for line in f:
+            idx = line.find('{')
+            if idx < 0:
+                continue
+            try:
+                rec = json.loads(line[idx:])
+            except ValueError:
+                continue
+            if isinstance(rec, dict) and 'tool' in rec:
+                records.append(rec)
+        if f is not sys.stdin:
+            f.close()
+    return records
+
+
+# p-th percentile of a list of values, nearest rank
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+# Values of the records per node: a dict (host, tool) -> metric -> list of values
+def get_node_values(records):
+    groups = {}
+    for rec in records:
+        g = groups.setdefault((rec.get('host', '?'), rec['tool']), {})
+        g.setdefault('elapsed', []).append(rec.get('elapsed', 0.0))
+        for (phase, seconds) in rec.get('phases', {}).items():
+            g.setdefault(phase, []).append(seconds)
+        for (kind, locks) in rec.get('locks', {}).items():
+            g.setdefault(kind + '_lock_wait', []).append(locks.get('wait', 0.0))
+            g.setdefault(kind + '_lock_retries', []).append(locks.get('retries', 0))
+        g.setdefault('subprocesses', []).append(rec.get('subprocesses', 0))
+    return groups
+
+
+# Values of the records per image: a dict (image, tool) -> metric -> list of values
+def get_image_values(records):
+    groups = {}
+    for rec in records:
+        images = dict(rec.get('images', {}))
+        if 'image' in rec:
+            images.setdefault(rec['image'], {})['elapsed'] = rec.get('elapsed', 0.0)
+        for (image, phases) in images.items():
+            g = groups.setdefault((image, rec['tool']), {})
+            for (phase, seconds) in phases.items():
+                g.setdefault(phase, []).append(seconds)
+            g.setdefault('total', []).append(sum(phases.values()))
+    return groups
+
+
+def print_report(groups, title):
+    print("%-50s %-20s %6s %8s %8s %8s %8s" % (title, "metric", "n", "p50", "p90", "p99", "max"))
+    for key in sorted(groups):
+        first = True
+        for metric in sorted(groups[key], key=lambda k: (k not in ['elapsed', 'total'], k)):
+            values = groups[key][metric]
+            name = " ".join(key) if first else ""
+            print("%-50s %-20s %6d %8.3f %8.3f %8.3f %8.3f" % (name, metric, len(values), percentile(values, 50),
+                                                               percentile(values, 90), percentile(values, 99), max(values)))
+            first = False
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Percentiles of the metrics records of the software image tools, per node or per image.")
+    parser.add_argument("file", help="metrics or syslog files, - for stdin [default: SI_METRICS_FILE]", nargs='*')
+    parser.add_argument("--by", help="group by node or image [default: %(default)s]", choices=['node', 'image'], default='node')
+    parser.add_argument("--tool", help="only records of this tool", default=None)
+    parser.add_argument("--host", help="only records of this node", default=None)
+    parser.add_argument("--since", help="only records of the last SINCE hours", type=float, default=None)
+    parser.add_argument("--failed", help="only failed runs", action='store_true')
+    args = parser.parse_args()
+
+    try:
+        files = args.file
+        if not len(files):
+            if not len(hpcmodules.metrics_file):
+                parser.error("no metrics files given, and SI_METRICS_FILE is not set")
+            files = [hpcmodules.metrics_file]
+
+        records = read_records(files)
+        if args.tool is not None:
+            records = [r for r in records if r['tool'] == args.tool]
+        if args.host is not None:
+            records = [r for r in records if r.get('host') == args.host]
+        if args.since is not None:
+            records = [r for r in records if r.get('start', 0) >= time.time() - args.since * 3600]
+        if args.failed:
+            records = [r for r in records if r.get('status') != 'ok']
+
+        if not len(records):
+            print(" --- no metrics records")
+        elif args.by == 'node':
+            print_report(get_node_values(records), "node, tool")
+        else:
+            print_report(get_image_values(records), "image, tool")
+
+    except ModuleException:
+        print(str(sys.exc_info()[1]))
+        exit(1)
+    # other exceptions run through
@@ -1,5 +1,8 @@
 NODES=c[1-18,31]-[1-36],c19-[1-20],c60-[1-8]
 
+echo "**************" moving host names from global lock files into holder records
+/cluster/bin/compact_image_locks
+
 echo "**************" unmounting images in global /cluster/software/IMAGES/
 lf=`find /cluster/software/IMAGES/ -name "*lock"`
 for f in $lf; do
@@ -3,7 +3,8 @@
 f=$1
 echo checking $f
 
-hns=`cat $f | uniq | sed -e 's/.local//' | sort`
+# hosts stored in the lock file (RW mounts, older versions), and RO holder markers in $f.d
+hns=`(cat $f | sed -e 's/^ rw //'; ls $f.d 2>/dev/null) | sed -e 's/.local//' | sort | uniq`
 if [[ "$hns" == "" ]]; then
     echo -- EMPTY $f
     exit 0
@@ -16,12 +17,17 @@ if [[ "$haveit" == "$hns" ]]; then
 fi
 
 # only save info about the mounted images
+lines=`cat $f`
 truncate --size=0 $f
 for h in $hns; do
-    res=`echo $haveit | grep $h`
+    res=`echo $haveit | grep -w $h`
     if [[ "$res" == "" ]]; then
 	echo removing spurious entry $h
+	rm -f $f.d/$h $f.d/$h.local
 	continue
     fi
-    echo $h.local >> $f
+    entry=`echo "$lines" | grep -w "$h\(.local\)\?$"`
+    if [[ "$entry" != "" ]]; then
+	echo "$entry" >> $f
+    fi
 done
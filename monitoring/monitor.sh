@@ -6,7 +6,8 @@ echo "**************" checking if images that have a .lock file are mounted on r
 # find /cluster/software/IMAGES/ -name "*lock" -exec cat {} \;
 lf=`find /cluster/software/IMAGES/ -name "*lock"`
 for f in $lf; do
-    hns=`cat $f | uniq | sed -e 's/.local//' | sort`
+    # hosts stored in the lock file (RW mounts, older versions), and RO holder markers in $f.d
+    hns=`(cat $f | sed -e 's/^ rw //'; ls $f.d 2>/dev/null) | sed -e 's/.local//' | sort | uniq`
     if [[ "$hns" == "" ]]; then
 	echo -- EMPTY $f
 	continue
@@ -19,7 +20,7 @@ for f in $lf; do
 	continue
     fi
     for h in $hns; do
-	res=`echo $haveit | grep $h`
+	res=`echo $haveit | grep -w $h`
 	if [[ "$res" == "" ]]; then
 	    echo $img not mounted on $h
 	fi
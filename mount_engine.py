@@ -0,0 +1,314 @@
+#!/usr/bin/env python2
+
+# Mount engine: runs the privileged per-image steps of a batch mount concurrently.
+#
+# The global cluster lock and the mount of one image are subprocess and syscall bound, so a batch of images is
+# processed by a bounded pool of threads. The node-local bookkeeping (mount table checks and the job .modules file)
+# stays serial in the caller, under local_lock_images().
+#
+# Backends implement the privileged steps:
+#   SystemBackend - global lock file, /bin/mount, per-job usage information
+#   DryRunBackend - records the calls in memory, used to test concurrency and ordering without root
+
+import sys
+import os
+import time
+import socket
+import threading
+import subprocess
+from subprocess import PIPE
+import pwd
+import hpcmodules
+from hpcmodules import *
+from image_cache import get_cached_image
+import image_profile
+
+# number of images mounted concurrently, can be overridden with SI_MOUNT_WORKERS
+default_workers = 8
+
+
+class SystemBackend(object):
+
+    dry_run = False
+
+    def is_mounted(self, imagename, mntpoint=None):
+        return is_image_mounted(imagename, mntpoint)
+
+    def add_usage(self, job_id, imagenames):
+        with metrics_phase('job_file'):
+            add_images_usage(job_id, imagenames)
+
+    def get_usage(self, imagename):
+        return get_image_usage(imagename)
+
+    # global cluster lock and mount of a single image
+    def mount(self, imagename, mntpoint, rw=False, job_id='NOJOBID'):
+
+        # the lower images of a stacked image, mounted as read-only layers below it
+        lowers = get_image_stack(imagename)
+        if len(lowers) and rw:
+            raise ModuleException("failed to mount " + imagename + ": a stacked image cannot be mounted in RW mode")
+
+        # next is the global cluster lock - keeps track of used images through a network file system lock file
+
+        # lock the image in desired mode:
+        #  RO: take a shared lock, check if the image is not already mounted in RW mode. If not, mount and add
+        #      an ro holder record for the host in <image>.lock.d
+        #  RW: take an exclusive lock, check if the image is not already mounted in any mode. If not, append
+        #      " rw "+hostname to lock file, mount and add an rw holder record
+        #
+        # To obtain an rw lock in fs_lock_file it is required that the lock file is empty, and that <image>.lock.d
+        # contains no holder records, i.e., no other host mounts that image.
+        # RO mounts of an image do not exclude each other, they only exclude RW mounts. After the lock is obtained,
+        # below we check if the file does not contain " rw ", i.e., the image is mounted in RW mode by someone.
+        with fs_lock_file(imagename + ".lock", rw, shared=not rw) as fd:
+
+            if rw:
+                # guaranteed that the lock file is empty
+                fd.writelines(" rw ")
+                fd.flush()
+            else:
+                # check if not already mounted in RW
+                data = fd.readline()
+                if len(data) >= 4 and (data[0:4] == " rw "):
+                    raise ModuleException("failed to mount " + imagename + ", it is already mounted in RW mode by another client: " + data[3:len(data)-1])
+
+            # do mount: a plain image, or the overlay of a stack
+            with metrics_phase('mount', imagename):
+                if len(lowers):
+                    returncode, stderrdata, log = mount_stack(imagename, lowers, mntpoint, job_id)
+                else:
+                    returncode, stderrdata, log = mount_loop(imagename, mntpoint, rw, job_id)
+
+            if not returncode:
+
+                # successfully mounted
+
+                # For RW mounts, change ownership of the mount point to allow the user to write
+                if rw:
+                    username = get_login_username()
+                    userinfo = pwd.getpwnam(username)
+                    os.chown(mntpoint, userinfo.pw_uid, userinfo.pw_gid)
+
+                # now need to mark the mount in the global database:
+                # add a holder record, and for RW mounts store host name in the lock file
+                try:
+                    if rw:
+                        fd.seek(0, os.SEEK_END)
+                        fd.write(socket.gethostname() + "\n")
+                        fd.flush()
+                        add_image_holder(imagename, socket.gethostname(), 'rw')
+                    else:
+                        add_image_holder(imagename, socket.gethostname(), 'ro')
+                except:
+
+                    # If the hostname store fails, the mount must be unmounted!
+                    print(log + " : FAILED - cannot write to " + imagename + ".lock. Image will be unmounted.")
+                    cmd = ["/bin/umount", mntpoint];
+                    p = subprocess.Popen(cmd, stderr=PIPE)
+                    stderrdata = p.communicate()[1]
+                    if not p.returncode:
+                        raise ModuleException("mount failed: unable to write to " + imagename + ".lock")
+                    else:
+                        raise ModuleException("failed to unmount " + mntpoint + " after failed write to " + imagename + ".lock: "+ stderrdata + ". Manual cleanup required!")
+
+                print(log + " : SUCCESS ")
+            else:
+                # release the RW claim
+                if rw:
+                    fd.truncate(0)
+                raise ModuleException("mount " + imagename + " on " + mntpoint + " failed: " + stderrdata)
+
+
+# Attach an image to a loop device and mount the device. RO mounts of software images use the copy of the image in
+# the image cache, and a pool loop device, if they are enabled. Returns the return code and error output of mount,
+# and a log message.
+def mount_loop(imagename, mntpoint, rw=False, job_id='NOJOBID'):
+
+    loopdev = None
+    lfd = None
+    pooled = not rw and hpcmodules.loop_pool_size > 0 and is_path_under(imagename, image_path)
+
+    # record the hot blocks of the image, or read them ahead after the mount. Both need a buffered loop device.
+    # A profile samples the image itself: the pages of a copy in an image cache on tmpfs cannot be dropped.
+    profile = 0
+    if not rw and is_path_under(imagename, image_path):
+        profile = getattr(caller, 'profile', 0)
+
+    filename = None
+    if not rw and profile <= 0:
+        filename = get_cached_image(imagename, fill=False, job_id=job_id)
+    if filename is None:
+        filename = imagename
+
+    hot = None
+    direct_io = None
+    if not rw and is_path_under(imagename, image_path):
+        if profile > 0:
+            image_profile.drop_cached_pages(filename)
+            direct_io = False
+        elif hpcmodules.hot_replay > 0:
+            hot = image_profile.read_hot_list(imagename)
+            if hot is not None:
+                direct_io = False
+
+    try:
+        try:
+            if pooled:
+                loopdev = get_pool_loopdev(imagename, filename, direct_io)
+            else:
+                loopdev, lfd = attach_image(filename, rw, direct_io=direct_io)
+        except (IOError, OSError):
+            if filename == imagename:
+                raise
+
+            # the copy is broken, use the image
+            print(job_id + " --- WARNING: cannot attach the cached copy " + filename + ": " + str(sys.exc_info()[1]))
+            filename = imagename
+            if pooled:
+                loopdev = get_pool_loopdev(imagename, direct_io=direct_io)
+            else:
+                loopdev, lfd = attach_image(imagename, rw, direct_io=direct_io)
+    except (IOError, OSError):
+        print(job_id + " --- WARNING: cannot attach " + filename + " to a loop device: " + str(sys.exc_info()[1]) + ", using mount -o loop")
+
+    if loopdev is not None:
+        cmd = ["/bin/mount", "-o", "nosuid,nodev", loopdev, mntpoint]
+    else:
+        cmd = ["/bin/mount", "-o", "loop,nosuid,nodev", filename, mntpoint]
+    log = job_id + " --- mounting " + imagename + " at " + mntpoint
+    if not rw:
+        cmd.append("-o")
+        cmd.append("ro")
+        log += " (RO)"
+        if filename != imagename:
+            log += " from the cached copy"
+    else:
+        log += " (RW)"
+    if loopdev is not None:
+        log += " using " + ("pool " if pooled else "") + "loop device " + loopdev
+        if has_direct_io(loopdev):
+            log += " (direct I/O)"
+
+    p = subprocess.Popen(cmd, stderr=PIPE)
+    stderrdata = p.communicate()[1]
+
+    # the mount holds the device now, or it is detached (autoclear)
+    if lfd is not None:
+        os.close(lfd)
+
+    if not p.returncode:
+        try:
+            if profile > 0:
+                image_profile.start_profile(imagename, filename, profile)
+                log += ", recording hot blocks for " + str(profile) + " s"
+            elif hot is not None:
+                log += ", read ahead %.1f MB of hot blocks" % (image_profile.replay_hot_list(filename, hot) / float(1024*1024))
+        except (IOError, OSError):
+            print(job_id + " --- WARNING: hot blocks of " + imagename + ": " + str(sys.exc_info()[1]))
+
+    return p.returncode, stderrdata, log
+
+
+# internal - mount an image of a stack read-only in its hidden directory, unless it is mounted there already, and add
+# an ro holder record for the host. Returns the mount point. The lock of the mount point serializes the stacks that
+# share the image, they can be mounted concurrently.
+def mount_layer(imagename, job_id='NOJOBID'):
+    mntpoint = get_layer_mount_point(imagename)
+    if ':' in mntpoint or ',' in mntpoint:
+        raise ModuleException("cannot use " + mntpoint + " as an overlay layer")
+    try:
+        os.makedirs(mntpoint)
+    except OSError:
+        if not os.path.isdir(mntpoint):
+            raise
+
+    with fs_lock_file(mntpoint + ".lock", False, timeout=60):
+        if get_mount_table().find_mntpoint(mntpoint) is not None:
+            print(job_id + " --- layer " + imagename + " is mounted at " + mntpoint)
+            return mntpoint
+
+        with fs_lock_file(imagename + ".lock", False, shared=True) as fd:
+            data = fd.readline()
+            if len(data) >= 4 and (data[0:4] == " rw "):
+                raise ModuleException("failed to mount " + imagename + ", it is already mounted in RW mode by another client: " + data[3:len(data)-1])
+
+            with metrics_phase('layer_mount', imagename):
+                returncode, stderrdata, log = mount_loop(imagename, mntpoint, False, job_id)
+            if returncode:
+                raise ModuleException("mount " + imagename + " on " + mntpoint + " failed: " + stderrdata)
+            print(log + " : SUCCESS ")
+            add_image_holder(imagename, socket.gethostname(), 'ro')
+
+    return mntpoint
+
+
+# Mount the images of a stack (lower images, bottom first, then the image itself) as shared layers, and their overlay
+# at mntpoint. Returns the return code and error output of the overlay mount, and a log message. Layers left unused
+# by a failed mount are unmounted by the next umount_layers.
+def mount_stack(imagename, lowers, mntpoint, job_id='NOJOBID'):
+
+    images = lowers + [imagename]
+    dirs = [mount_layer(img, job_id) for img in images]
+
+    # the top layer first
+    cmd = ["/bin/mount", "-t", "overlay", imagename, "-o", "ro,nosuid,nodev,lowerdir=" + ":".join(reversed(dirs)), mntpoint]
+    p = subprocess.Popen(cmd, stderr=PIPE)
+    stderrdata = p.communicate()[1]
+    if not p.returncode:
+        add_stack_layers(imagename, lowers)
+
+    log = job_id + " --- mounting " + imagename + " at " + mntpoint + " (RO) as an overlay of " + str(len(images)) + " images"
+    return p.returncode, stderrdata, log
+
+
+class DryRunBackend(object):
+
+    dry_run = True
+
+    def __init__(self, delay=0.1):
+        self.delay = delay
+        self.mounted = {}
+        self.usage = {}
+        self.events = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def _event(self, event, name):
+        with self._lock:
+            self.events.append((time.time(), event, name))
+
+    def is_mounted(self, imagename, mntpoint=None):
+        with self._lock:
+            if imagename not in self.mounted:
+                return False
+            return mntpoint is None or self.mounted[imagename] == os.path.realpath(mntpoint)
+
+    def add_usage(self, job_id, imagenames):
+        with self._lock:
+            self.usage.setdefault(job_id, []).extend(imagenames)
+        self._event('add_usage', job_id + ': ' + ' '.join(imagenames))
+
+    def get_usage(self, imagename):
+        with self._lock:
+            return len([j for j in self.usage if imagename in self.usage[j]])
+
+    # simulate the global lock and mount with a delay
+    def mount(self, imagename, mntpoint, rw=False, job_id='NOJOBID'):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        self._event('mount start', imagename)
+        time.sleep(self.delay)
+        with self._lock:
+            self.mounted[imagename] = os.path.realpath(mntpoint)
+            self.active -= 1
+        self._event('mount end', imagename)
+
+
+try:
+    default_workers = int(os.environ['SI_MOUNT_WORKERS'])
+except (KeyError, ValueError):
+    # not defined - use default
+    pass
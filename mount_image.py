@@ -2,17 +2,19 @@
 
 import sys
 import os
-import socket
 from stat import *
 import argparse
-import subprocess
-from subprocess import *
-import pwd
+import time
 import hpcmodules
 from hpcmodules import *
+import mount_engine
+from mount_engine import SystemBackend, DryRunBackend
+from image_cache import fill_cache
+from daemon_client import daemon_request, absolute_requests
 
 
-def mount_image(mntname, mntpoint=None, rw=False, job_id='NOJOBID'):
+# validate a mount request, return the image name, mount point and module name
+def check_mount_request(mntname, mntpoint=None, rw=False):
 
     # argument validation: image name / module name, and mount point
     imagename, mntpoint, modulename = validate_mount_arguments(mntname, mntpoint)
@@ -21,10 +23,6 @@ def mount_image(mntname, mntpoint=None, rw=False, job_id='NOJOBID'):
     if rw and modulename is not None:
         raise ModuleException('cannot mount a software module ' + modulename + ' in RW mode!')
 
-    # if a job file exists, make sure the calling user is the job owner
-    if not is_job_owner(job_id):
-        raise ModuleException(get_login_username() + ": you are not the job owner of job_id " + job_id)
-
     # make sure the image file is not a symlink
     mode = os.lstat(imagename)[ST_MODE]
     if S_ISLNK(mode):
@@ -35,110 +33,232 @@ def mount_image(mntname, mntpoint=None, rw=False, job_id='NOJOBID'):
     if S_ISLNK(mode):
         raise ModuleException("mount point " + mntpoint + " is a symbolic link, refusing to mount")
 
+    return imagename, mntpoint, modulename
+
+
+# Check that an image can be mounted at a mount point. Returns True if it is already mounted there.
+def check_mount_point(imagename, mntpoint, backend):
+
+    # make sure the destination directory is not a mount point,
+    # or that the same image is already mounted there.
+    already_mounted = backend.is_mounted(imagename, mntpoint)
+    if os.path.ismount(mntpoint) and not already_mounted:
+        raise ModuleException(mntpoint + " is already used as a mount point for a different image, refusing to mount")
+
+    return already_mounted
+
+
+# internal - --profile records the hot blocks of the images mounted by the request only
+def warn_not_profiled(imagename, job_id='NOJOBID'):
+    if getattr(caller, 'profile', 0) > 0:
+        print(job_id + " --- WARNING: " + imagename + " is already mounted, no hot blocks are recorded. Unmount it first (umount_image --now) to profile it.")
+
+
+# Mount an image unless it is already mounted. Returns True if the image has been mounted, False if it was
+# already mounted. Must be called with the local (per-compute node) image lock held.
+def mount_locked(imagename, mntpoint, rw=False, job_id='NOJOBID', backend=None):
+
+    if backend is None:
+        backend = SystemBackend()
+
+    # Do not check rw mounts: if rw is set, we will get an error later, in fs_lock_file.
+    if check_mount_point(imagename, mntpoint, backend) and not rw:
+
+        # Do not mount if image is already mounted. Only update image usage later.
+        print(job_id + " --- cannot mount: " + imagename + " is already mounted at " + mntpoint)
+        warn_not_profiled(imagename, job_id)
+        return False
+
+    backend.mount(imagename, mntpoint, rw, job_id)
+    return True
+
+
+def mount_image(mntname, mntpoint=None, rw=False, job_id='NOJOBID'):
+
+    imagename, mntpoint, modulename = check_mount_request(mntname, mntpoint, rw)
+
+    # if a job file exists, make sure the calling user is the job owner
+    if not is_job_owner(job_id):
+        raise ModuleException(get_login_username() + ": you are not the job owner of job_id " + job_id)
+
+    # copy the image into the image cache before the local lock is taken
+    if not rw:
+        fill_cache([imagename], job_id)
+
     # lock access to local (per-compute node) image information
     with local_lock_images() as lock:
 
-        # make sure the destination directory is not a mount point,
-        # or that the same image is already mounted there.
-        already_mounted = is_image_mounted(imagename, mntpoint)
-        if os.path.ismount(mntpoint) and not already_mounted:
-            raise ModuleException(mntpoint + " is already used as a mount point for a different image, refusing to mount")
-
-        # Do not check rw mounts: if rw is set, we will get an error later, in fs_lock_file.
-        if already_mounted and not rw:
-
-            # Do not mount if image is already mounted. Only update image usage later.
-            print(job_id + " --- cannot mount: " + imagename + " is already mounted at " + mntpoint)
-        else:
-            # next is the global cluster lock - keeps track of used images through a network file system lock file
-
-            # lock the image in desired mode:
-            #  RO: check if the image is not already mounted in RW mode. If not, append hostname to lock file and mount
-            #  RW: check if the image is not already mounted in any mode. If not, append " rw "+hostname to lock file and mount
-            #
-            # To obtain an rw lock in fs_lock_file it is required that the lock file is empty,
-            # i.e., no other host mounts that image.
-            # An ro lock is obtained in fs_lock_file using flock. After that, below we check if the file does not contain
-            # " rw ", i.e., the image is mounted in RW mode by someone.
-            with fs_lock_file(imagename + ".lock", rw) as fd:
-
-                if rw:
-                    # guaranteed that the lock file is empty
-                    fd.writelines(" rw ")
-                else:
-                    # check if not already mounted in RW
-                    data = fd.readline()
-                    if len(data) >= 4 and (data[0:4] == " rw "):
-                        raise ModuleException("failed to mount " + imagename + ", it is already mounted in RW mode by another client: " + data[3:len(data)-1])
-
-                # do mount
-                cmd = ["/bin/mount", "-o", "loop,nosuid,nodev", imagename, mntpoint]
-                log = job_id + " --- mounting " + imagename + " at " + mntpoint
-                if not rw:
-                    cmd.append("-o")
-                    cmd.append("ro")
-                    log += " (RO)"
-                else:
-                    log += " (RW)"
-
-                p = subprocess.Popen(cmd, stderr=PIPE)
-                stderrdata = p.communicate()[1]
-                if not p.returncode:
-
-                    # successfully mounted
-
-                    # For RW mounts, change ownership of the mount point to allow the user to write
-                    if rw:
-                        username = get_login_username()
-                        userinfo = pwd.getpwnam(username)
-                        os.chown(mntpoint, userinfo.pw_uid, userinfo.pw_gid)
-
-                    # now need to mark the mount in the global database:
-                    # store host name in the lock file
-                    try:
-                        fd.seek(0, os.SEEK_END)
-                        fd.write(socket.gethostname() + "\n")
-                    except:
-
-                        # If the hostname store fails, the mount must be unmounted!
-                        print(log + " : FAILED - cannot write to " + imagename + ".lock. Image will be unmounted.")
-                        cmd = ["/bin/umount", mntpoint];
-                        p = subprocess.Popen(cmd, stderr=PIPE)
-                        stderrdata = p.communicate()[1]
-                        if not p.returncode:
-                            raise ModuleException("mount failed: unable to write to " + imagename + ".lock")
-                        else:
-                            raise ModuleException("failed to unmount " + mntpoint + " after failed write to " + imagename + ".lock: "+ stderrdata + ". Manual cleanup required!")
-
-                    print(log + " : SUCCESS ")
-                else:
-                    raise ModuleException("mount " + imagename + " on " + mntpoint + " failed: " + stderrdata)
+        mount_locked(imagename, mntpoint, rw, job_id)
+        record_image_usage(imagename, job_id)
+
+
+# Reality check - if the image is mounted, update per-job usage information.
+# Must be called with the local (per-compute node) image lock held.
+def record_image_usage(imagename, job_id='NOJOBID', backend=None):
+
+    if backend is None:
+        backend = SystemBackend()
 
-        # reality check - if the image is mounted, update per-job usage information
-        if is_image_mounted(imagename):
+    if backend.is_mounted(imagename):
+        try:
+            backend.add_usage(job_id, [imagename])
+            print(job_id + " --- added image usage, current image usage: " + str(backend.get_usage(imagename)) + " jobs.")
+        except:
+            print(job_id + " --- ERROR adding information about " + imagename + " to local database.")
+            raise
+    else:
+        raise ModuleException('Image ' + imagename + ' not identified as mounted.')
+
+
+# Validate the requests of a batch. Returns the report with the failed requests filled in, and a list of
+# (index, image name, mount point, start time) tuples of the valid requests.
+def check_mount_requests(requests):
+
+    report = [None] * len(requests)
+    checked = []
+    for i, (mntname, mntpoint) in enumerate(requests):
+        start = time.time()
+        try:
+            imagename, mntpoint, modulename = check_mount_request(mntname, mntpoint)
+            checked.append((i, imagename, mntpoint, start))
+        except:
+            report[i] = (mntname, 'FAILED', str(sys.exc_info()[1]), time.time() - start)
+
+    return report, checked
+
+
+# Reality check of a batch - only images that are mounted are added to the job file. status maps the image names
+# to (status, message, seconds) tuples, the report is completed. Must be called with the local image lock held.
+def record_images_usage(requests, checked, status, report, job_id='NOJOBID', backend=None):
+
+    if backend is None:
+        backend = SystemBackend()
+
+    mounted = []
+    for (i, imagename, mntpoint, start) in checked:
+        (st, msg, elapsed) = status[imagename]
+        if st != 'FAILED' and not backend.is_mounted(imagename):
+            (st, msg) = ('FAILED', ' --- image ' + imagename + ' not identified as mounted.')
+        if st != 'FAILED' and imagename not in mounted:
+            mounted.append(imagename)
+        report[i] = (requests[i][0], st, msg, elapsed)
+
+    try:
+        backend.add_usage(job_id, mounted)
+    except:
+        print(job_id + " --- ERROR adding information about " + " ".join(mounted) + " to local database.")
+        raise
+
+
+# Mount several images (RO) for a job with a single local lock and a single update of the job file.
+# The global lock and mount steps of the images run concurrently in at most workers threads.
+# requests is a list of (name, mount point) tuples, see get_image_requests.
+# Returns a per-image status report: a list of (name, status, message, seconds) tuples.
+def mount_images(requests, job_id='NOJOBID', workers=None, backend=None):
+
+    if backend is None:
+        backend = SystemBackend()
+
+    # if a job file exists, make sure the calling user is the job owner
+    if not is_job_owner(job_id):
+        raise ModuleException(get_login_username() + ": you are not the job owner of job_id " + job_id)
+
+    report, checked = check_mount_requests(requests)
+
+    # copy the images into the image cache before the local lock is taken
+    if not backend.dry_run:
+        fill_cache(unique([imagename for (i, imagename, mntpoint, start) in checked]), job_id)
+
+    # lock access to local (per-compute node) image information
+    with local_lock_images() as lock:
+
+        # serial: find the images that need to be mounted, every image is mounted once
+        status = {}
+        mntpoints = {}
+        tomount = []
+        for (i, imagename, mntpoint, start) in checked:
+            if imagename in status:
+                continue
             try:
-                add_image_usage(job_id, imagename)
-                print(job_id + " --- added image usage, current image usage: " + str(get_image_usage(imagename)) + " jobs.")
+                if mntpoints.get(mntpoint, imagename) != imagename:
+                    raise ModuleException(mntpoint + " is used as a mount point for " + mntpoints[mntpoint] + " in the same request")
+                mntpoints[mntpoint] = imagename
+
+                if check_mount_point(imagename, mntpoint, backend):
+                    print(job_id + " --- cannot mount: " + imagename + " is already mounted at " + mntpoint)
+                    warn_not_profiled(imagename, job_id)
+                    status[imagename] = ('already mounted', '', 0.0)
+                else:
+                    status[imagename] = None
+                    tomount.append((imagename, mntpoint, False, job_id))
             except:
-                print(job_id + " --- ERROR adding information about " + imagename + " to local database.")
-                raise
-        else:
-            raise ModuleException('Image ' + image_name + ' not identified as mounted.')
+                status[imagename] = ('FAILED', str(sys.exc_info()[1]), 0.0)
+
+        # concurrent: global lock and mount
+        if workers is None:
+            workers = mount_engine.default_workers
+        results = run_parallel(backend.mount, tomount, workers)
+        for (imagename, mntpoint, rw, jid), (ret, err, elapsed) in zip(tomount, results):
+            if err is None:
+                status[imagename] = ('mounted', '', elapsed)
+            else:
+                status[imagename] = ('FAILED', str(err), elapsed)
+
+        # serial: reality check - only images that are mounted are added to the job file
+        record_images_usage(requests, checked, status, report, job_id, backend)
+
+    return report
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Mount a disk image.")
-    parser.add_argument("image_name", help="name of the software module, or path to disk image file.")
-    parser.add_argument("mount_point", help="mount point under " + hpcmodules.mount_path_usr + '/$USER', nargs='?', default=None)
+    parser.add_argument("image_name", help="name of the software module(s), or path to disk image file followed by a mount point under " + hpcmodules.mount_path_usr + '/$USER', nargs='*')
+    parser.add_argument("--list", help="read images to mount from a file, one per line: module name, or image path and mount point. Use - for stdin.", default=None)
     parser.add_argument("--job_id", help="job identifier [default $USER].", default="NOJOBID")
     parser.add_argument("--rw", help="mount image in read-write mode (only one compute node can do that at a time)", action='store_true')
+    parser.add_argument("--workers", help="number of images mounted concurrently [default: %(default)s]", type=int, default=mount_engine.default_workers)
+    parser.add_argument("--dry-run", help="only simulate the global lock and mount steps, print the order of events", action='store_true')
+    parser.add_argument("--profile", help="record the blocks of the images read in the first PROFILE seconds after the mount as their hot lists, see image_profile (root only)", type=int, default=0)
     args = parser.parse_args()
 
     hpcmodules.gl_job_id = args.job_id
+    start_metrics('mount_image', args.job_id)
     try:
-        mount_image(args.image_name, rw=args.rw, mntpoint=args.mount_point, job_id=args.job_id)
+        requests = get_image_requests(args.image_name, args.list)
+        if len(requests) == 0:
+            parser.error("no images given")
+
+        if args.profile > 0:
+            if get_login_username() != 'root':
+                raise ModuleException("--profile can only be used by root")
+            caller.profile = args.profile
+
+        if args.rw and (args.dry_run or len(requests) > 1 or args.list is not None):
+            raise ModuleException("--rw can only be used with a single image")
+
+        if args.dry_run:
+            backend = DryRunBackend()
+            ok = print_image_report(args.job_id, mount_images(requests, args.job_id, args.workers, backend))
+            for (t, event, name) in backend.events:
+                print(args.job_id + " --- dry run: %.3f " % (t - backend.events[0][0]) + event + " " + name)
+            print(args.job_id + " --- dry run: at most " + str(backend.max_active) + " concurrent mounts")
+            if not ok:
+                exit(1)
+            exit(0)
+
+        # hand the request to the image daemon, if it is running
+        batch = len(requests) > 1 or args.list is not None
+        ok = daemon_request({'op': 'mount', 'images': absolute_requests(requests), 'job_id': args.job_id, 'rw': args.rw, 'batch': batch, 'workers': args.workers, 'profile': args.profile})
+        if ok is not None:
+            if not ok:
+                exit(1)
+        elif not batch:
+            mount_image(requests[0][0], rw=args.rw, mntpoint=requests[0][1], job_id=args.job_id)
+        elif not print_image_report(args.job_id, mount_images(requests, args.job_id, args.workers)):
+            exit(1)
     except ModuleException:
         print(args.job_id + str(sys.exc_info()[1]))
+        metrics_failed(str(sys.exc_info()[1]))
         exit(1)
     # other exceptions run through
@@ -0,0 +1,214 @@
+#!/usr/bin/env python2
+
+# Coalescing mount service, the mount core of the image daemon.
+#
+# When many tasks of a job load the same module at the same time (e.g., MPI ranks running the task prolog), the
+# requests are coalesced: the first request for an image performs the mount, concurrent requests for the same image
+# wait for that in-flight mount and share its result. Requests for different images proceed in parallel.
+#
+# The mounts run with the node-local image lock taken shared, so they do not exclude each other but do exclude the
+# (un)mount tools working directly, which take it exclusively. The job files are then updated with the exclusive lock.
+# Between the two, another job, the epilog or the idle timer of the daemon can unmount an image that has no users
+# yet: the images are checked again with the exclusive lock held, and mounted again if needed, before their usage is
+# recorded. Concurrent requests for different images at the same mount point are serialized.
+#
+# The service works with any mount engine backend: the command line below drives it with the dry-run backend.
+
+import sys
+import os
+import time
+import threading
+import argparse
+from hpcmodules import *
+from mount_engine import SystemBackend, DryRunBackend, default_workers
+from image_cache import fill_cache
+from mount_image import check_mount_request, check_mount_point, warn_not_profiled, mount_locked, check_mount_requests, record_image_usage, record_images_usage
+
+
+# a mount in progress, and its result
+class InFlightMount(object):
+
+    def __init__(self, key):
+        self.key = key
+        self.done = threading.Event()
+        self.status = None
+        self.error = None
+
+
+class MountService(object):
+
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = SystemBackend()
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.inflight_mntpoints = {}
+        self.mounts = 0
+        self.coalesced = 0
+
+    # Mount an image, or join the in-flight mount of the same image at the same mount point.
+    # Returns 'mounted', or 'already mounted'.
+    def mount(self, imagename, mntpoint, rw=False, job_id='NOJOBID'):
+
+        # RW mounts are never shared
+        realmnt = os.path.realpath(mntpoint)
+        key = (imagename, realmnt, rw)
+        while True:
+            with self.lock:
+                flight = self.inflight.get(imagename, self.inflight_mntpoints.get(realmnt))
+                if flight is None:
+                    flight = InFlightMount(key)
+                    self.inflight[imagename] = flight
+                    self.inflight_mntpoints[realmnt] = flight
+                    break
+
+            flight.done.wait()
+            if flight.key == key and not rw:
+                with self.lock:
+                    self.coalesced += 1
+                if flight.error is not None:
+                    raise flight.error
+                print(job_id + " --- joined the mount of " + imagename + " by a concurrent request")
+                warn_not_profiled(imagename, job_id)
+                return flight.status
+
+            # a different request for the image or the mount point was in flight: check again
+
+        try:
+            # the first request copies the image into the image cache, before the local lock is taken
+            if not rw and not self.backend.dry_run:
+                fill_cache([imagename], job_id)
+
+            with local_lock_images(shared=True) as lock:
+
+                # Do not check rw mounts: if rw is set, we will get an error later, in fs_lock_file.
+                if check_mount_point(imagename, mntpoint, self.backend) and not rw:
+                    print(job_id + " --- cannot mount: " + imagename + " is already mounted at " + mntpoint)
+                    warn_not_profiled(imagename, job_id)
+                    flight.status = 'already mounted'
+                else:
+                    self.backend.mount(imagename, mntpoint, rw, job_id)
+                    with self.lock:
+                        self.mounts += 1
+                    flight.status = 'mounted'
+        except:
+            flight.error = sys.exc_info()[1]
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[imagename]
+                del self.inflight_mntpoints[realmnt]
+            flight.done.set()
+
+        return flight.status
+
+    # internal - mount an image again if it has been unmounted after the shared lock was released.
+    # Must be called with the local (per-compute node) image lock held exclusively.
+    def remount_locked(self, imagename, mntpoint, rw=False, job_id='NOJOBID'):
+        if not self.backend.is_mounted(imagename, mntpoint):
+            print(job_id + " --- " + imagename + " has been unmounted concurrently, mounting again")
+            mount_locked(imagename, mntpoint, rw, job_id, self.backend)
+
+    # same as mount_image.mount_image
+    def mount_image(self, mntname, mntpoint=None, rw=False, job_id='NOJOBID'):
+
+        imagename, mntpoint, modulename = check_mount_request(mntname, mntpoint, rw)
+
+        # if a job file exists, make sure the calling user is the job owner
+        if not is_job_owner(job_id):
+            raise ModuleException(get_login_username() + ": you are not the job owner of job_id " + job_id)
+
+        self.mount(imagename, mntpoint, rw, job_id)
+
+        with local_lock_images() as lock:
+            self.remount_locked(imagename, mntpoint, rw, job_id)
+            record_image_usage(imagename, job_id, self.backend)
+
+    # same as mount_image.mount_images
+    def mount_images(self, requests, job_id='NOJOBID', workers=None):
+
+        # if a job file exists, make sure the calling user is the job owner
+        if not is_job_owner(job_id):
+            raise ModuleException(get_login_username() + ": you are not the job owner of job_id " + job_id)
+
+        report, checked = check_mount_requests(requests)
+
+        # every image is mounted once
+        status = {}
+        mntpoints = {}
+        tomount = []
+        for (i, imagename, mntpoint, start) in checked:
+            if imagename in status:
+                continue
+            if mntpoints.get(mntpoint, imagename) != imagename:
+                status[imagename] = ('FAILED', mntpoint + " is used as a mount point for " + mntpoints[mntpoint] + " in the same request", 0.0)
+                continue
+            mntpoints[mntpoint] = imagename
+            status[imagename] = None
+            tomount.append((imagename, mntpoint, False, job_id))
+
+        # concurrent: coalesced global lock and mount
+        if workers is None:
+            workers = default_workers
+        results = run_parallel(self.mount, tomount, workers)
+        for (imagename, mntpoint, rw, jid), (ret, err, elapsed) in zip(tomount, results):
+            if err is None:
+                status[imagename] = (ret, '', elapsed)
+            else:
+                status[imagename] = ('FAILED', str(err), elapsed)
+
+        # serial: reality check - only images that are mounted are added to the job file
+        with local_lock_images() as lock:
+            for (mntpoint, imagename) in mntpoints.items():
+                if status[imagename][0] == 'FAILED':
+                    continue
+                try:
+                    self.remount_locked(imagename, mntpoint, False, job_id)
+                except:
+                    status[imagename] = ('FAILED', str(sys.exc_info()[1]), status[imagename][2])
+            record_images_usage(requests, checked, status, report, job_id, self.backend)
+
+        return report
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Simulate concurrent mount requests against the coalescing mount service, using the dry-run backend.")
+    parser.add_argument("image_name", help="name of the software module(s)", nargs='+')
+    parser.add_argument("--clients", help="number of concurrent requests per image [default: %(default)s]", type=int, default=32)
+    parser.add_argument("--delay", help="simulated seconds per mount [default: %(default)s]", type=float, default=0.1)
+    args = parser.parse_args()
+
+    backend = DryRunBackend(args.delay)
+    service = MountService(backend)
+
+    failed = []
+    def client(name, i):
+        try:
+            service.mount_image(name, job_id="dryrun" + str(i))
+        except:
+            failed.append(name + ": " + str(sys.exc_info()[1]))
+
+    threads = []
+    for i in range(args.clients):
+        for name in args.image_name:
+            threads.append(threading.Thread(target=client, args=(name, i)))
+
+    # the messages of the single requests are not printed
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    sys.stdout = stdout
+
+    print(" --- requests: " + str(len(threads)) + ", mounts: " + str(service.mounts) + ", coalesced: " + str(service.coalesced) + ", failed: " + str(len(failed)))
+    print(" --- elapsed: %.3f s, at most %d concurrent mounts" % (elapsed, backend.max_active))
+    for f in failed:
+        print(" --- FAILED " + f)
+    if len(failed):
+        exit(1)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python2
+
+# In-process view of the kernel mount table.
+#
+# /proc/self/mountinfo is parsed once into an index keyed by source image, mount point and loop device.
+# For loop mounts the kernel reports /dev/loopN as the mount source, so the image file is resolved through
+# /sys/block/loopN/loop/backing_file.
+#
+# The parsed table is cached and only re-read when the mount table changes: the kernel signals changes
+# of /proc mount files with POLLPRI | POLLERR, other files (e.g., test fixtures) are checked by mtime and size.
+#
+# Both paths can be overridden with SI_MOUNTINFO_PATH and SI_SYS_BLOCK_PATH.
+#
+# Loop devices attached to copies of images (see image_cache.py) report the image they are a copy of: the backing
+# files under a directory of backing_aliases are mapped to the aliased directory.
+
+import os
+import re
+import select
+import threading
+from collections import namedtuple
+
+mountinfo_path = "/proc/self/mountinfo"
+sys_block_path = "/sys/block"
+
+# list of (directory, alias) of backing files
+backing_aliases = []
+
+# source   - backing image file for loop mounts, mount source otherwise
+# mntpoint - mount point
+# loopdev  - loop device (/dev/loopN), or None
+# fstype   - file system type
+# options  - per-mount options, e.g., ro,nosuid,nodev
+# device   - mount source as reported by the kernel
+# super_options - per-superblock options, e.g., the lowerdir of an overlay
+MountEntry = namedtuple('MountEntry', ['source', 'mntpoint', 'loopdev', 'fstype', 'options', 'device', 'super_options'])
+
+
+# mountinfo escapes space, tab, newline and backslash as octal
+def unescape(field):
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+# return the image file attached to a loop device, or None
+def get_loop_backing_file(loopdev, sys_block=None):
+    if sys_block is None:
+        sys_block = sys_block_path
+    try:
+        with open(os.path.join(sys_block, os.path.basename(loopdev), "loop", "backing_file"), 'r') as fd:
+            backing = fd.read().rstrip("\n")
+    except (IOError, OSError):
+        return None
+
+    # the image file has been replaced or removed while attached
+    if backing.endswith(" (deleted)"):
+        backing = backing[:-len(" (deleted)")]
+
+    for (path, alias) in backing_aliases:
+        if backing.startswith(path + os.sep):
+            return alias + backing[len(path):]
+    return backing
+
+
+# parse mountinfo contents into a list of MountEntry
+def parse_mountinfo(data, sys_block=None):
+    entries = []
+    for line in data.split("\n"):
+        fields = line.split()
+        if len(fields) < 10:
+            continue
+
+        # optional fields are terminated by a single hyphen
+        try:
+            sep = fields.index("-", 6)
+        except ValueError:
+            continue
+        if len(fields) < sep + 3:
+            continue
+
+        mntpoint = unescape(fields[4])
+        options = fields[5]
+        fstype = fields[sep + 1]
+        device = unescape(fields[sep + 2])
+        super_options = fields[sep + 3] if len(fields) > sep + 3 else ''
+
+        source = device
+        loopdev = None
+        if re.match(r'^/dev/loop[0-9]+$', device):
+            loopdev = device
+            backing = get_loop_backing_file(device, sys_block)
+            if backing is not None:
+                source = backing
+
+        entries.append(MountEntry(source, mntpoint, loopdev, fstype, options, device, super_options))
+
+    return entries
+
+
+class MountTable(object):
+
+    def __init__(self, path=None, sys_block=None):
+        self.path = path if path is not None else mountinfo_path
+        self.sys_block = sys_block if sys_block is not None else sys_block_path
+        self.entries = []
+        self.by_source = {}
+        self.by_mntpoint = {}
+        self.by_loopdev = {}
+        self._fd = None
+        self._poll = None
+        self._stamp = None
+        self._lock = threading.Lock()
+        self.refresh(True)
+
+    # check if the mount table changed since it was last read
+    def changed(self):
+        if self._poll is not None:
+            return len(self._poll.poll(0)) > 0
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        return self._stamp != (st.st_mtime, st.st_size, st.st_ino)
+
+    def _read(self):
+
+        # proc files: keep the file open, a change is signalled through poll
+        if self.path.startswith("/proc/"):
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDONLY)
+                self._poll = select.poll()
+                self._poll.register(self._fd, select.POLLPRI | select.POLLERR)
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            chunks = []
+            while True:
+                chunk = os.read(self._fd, 65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return "".join(chunks)
+
+        with open(self.path, 'r') as fd:
+            st = os.fstat(fd.fileno())
+            self._stamp = (st.st_mtime, st.st_size, st.st_ino)
+            return fd.read()
+
+    # re-read the mount table if it changed, or if forced
+    def refresh(self, force=False):
+        with self._lock:
+            if not force and not self.changed():
+                return False
+
+            entries = parse_mountinfo(self._read(), self.sys_block)
+            by_source = {}
+            by_mntpoint = {}
+            by_loopdev = {}
+            for e in entries:
+                by_source.setdefault(e.source, []).append(e)
+
+                # later entries are mounted on top of earlier ones
+                by_mntpoint[e.mntpoint] = e
+                if e.loopdev is not None:
+                    by_loopdev[e.loopdev] = e
+
+            self.entries = entries
+            self.by_source = by_source
+            self.by_mntpoint = by_mntpoint
+            self.by_loopdev = by_loopdev
+            return True
+
+    # all mounts of a given source (image file)
+    def find_source(self, source):
+        return self.by_source.get(source, [])
+
+    # mount visible at a given mount point, or None
+    def find_mntpoint(self, mntpoint):
+        return self.by_mntpoint.get(mntpoint)
+
+    # mount on which a given path is located, or None
+    def find_path(self, path):
+        while True:
+            m = self.by_mntpoint.get(path)
+            if m is not None or path == os.sep or path == "":
+                return m
+            path = os.path.dirname(path)
+
+    # mount using a given loop device, or None
+    def find_loopdev(self, loopdev):
+        return self.by_loopdev.get(loopdev)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._poll = None
+
+
+# shared, lazily refreshed mount table
+_table = None
+_table_lock = threading.Lock()
+
+
+def get_mount_table():
+    global _table
+    with _table_lock:
+        if _table is None or _table.path != mountinfo_path or _table.sys_block != sys_block_path:
+            if _table is not None:
+                _table.close()
+            _table = MountTable()
+            return _table
+    _table.refresh()
+    return _table
+
+
+mountinfo_path = os.environ.get('SI_MOUNTINFO_PATH', mountinfo_path)
+sys_block_path = os.environ.get('SI_SYS_BLOCK_PATH', sys_block_path)
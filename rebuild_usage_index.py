@@ -0,0 +1,24 @@
+#!/usr/bin/env python2
+
+# Rebuild the node-local image usage index from the per-job .modules files, e.g., after the index has been removed
+# or damaged, or after job files have been edited by hand.
+
+import argparse
+import sys
+from hpcmodules import *
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Rebuild the image usage index from the job files in " + local_lock_path + ".")
+    args = parser.parse_args()
+
+    try:
+        with local_lock_images() as lock:
+            jobs = rebuild_usage_index()
+        print(" --- rebuilt image usage index " + get_usage_index_filename() + " from " + str(len(jobs)) + " job files.")
+
+    except ModuleException:
+        print(str(sys.exc_info()[1]))
+        exit(1)
+    # other exceptions run through
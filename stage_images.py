@@ -0,0 +1,284 @@
+#!/usr/bin/env python2
+
+# Stage software images on the nodes of a job before the job starts.
+#
+# The images of the modules (and the lower images of stacked images) are read ahead on every node: copied into the
+# node-local image cache if it is enabled (see image_cache.py), otherwise read into the page cache of the node with
+# posix_fadvise(POSIX_FADV_WILLNEED). Several images are staged concurrently, and the reads of a node can be limited
+# to a rate. The nodes are reached with pdsh, e.g., from PrologSlurmctld:
+#
+#   stage_images --job_id $SLURM_JOB_ID                     # modules loaded in the batch script of the job
+#   stage_images --nodes c1-[1-4] gcc/9.3.0 python/3.8.2
+#   stage_images --local gcc/9.3.0                          # this node only
+#   stage_images --benchmark gcc/9.3.0                      # cold vs. warm mount and first read, needs root
+#
+# Loop devices with direct I/O (SI_LOOP_DIRECT_IO) do not use the page cache of the image file: without an image
+# cache, staging only helps mounts that use buffered loop devices.
+
+import os
+import re
+import sys
+import time
+import ctypes
+import ctypes.util
+import argparse
+import tempfile
+import threading
+import subprocess
+from subprocess import PIPE
+import hpcmodules
+from hpcmodules import *
+import image_cache
+from image_cache import get_cached_image
+from filefs import MB
+
+# images are read ahead in chunks of this size [MB]
+stage_chunk_mb = 8
+
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+libc = None
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+except (OSError, AttributeError):
+    libc = None
+
+
+# posix_fadvise on a range of an open file. Returns False if it is not available.
+def fadvise(fd, offset, length, advice):
+    if libc is None:
+        return False
+    return libc.posix_fadvise(fd, offset, length, advice) == 0
+
+
+# Limits the bytes read by all threads of a node to a rate, in MB/s. A rate of 0 does not limit.
+class RateLimit(object):
+
+    def __init__(self, rate_mb):
+        self.rate = rate_mb * MB
+        self.start = time.time()
+        self.nbytes = 0
+        self._lock = threading.Lock()
+
+    # account for nbytes, sleep until they are within the rate
+    def wait(self, nbytes):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self.nbytes += nbytes
+            delay = self.start + self.nbytes / float(self.rate) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Read a file ahead into the page cache, chunk by chunk. If posix_fadvise is not available, the chunks are read.
+# Returns the number of bytes.
+def read_ahead(filename, limit):
+    chunk = stage_chunk_mb * MB
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        for offset in range(0, size, chunk):
+            n = min(chunk, size - offset)
+            if not fadvise(fd, offset, n, POSIX_FADV_WILLNEED):
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.read(fd, n)
+            limit.wait(n)
+    finally:
+        os.close(fd)
+    return size
+
+
+# Stage an image on this node: copy it into the image cache, or read it ahead into the page cache.
+# Returns a status message.
+def stage_image(imagename, limit, job_id='NOJOBID'):
+    start = time.time()
+    cachename = get_cached_image(imagename, fill=False)
+    if cachename is not None:
+        return "in the image cache"
+
+    if len(hpcmodules.image_cache_path):
+        limit.wait(os.stat(imagename).st_size)
+        if get_cached_image(imagename, fill=True, job_id=job_id) is not None:
+            return "copied to the image cache in %.1f s" % (time.time() - start)
+
+    nbytes = read_ahead(imagename, limit)
+    return "read ahead %d MB in %.1f s" % (nbytes / MB, time.time() - start)
+
+
+# Stage images on this node with at most workers threads, reading at most rate_mb MB/s.
+# Returns a per-image status report: a list of (name, status, message, seconds) tuples.
+def stage_images(imagenames, workers=None, rate_mb=None, job_id='NOJOBID'):
+    if workers is None:
+        workers = hpcmodules.stage_workers
+    if rate_mb is None:
+        rate_mb = hpcmodules.stage_rate_mb
+
+    limit = RateLimit(rate_mb)
+    results = run_parallel(stage_image, [(imagename, limit, job_id) for imagename in imagenames], workers)
+    report = []
+    for imagename, (msg, err, elapsed) in zip(imagenames, results):
+        if err is None:
+            report.append((imagename, 'staged', msg, elapsed))
+        else:
+            report.append((imagename, 'FAILED', str(err), elapsed))
+    return report
+
+
+# Images of modules: the image of each module, and the lower images of stacked images, bottom first.
+# Modules that are not imaged are skipped.
+def get_stage_images(modulenames, job_id='NOJOBID'):
+    imagenames = []
+    for m in modulenames:
+        imagename = get_image_name(m)
+        if not os.path.isfile(imagename):
+            print(job_id + " --- module " + m + " is not imaged, skipping")
+            continue
+        imagenames += get_image_stack(imagename) + [imagename]
+    return unique(imagenames)
+
+
+# Modules loaded in the batch script of a job (module load / module add lines)
+def get_job_modules(job_id):
+    try:
+        p = subprocess.Popen(["scontrol", "write", "batch_script", job_id, "-"], stdout=PIPE, stderr=PIPE)
+    except OSError:
+        raise ModuleException("cannot run scontrol: " + str(sys.exc_info()[1]))
+    stdout, stderr = p.communicate()
+    if p.returncode:
+        raise ModuleException("cannot read the batch script of job " + job_id + ": " + stderr.strip())
+
+    modules = []
+    for l in stdout.split('\n'):
+        m = re.match(r'^\s*module\s+(?:-\S+\s+)*(?:load|add)\s+(.*)$', l.split('#')[0])
+        if m is None:
+            continue
+        modules += [n for n in m.group(1).split() if not n.startswith('-') and is_module_name(n)]
+    return unique(modules)
+
+
+# Nodes of a job, a SLURM host list
+def get_job_nodes(job_id):
+    if os.environ.get('SLURM_JOB_ID') == job_id and len(os.environ.get('SLURM_JOB_NODELIST', '')):
+        return os.environ['SLURM_JOB_NODELIST']
+    try:
+        p = subprocess.Popen(["squeue", "-h", "-j", job_id, "-o", "%N"], stdout=PIPE, stderr=PIPE)
+    except OSError:
+        raise ModuleException("cannot run squeue: " + str(sys.exc_info()[1]))
+    stdout, stderr = p.communicate()
+    if p.returncode or not len(stdout.strip()):
+        raise ModuleException("cannot find the nodes of job " + job_id + ": " + stderr.strip())
+    return stdout.strip()
+
+
+# Run stage_images --local on the nodes, a host list. Returns the exit code of pdsh.
+def stage_on_nodes(nodes, modulenames, workers, rate_mb, job_id='NOJOBID'):
+    cmd = [hpcmodules.stage_pdsh, "-w", nodes, os.path.realpath(sys.argv[0]), "--local", "--job_id", job_id,
+           "--workers", str(workers), "--rate", str(rate_mb)] + modulenames
+    print(job_id + " --- staging " + str(len(modulenames)) + " modules on " + nodes)
+    return subprocess.call(cmd)
+
+
+# internal - mount an image file with a buffered loop device, read the first block of every file, unmount.
+# Returns the seconds of the mount and of the first read.
+def time_mount_and_read(filename, mntpoint):
+    start = time.time()
+    subprocess.check_call(["/bin/mount", "-o", "loop,ro,nosuid,nodev", filename, mntpoint])
+    mounted = time.time()
+    try:
+        for (dirpath, dirnames, filenames) in os.walk(mntpoint):
+            for f in filenames:
+                path = join(dirpath, f)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    with open(path, 'rb') as fd:
+                        fd.read(64*1024)
+        read = time.time()
+    finally:
+        subprocess.call(["/bin/umount", mntpoint])
+    return mounted - start, read - mounted
+
+
+# internal - drop the pages of a file from the page cache
+def drop_cache(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+# Benchmark staging of an image on this node: mount and first read of every file with a cold page cache, staging,
+# and mount and first read of the staged image. The images of a stack are mounted one by one, not as an overlay.
+# Returns (cold mount, cold read, staging, warm mount, warm read) seconds.
+def benchmark_image(imagename, job_id='NOJOBID'):
+    mntpoint = tempfile.mkdtemp('', 'stage', local_lock_path)
+    try:
+        cachename = image_cache.get_cache_name(imagename)
+        if cachename is not None:
+            image_cache.remove_copy(cachename)
+        drop_cache(imagename)
+        cold = time_mount_and_read(imagename, mntpoint)
+
+        drop_cache(imagename)
+        start = time.time()
+        stage_image(imagename, RateLimit(0), job_id)
+        staged = time.time() - start
+
+        filename = get_cached_image(imagename, fill=False) or imagename
+        warm = time_mount_and_read(filename, mntpoint)
+    finally:
+        os.rmdir(mntpoint)
+    return cold[0], cold[1], staged, warm[0], warm[1]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Stage software images on the nodes of a job: copy them into the node-local image cache, or read them into the page cache.")
+    parser.add_argument("image_name", help="name of the software module(s) [default: the modules loaded in the batch script of --job_id]", nargs='*')
+    parser.add_argument("--job_id", help="job identifier, stage on the nodes of the job", default="NOJOBID")
+    parser.add_argument("--nodes", help="host list of the nodes [default: the nodes of --job_id]", default=None)
+    parser.add_argument("--local", help="stage on this node only", action='store_true')
+    parser.add_argument("--workers", help="number of images staged concurrently on a node [default: %(default)s, SI_STAGE_WORKERS]", type=int, default=hpcmodules.stage_workers)
+    parser.add_argument("--rate", help="maximum read rate per node [MB/s, 0: no limit, default: %(default)s, SI_STAGE_RATE_MB]", type=int, default=hpcmodules.stage_rate_mb)
+    parser.add_argument("--benchmark", help="report cold vs. warm mount and first read times of the images on this node, needs root. Removes the copies of the images from the image cache first.", action='store_true')
+    args = parser.parse_args()
+
+    hpcmodules.gl_job_id = args.job_id
+    try:
+        modulenames = args.image_name
+        if not len(modulenames):
+            if args.job_id == "NOJOBID":
+                parser.error("no modules given")
+            modulenames = get_job_modules(args.job_id)
+            if not len(modulenames):
+                print(args.job_id + " --- no modules loaded in the batch script, nothing to stage")
+                exit(0)
+
+        if args.benchmark:
+            print("%-50s %8s %8s %8s %8s %8s" % ("image", "cold mnt", "read", "stage", "warm mnt", "read"))
+            for imagename in get_stage_images(modulenames, args.job_id):
+                try:
+                    times = benchmark_image(imagename, args.job_id)
+                    print("%-50s %8.3f %8.3f %8.3f %8.3f %8.3f" % ((imagename,) + times))
+                except (IOError, OSError, subprocess.CalledProcessError):
+                    print("%-50s %s" % (imagename, "FAILED: " + str(sys.exc_info()[1])))
+
+        elif args.local or (args.nodes is None and args.job_id == "NOJOBID"):
+            start = time.time()
+            if not print_image_report(args.job_id, stage_images(get_stage_images(modulenames, args.job_id), args.workers, args.rate, args.job_id)):
+                exit(1)
+            print(args.job_id + " --- staged in %.1f s" % (time.time() - start))
+
+        else:
+            nodes = args.nodes
+            if nodes is None:
+                nodes = get_job_nodes(args.job_id)
+            if stage_on_nodes(nodes, modulenames, args.workers, args.rate, args.job_id):
+                exit(1)
+
+    except ModuleException:
+        print(args.job_id + str(sys.exc_info()[1]))
+        exit(1)
+    # other exceptions run through
@@ -3,7 +3,7 @@
 import argparse
 import sys
 import socket
-from umount_image import umount_image
+from umount_image import umount_images, evict_idle_images
 from cleanup_images import cleanup_images
 import hpcmodules
 from hpcmodules import *
@@ -18,6 +18,7 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     hpcmodules.gl_job_id = args.job_id
+    start_metrics('umount_all_images', args.job_id)
     try:
 
         if args.job_id == "ALL":
@@ -36,32 +37,36 @@ if __name__ == '__main__':
         # get_image_usage will not report those images, hence umount_all_images will not report 'still used' error
         # If we fail to unmount an image later, this will be reported by monitoring software as inconsistency:
         # image is mounted, but not reported as used
-        clear_image_usage(args.job_id)
+        with metrics_phase('job_file'):
+            clear_image_usage(args.job_id)
 
         # iterate over unique module names
+        requests = []
         for imagename in images:
-
             try:
-                try:
-                    # try to treat as a module
-                    img = get_module_name(imagename)
-                    mnt = None
-                except:
-                    # it is a user image
-                    img = imagename
-                    mnt = get_image_mount_point(imagename)
-
-                umount_image(img, mnt, args.job_id)
+                # try to treat as a module
+                requests.append((get_module_name(imagename), None))
             except:
-                # failed to clean-up after this module, try next one
-                # could be due to a network error when releasing the global module usage lock, but the image
-                # has been unmounted anyway
-                print(args.job_id + str(sys.exc_info()[1]))
+                # it is a user image
+                requests.append((imagename, get_image_mount_point(imagename)))
+
+        # Failures are reported per image, the remaining images are still unmounted.
+        # A failure could be due to a network error when releasing the global module usage lock, but the image
+        # has been unmounted anyway
+        # In SLURM epilogue mode unused software images are kept mounted as idle images, see idle_grace
+        keep_idle = args.job_id != "ALL"
+        print_image_report(args.job_id, umount_images(requests, args.job_id, keep_idle))
+        if not keep_idle:
+            with local_lock_images() as lock:
+                with metrics_phase('evict'):
+                    evict_idle_images(args.job_id, force=True)
 
         # perform cleanup actions, look for blocked loop devices
-        cleanup_images(args.cleanup, args.kill)
+        with metrics_phase('cleanup'):
+            cleanup_images(args.cleanup, args.kill)
 
     except ModuleException:
         print(args.job_id + str(sys.exc_info()[1]))
+        metrics_failed(str(sys.exc_info()[1]))
         exit(1)
     # other exceptions run through
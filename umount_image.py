@@ -3,44 +3,47 @@
 import sys
 import os
 import socket
+import time
 import argparse
 import subprocess
 from subprocess import *
 import hpcmodules
 from hpcmodules import *
-
-
-def umount_image(mntname, mntpoint=None, job_id='NOJOBID'):
-
-    # argument validation: image name / module name, and mount point
-    imagename, mntpoint, modulename = validate_mount_arguments(mntname, mntpoint)
-
-    # if a job file exists, make sure the calling user is the job owner
-    if not is_job_owner(job_id):
-        raise ModuleException(get_login_username() + ": you are not the job owner of job_id " + job_id)
-
-    # lock access to local (per-compute node) image information
-    with local_lock_images() as lock:
-
-        # update per-job image usage information
-        clear_image_usage(job_id, imagename)
-
-        if not is_image_mounted(imagename, mntpoint):
-            # this is not necessarily an error. Happens in this scenario:
-            # - load a module (mount image)
-            # - start a script. It will see the module as loaded
-            # - unload the module from the script (will also unmount the image)
-            # - exit the script, go back to original environment. The module is still 'loaded' here. unloading the module
-            # attempts to unmount an image, which has already been unmounted in the script - hence the exception.
-            raise ModuleException("It seems " + imagename + " is not mounted at " + mntpoint)
-
-        # do not unmount if the image is used by sb. else
-        usage = get_image_usage(imagename)
-        if usage:
-            print(job_id + " --- image " + imagename + " still used by " + str(usage) + " jobs, refusing to unmount.")
-            return
-
-        # call the umount process.
+from daemon_client import daemon_request, absolute_requests
+
+
+# Unmount an image unless it is still used by other jobs, and remove the host from the global image lock file.
+# With keep_idle, software images are kept mounted as idle images instead, see idle_grace.
+# Returns the status of the image. Must be called with the local (per-compute node) image lock held,
+# after the per-job image usage information has been updated.
+def umount_locked(imagename, mntpoint, job_id='NOJOBID', keep_idle=True):
+
+    if not is_image_mounted(imagename, mntpoint):
+        # this is not necessarily an error. Happens in this scenario:
+        # - load a module (mount image)
+        # - start a script. It will see the module as loaded
+        # - unload the module from the script (will also unmount the image)
+        # - exit the script, go back to original environment. The module is still 'loaded' here. unloading the module
+        # attempts to unmount an image, which has already been unmounted in the script - hence the exception.
+        raise ModuleException("It seems " + imagename + " is not mounted at " + mntpoint)
+
+    # do not unmount if the image is used by sb. else. Stacks that use the image as a layer do not use this mount.
+    usage = get_image_usage(imagename, layers=False)
+    stacked = any(m.fstype == 'overlay' for m in get_mount_table().find_source(imagename) if m.mntpoint == os.path.realpath(mntpoint))
+    if usage:
+        print(job_id + " --- image " + imagename + " still used by " + str(usage) + " jobs, refusing to unmount.")
+        return 'still used by ' + str(usage) + ' jobs'
+
+    # keep software images mounted and cached for the next jobs, unless the idle budget is exceeded
+    if keep_idle and hpcmodules.idle_grace > 0 and is_path_under(imagename, image_path):
+        set_image_idle(imagename, mntpoint)
+        if imagename not in evict_idle_images(job_id):
+            print(job_id + " --- image " + imagename + " is idle, kept mounted for " + str(hpcmodules.idle_grace) + " s.")
+            return 'idle'
+        return 'unmounted'
+
+    # call the umount process.
+    with metrics_phase('umount', imagename):
         cmd = ["/bin/umount", mntpoint]
         p = subprocess.Popen(cmd, stderr=PIPE)
         stderrdata = p.communicate()[1]
@@ -56,15 +59,40 @@ def umount_image(mntname, mntpoint=None, job_id='NOJOBID'):
         else:
             print(job_id + " --- image " + imagename + " has been unmounted.")
 
-        # remove host info from image lock file
-        # if that fails, and the image has in fact been unmounted, this will be reported in monitoring as an inconsistency:
-        # an image reported as mounted is in fact not mounted.
+    # an idle image is not idle any more
+    if hpcmodules.idle_grace > 0 and is_path_under(imagename, image_path):
+        clear_images_idle([imagename])
+
+    # the layers of a stacked image, unless other stacks use them
+    if stacked:
+        umount_layers(job_id)
+
+    # the image can still be mounted on the host as a layer of a stack
+    if is_image_mounted(imagename):
+        print(job_id + " --- image " + imagename + " is still mounted as a layer of a stacked image.")
+        return 'unmounted'
+
+    # remove host info from the global image lock
+    # if that fails, and the image has in fact been unmounted, this will be reported in monitoring as an inconsistency:
+    # an image reported as mounted is in fact not mounted.
+    hostname = socket.gethostname()
+    with fs_lock_file(imagename + ".lock", False, shared=True) as fd:
+
+        # remove the holder record of the host
+        remove_image_holder(imagename, hostname)
+
+        # RW mounts, and RO mounts made by older versions store the host name in the lock file
+        fd.seek(0)
+        data = fd.readlines()
+        in_lock_file = any(parse_lock_file_line(line)[0] == hostname for line in data)
+
+    if in_lock_file:
         with fs_lock_file(imagename + ".lock", False) as fd:
 
             # filter out local host name
             fd.seek(0)
             data = fd.readlines()
-            data = [line for line in data if socket.gethostname() not in line]
+            data = [line for line in data if parse_lock_file_line(line)[0] != hostname]
 
             # truncate the file and write new, filtered data
             fd.truncate(0)
@@ -72,19 +100,113 @@ def umount_image(mntname, mntpoint=None, job_id='NOJOBID'):
             if len(data):
                 fd.writelines(data)
 
+    # keep at most loop_pool_size pool loop devices attached
+    if is_path_under(imagename, image_path):
+        trim_loop_pool()
+
+    return 'unmounted'
+
+
+# Unmount the idle images whose grace period is over, and the longest idle images beyond the idle budget, see
+# get_expired_images. With force, unmount all idle images. Must be called with the local (per-compute node) image
+# lock held. Returns the names of the unmounted images.
+def evict_idle_images(job_id='NOJOBID', force=False):
+    idle = get_idle_images()
+    expired = idle if force else get_expired_images(idle)
+    evicted = []
+    for (imagename, mntpoint, since) in expired:
+        print(job_id + " --- unmounting image " + imagename + ", idle for %d s" % (time.time() - since))
+        try:
+            if umount_locked(imagename, mntpoint, job_id, keep_idle=False) == 'unmounted':
+                evicted.append(imagename)
+        except ModuleException:
+            print(job_id + str(sys.exc_info()[1]))
+    return evicted
+
+
+def umount_image(mntname, mntpoint=None, job_id='NOJOBID', keep_idle=True):
+
+    # argument validation: image name / module name, and mount point
+    imagename, mntpoint, modulename = validate_mount_arguments(mntname, mntpoint)
+
+    # if a job file exists, make sure the calling user is the job owner
+    if not is_job_owner(job_id):
+        raise ModuleException(get_login_username() + ": you are not the job owner of job_id " + job_id)
+
+    # lock access to local (per-compute node) image information
+    with local_lock_images() as lock:
+
+        # update per-job image usage information
+        with metrics_phase('job_file'):
+            clear_image_usage(job_id, imagename)
+
+        umount_locked(imagename, mntpoint, job_id, keep_idle)
+
+
+# Unmount several images of a job with a single local lock and a single update of the job file.
+# requests is a list of (name, mount point) tuples, see get_image_requests.
+# Returns a per-image status report: a list of (name, status, message, seconds) tuples.
+def umount_images(requests, job_id='NOJOBID', keep_idle=True):
+
+    # if a job file exists, make sure the calling user is the job owner
+    if not is_job_owner(job_id):
+        raise ModuleException(get_login_username() + ": you are not the job owner of job_id " + job_id)
+
+    report = [None] * len(requests)
+    checked = []
+    for i, (mntname, mntpoint) in enumerate(requests):
+        start = time.time()
+        try:
+            imagename, mntpoint, modulename = validate_mount_arguments(mntname, mntpoint)
+            checked.append((i, imagename, mntpoint))
+        except:
+            report[i] = (mntname, 'FAILED', str(sys.exc_info()[1]), time.time() - start)
+
+    # lock access to local (per-compute node) image information
+    with local_lock_images() as lock:
+
+        # update per-job image usage information
+        with metrics_phase('job_file'):
+            clear_images_usage(job_id, [imagename for (i, imagename, mntpoint) in checked])
+
+        for (i, imagename, mntpoint) in checked:
+            start = time.time()
+            try:
+                report[i] = (requests[i][0], umount_locked(imagename, mntpoint, job_id, keep_idle), '', time.time() - start)
+            except:
+                report[i] = (requests[i][0], 'FAILED', str(sys.exc_info()[1]), time.time() - start)
+
+    return report
+
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Unmount a disk image.")
-    parser.add_argument("image_name", help="Name of the software module, or path to the mounted disk image file.")
-    parser.add_argument("mount_point", help="Mount point under " + hpcmodules.mount_path_usr + '/$USER', nargs='?', default=None)
+    parser.add_argument("image_name", help="Name of the software module(s), or path to the mounted disk image file followed by the mount point under " + hpcmodules.mount_path_usr + '/$USER', nargs='*')
+    parser.add_argument("--list", help="read images to unmount from a file, one per line: module name, or image path and mount point. Use - for stdin.", default=None)
     parser.add_argument("--job_id", help="job identifier [default $USER].", default="NOJOBID")
+    parser.add_argument("--now", help="unmount unused images now, do not keep them mounted as idle images (SI_IDLE_GRACE)", action='store_true')
     args = parser.parse_args()
 
     hpcmodules.gl_job_id = args.job_id
+    start_metrics('umount_image', args.job_id)
     try:
-        umount_image(args.image_name, mntpoint=args.mount_point, job_id=args.job_id)
+        requests = get_image_requests(args.image_name, args.list)
+        if len(requests) == 0:
+            parser.error("no images given")
+
+        # hand the request to the image daemon, if it is running
+        batch = len(requests) > 1 or args.list is not None
+        ok = daemon_request({'op': 'umount', 'images': absolute_requests(requests), 'job_id': args.job_id, 'batch': batch, 'now': args.now})
+        if ok is not None:
+            if not ok:
+                exit(1)
+        elif not batch:
+            umount_image(requests[0][0], mntpoint=requests[0][1], job_id=args.job_id, keep_idle=not args.now)
+        elif not print_image_report(args.job_id, umount_images(requests, job_id=args.job_id, keep_idle=not args.now)):
+            exit(1)
     except ModuleException:
         print(args.job_id + str(sys.exc_info()[1]))
+        metrics_failed(str(sys.exc_info()[1]))
         exit(1)
     # other exceptions run through
@@ -0,0 +1,173 @@
+#!/usr/bin/env python2
+
+# Node-local image usage index.
+#
+# The number of jobs that use an image is kept in a SQLite database next to the per-job .modules files, with one row
+# per (job, image). The .modules files remain the primary record: the index is updated after them, under
+# local_lock_images(), and can be rebuilt from them at any time (rebuild_usage_index).
+#
+# The usage history (number of jobs that used an image, and the time of its last use) is kept in the same database,
+# for the loop device pool. It is not derived from the job files, a rebuild keeps it.
+#
+# The layers of the stacked images mounted on the node (see get_image_stack) are kept in the same database, one row
+# per (image, lower image): a job that uses a stacked image also uses its lower images. They mirror the mount table,
+# and are rewritten from it when layers are unmounted.
+#
+# Idle images, kept mounted without jobs for a grace period (see idle_grace in hpcmodules), are kept in the same
+# database with their mount point and the time since they are idle. A job that uses an idle image again removes it.
+
+import os
+import time
+import sqlite3
+
+# database file, located in local_lock_path
+index_name = "usage.db"
+
+
+def open_index(path):
+    conn = sqlite3.connect(path, timeout=10)
+    conn.text_factory = str
+    conn.execute("CREATE TABLE IF NOT EXISTS usage (job TEXT NOT NULL, image TEXT NOT NULL, PRIMARY KEY (job, image))")
+    conn.execute("CREATE INDEX IF NOT EXISTS usage_image ON usage (image)")
+    conn.execute("CREATE TABLE IF NOT EXISTS history (image TEXT PRIMARY KEY, uses INTEGER NOT NULL, last_used REAL NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS layers (image TEXT NOT NULL, layer TEXT NOT NULL, PRIMARY KEY (image, layer))")
+    conn.execute("CREATE INDEX IF NOT EXISTS layers_layer ON layers (layer)")
+    conn.execute("CREATE TABLE IF NOT EXISTS idle (image TEXT PRIMARY KEY, mntpoint TEXT NOT NULL, since REAL NOT NULL)")
+    return conn
+
+
+# add images used by a job
+def add_usage(path, job, images):
+    now = time.time()
+    conn = open_index(path)
+    try:
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO usage (job, image) VALUES (?, ?)", [(job, i) for i in images])
+            conn.executemany("INSERT OR IGNORE INTO history (image, uses, last_used) VALUES (?, 0, ?)", [(i, now) for i in images])
+            conn.executemany("UPDATE history SET uses = uses + 1, last_used = ? WHERE image = ?", [(now, i) for i in images])
+            conn.executemany("DELETE FROM idle WHERE image = ?", [(i,) for i in images])
+    finally:
+        conn.close()
+
+
+# remove images used by a job. If images is None, remove all images of the job. If job is None, remove everything.
+def clear_usage(path, job=None, images=None):
+    conn = open_index(path)
+    try:
+        with conn:
+            if job is None:
+                conn.execute("DELETE FROM usage")
+            elif images is None:
+                conn.execute("UPDATE history SET last_used = ? WHERE image IN (SELECT image FROM usage WHERE job = ?)", (time.time(), job))
+                conn.execute("DELETE FROM usage WHERE job = ?", (job,))
+            else:
+                conn.executemany("UPDATE history SET last_used = ? WHERE image = ?", [(time.time(), i) for i in images])
+                conn.executemany("DELETE FROM usage WHERE job = ? AND image = ?", [(job, i) for i in images])
+    finally:
+        conn.close()
+
+
+# set the lower images of a mounted stacked image
+def add_layers(path, image, layers):
+    conn = open_index(path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM layers WHERE image = ?", (image,))
+            conn.executemany("INSERT OR IGNORE INTO layers (image, layer) VALUES (?, ?)", [(image, l) for l in layers])
+    finally:
+        conn.close()
+
+
+# replace the layers with stacks, a dictionary image -> list of lower images
+def set_layers(path, stacks):
+    conn = open_index(path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM layers")
+            for image, layers in stacks.items():
+                conn.executemany("INSERT OR IGNORE INTO layers (image, layer) VALUES (?, ?)", [(image, l) for l in layers])
+    finally:
+        conn.close()
+
+
+# mark an image mounted at mntpoint as idle, since now unless it is idle already
+def set_idle(path, image, mntpoint):
+    conn = open_index(path)
+    try:
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO idle (image, mntpoint, since) VALUES (?, ?, ?)", (image, mntpoint, time.time()))
+    finally:
+        conn.close()
+
+
+# remove images from the idle images
+def clear_idle(path, images):
+    conn = open_index(path)
+    try:
+        with conn:
+            conn.executemany("DELETE FROM idle WHERE image = ?", [(i,) for i in images])
+    finally:
+        conn.close()
+
+
+# idle images: a list of (image, mount point, idle since), longest idle first
+def get_idle(path):
+    conn = open_index(path)
+    try:
+        return conn.execute("SELECT image, mntpoint, since FROM idle ORDER BY since").fetchall()
+    finally:
+        conn.close()
+
+
+# number of jobs that use an image (exact match). With layers, the jobs that use a mounted stacked image with the
+# image as a lower image are counted too.
+def get_usage(path, image, layers=True):
+    conn = open_index(path)
+    try:
+        if not layers:
+            return conn.execute("SELECT COUNT(*) FROM usage WHERE image = ?", (image,)).fetchone()[0]
+        return conn.execute("SELECT COUNT(DISTINCT job) FROM usage WHERE image = ? OR image IN "
+                            "(SELECT image FROM layers WHERE layer = ?)", (image, image)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+# usage history: a list of (image, number of uses, time of last use), most used first
+def get_history(path):
+    conn = open_index(path)
+    try:
+        return conn.execute("SELECT image, uses, last_used FROM history ORDER BY uses DESC, last_used DESC").fetchall()
+    finally:
+        conn.close()
+
+
+# Replace the index with the contents of jobs, a dictionary job -> list of images, and the layers of stacks, a
+# dictionary image -> list of lower images. The usage history and the idle images are kept.
+# The new index is built in a temporary file and renamed into place.
+def rebuild(path, jobs, stacks={}):
+    tmppath = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+    if os.path.exists(tmppath):
+        os.remove(tmppath)
+
+    history = []
+    idle = []
+    if os.path.isfile(path):
+        try:
+            history = get_history(path)
+            idle = get_idle(path)
+        except sqlite3.Error:
+            # broken index, the history and the idle images are lost
+            pass
+
+    conn = open_index(tmppath)
+    try:
+        with conn:
+            for job, images in jobs.items():
+                conn.executemany("INSERT OR IGNORE INTO usage (job, image) VALUES (?, ?)", [(job, i) for i in images])
+            conn.executemany("INSERT INTO history (image, uses, last_used) VALUES (?, ?, ?)", history)
+            conn.executemany("INSERT INTO idle (image, mntpoint, since) VALUES (?, ?, ?)", idle)
+            for image, layers in stacks.items():
+                conn.executemany("INSERT OR IGNORE INTO layers (image, layer) VALUES (?, ?)", [(image, l) for l in layers])
+    finally:
+        conn.close()
+    os.rename(tmppath, path)
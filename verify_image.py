@@ -0,0 +1,64 @@
+#!/usr/bin/env python2
+
+# Compare a directory tree against the manifest of an image (see manifest.py).
+#
+# The tree is the source directory of a module, or a mounted image: by default the mount path of the module, i.e.,
+# the source directory on the build host and the mounted image on a compute node. Without differences the exit
+# status is 0.
+#
+#   verify_image gcc/9.3.0                  # full check: contents hashed
+#   verify_image --quick gcc/9.3.0          # metadata only: type, mode, size, mtime
+#   verify_image --path /mnt/x /cluster/software/IMAGES/gcc/9.3.0.ext4
+
+import os
+import sys
+import argparse
+from hpcmodules import *
+from manifest import get_manifest_name, read_manifest, compute_manifest, compare_manifests
+from get_dir_size import scan_workers
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compare a source tree or a mounted image against the manifest of an image.")
+    parser.add_argument("image_name", help="name of the software module, or image file")
+    parser.add_argument("--path", help="directory tree to verify [default: mount path of the module]", default=None)
+    parser.add_argument("--quick", help="compare metadata only (type, mode, size, mtime), do not hash the files", action='store_true')
+    parser.add_argument("--workers", help="number of hashing threads [default: %(default)s, SI_SCAN_WORKERS]", type=int, default=scan_workers)
+    args = parser.parse_args()
+
+    try:
+        if os.path.isfile(args.image_name):
+            imagename = os.path.abspath(args.image_name)
+            path = args.path
+            if path is None:
+                raise ModuleException("--path is needed to verify an image file")
+        else:
+            imagename = get_image_name(args.image_name)
+            path = args.path
+            if path is None:
+                path = get_mount_path(args.image_name)
+
+        manifest_name = get_manifest_name(imagename)
+        if not os.path.isfile(manifest_name):
+            raise ModuleException(imagename + " has no manifest")
+        if not os.path.isdir(path):
+            raise ModuleException(path + " is not a directory")
+
+        old = read_manifest(manifest_name)
+        new = compute_manifest(path, args.workers, args.quick)
+        diffs = compare_manifests(old, new, args.quick)
+
+        for (p, what) in diffs:
+            print(" --- " + p + ": " + what)
+        if not args.quick:
+            print(" --- root " + new.root + (" matches" if new.root == old.root else " differs from " + old.root))
+        if len(diffs):
+            print(" --- " + path + " differs from " + manifest_name + " in " + str(len(diffs)) + " entries")
+            exit(1)
+        print(" --- " + path + " matches " + manifest_name)
+
+    except ModuleException:
+        print(str(sys.exc_info()[1]))
+        exit(2)
+    # other exceptions run through